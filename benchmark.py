@@ -0,0 +1,320 @@
+#!/usr/bin/env python2.7
+"""
+Headless benchmarks for the hot paths of the engine. Runs with SDL's dummy video
+driver so it works on build machines without a display.
+
+python benchmark.py                          prints the results as json
+python benchmark.py -o results.json          writes them to a file as well
+python benchmark.py -b baseline.json         compares them with a stored baseline
+                                             and exits with 1 if anything regressed
+"""
+import os
+os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+
+import sys
+import json
+import time
+import argparse
+import shutil
+import tempfile
+import platform
+import multiprocessing
+
+import pygame
+import numpy as np
+
+import depth_confusion
+from depth_confusion.common_util import *
+
+IMAGE_PACK = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'example_image_pack', 'pack.json')
+
+
+
+class GrassBlock(depth_confusion.voxels.Block):
+	def __init__(self):
+		depth_confusion.voxels.Block.__init__(self, 'grass-block')
+	
+	
+
+
+
+class GrassTile(depth_confusion.tiles.GroundTile):
+	def __init__(self):
+		depth_confusion.tiles.GroundTile.__init__(self, 'grass-tile')
+	
+	
+
+
+
+def measure(function, repeat = 5, number = 1, setup = None):
+	"""
+	Runs the function number times in a row, repeat times, and returns the
+	timings of one call. setup is called before every repeat and its return
+	value is passed to the function.
+	"""
+	timings = []
+	for i in xrange(repeat):
+		argument = setup() if setup else None
+		start = time.time()
+		for j in xrange(number):
+			function(argument)
+		
+		timings.append((time.time() - start) / number)
+	
+	timings.sort()
+	return {'min': timings[0],
+	        'median': timings[len(timings) / 2],
+	        'max': timings[-1],
+	        'repeat': repeat,
+	        'number': number}
+
+
+def load_pack(argument = None):
+	return depth_confusion.resource_loader.load_image_pack(IMAGE_PACK)
+
+
+def voxel_handler():
+	handler = depth_confusion.voxels.VoxelHandler()
+	handler.add_voxel_type('grass-block', GrassBlock)
+	return handler
+
+
+def flat_world(dimensions, image_handler):
+	return depth_confusion.world_generator.generate_flat(dimensions, dimensions[DEPTH] / 2,
+	                                                     voxel_handler(), image_handler, 'grass-block')
+
+
+def bench_load_image_pack(results, image_handler, quick):
+	#the loader prints every image it loads, keep that out of the output
+	stdout, sys.stdout = sys.stdout, open(os.devnull, 'w')
+	try:
+		results['load_image_pack'] = measure(load_pack, repeat = 5)
+		results['load_image_pack/lazy'] = measure(lambda a: depth_confusion.resource_loader.load_image_pack(IMAGE_PACK, lazy = True),
+		                                          repeat = 5)
+	
+	finally:
+		sys.stdout = stdout
+
+
+def bench_generate_flat(results, image_handler, quick):
+	for size in ((64, 64, 16),) if quick else ((64, 64, 16), (256, 256, 32), (512, 512, 32)):
+		results['generate_flat/{0}x{1}x{2}'.format(*size)] = measure(lambda a: flat_world(size, image_handler), repeat = 3)
+
+
+def bench_render(results, image_handler, quick):
+	screen = pygame.display.get_surface()
+	for size in ((16, 16, 8),) if quick else ((16, 16, 8), (64, 64, 16), (256, 256, 16)):
+		world = flat_world(size, image_handler)
+		for scale in (1, 0.5):
+			def setup():
+				viewport = depth_confusion.viewport.Viewport(screen)
+				viewport.attach_to_world(world)
+				viewport.scene_scale = scale
+				viewport.pan_view((screen.get_width() / 2, 0))
+				return viewport
+			
+			def first_frame(viewport):
+				#a new sprite cache and chunk grid make every frame a cold one
+				world.sprite_cache.clear()
+				world._chunks.invalidate_all()
+				viewport.on_render()
+			
+			name = 'render/{0}x{1}x{2}/scale-{3}'.format(size[X], size[Y], size[Z], scale)
+			results[name + '/cold'] = measure(first_frame, repeat = 3, setup = setup)
+			results[name + '/warm'] = measure(lambda viewport: viewport.on_render(), repeat = 5, number = 10, setup = setup)
+
+
+def bench_picking(results, image_handler, quick):
+	world = flat_world((64, 64, 16), image_handler)
+	points = [(x, y) for x in xrange(-600, 600, 37) for y in xrange(-100, 1000, 23)]
+	results['global_to_map/x{0}'.format(len(points))] = measure(lambda a: [world.global_to_map(point) for point in points])
+	results['global_to_map_array/x{0}'.format(len(points))] = measure(lambda a: world.global_to_map_array(points))
+	#from the top of the world down to the ground
+	world.scroll_layer(world.get_dimension(DEPTH) - 1 - world.get_visible_top())
+	results['pick/x{0}'.format(len(points))] = measure(lambda a: [world.pick(point) for point in points])
+
+
+def bench_edit(results, image_handler, quick):
+	handler = voxel_handler()
+	world = flat_world((32, 32, 8), image_handler)
+	coordinates = [(x, y, 3) for x in xrange(4, 28, 3) for y in xrange(4, 28, 3)]
+	
+	def delete_and_insert(argument):
+		for coordinate in coordinates:
+			del world[coordinate]
+		
+		for coordinate in coordinates:
+			world[coordinate] = handler.construct_voxel('grass-block')
+	
+	def in_transaction(argument):
+		with world.transaction():
+			delete_and_insert(argument)
+	
+	results['delete_insert/x{0}'.format(len(coordinates))] = measure(delete_and_insert)
+	results['delete_insert/transaction/x{0}'.format(len(coordinates))] = measure(in_transaction)
+
+
+def bench_viewports(results, image_handler, quick):
+	screen = pygame.display.get_surface()
+	size = (32, 32, 8) if quick else (64, 64, 16)
+	world = flat_world(size, image_handler)
+	#a main view, a split screen view and a minimap
+	viewports = [depth_confusion.viewport.Viewport(screen),
+	             depth_confusion.viewport.Viewport(screen, (screen.get_width() / 2, 0), (screen.get_width() / 2, 200)),
+	             depth_confusion.viewport.Viewport(screen, (0, 0), (200, 150))]
+	for viewport, scale in zip(viewports, (1, 1, 0.25)):
+		viewport.attach_to_world(world)
+		viewport.scene_scale = scale
+		viewport.center_on((size[X] / 2, size[Y] / 2, size[Z] / 2))
+	
+	def frame(argument):
+		for viewport in viewports:
+			viewport.on_render()
+	
+	for shared in (False, True):
+		world.shared_regions = shared
+		name = 'viewports/{0}x{1}x{2}/x3/{3}'.format(size[X], size[Y], size[Z], 'shared' if shared else 'chunks')
+		results[name] = measure(frame, repeat = 5, number = 10)
+
+
+def bench_pipeline(results, image_handler, quick):
+	size = (32, 32, 8) if quick else (64, 64, 16)
+	world = flat_world(size, image_handler)
+	viewport = depth_confusion.viewport.Viewport(pygame.display.get_surface())
+	viewport.attach_to_world(world)
+	viewport.center_on((size[X] / 2, size[Y] / 2, size[Z] / 2))
+	pipeline = depth_confusion.pipeline.RenderPipeline(viewport)
+	name = 'pipeline/{0}x{1}x{2}'.format(*size)
+	try:
+		#what a frame holds up the main loop for without and with the pipeline
+		results[name + '/direct'] = measure(lambda a: viewport.on_render(), repeat = 5, number = 10)
+		results[name + '/present'] = measure(lambda a: pipeline.present(), repeat = 5, number = 10)
+		results[name + '/present_wait'] = measure(lambda a: pipeline.present(wait = True), repeat = 5, number = 10)
+	
+	finally:
+		pipeline.stop()
+
+
+def bench_update(results, image_handler, quick):
+	size = (64, 64, 16) if quick else (256, 256, 16)
+	world = flat_world(size, image_handler)
+	results['on_update/{0}x{1}x{2}'.format(*size)] = measure(lambda a: world.on_update(), number = 10)
+
+
+def bench_prerender(results, image_handler, quick):
+	size = (32, 32, 8) if quick else (128, 128, 16)
+	world = flat_world(size, image_handler)
+	world._chunks.capacity = len(list(world._chunks.all_chunks()))
+	name = '{0}x{1}x{2}'.format(*size)
+	for workers in sorted(set([1, multiprocessing.cpu_count()])):
+		results['prerender_chunks/{0}/x{1}'.format(name, workers)] = measure(
+			lambda a: depth_confusion.prerender.prerender_chunks(world, workers = workers), repeat = 3,
+			setup = lambda: world._chunks.invalidate_all())
+
+
+def bench_tiles(results, image_handler, quick):
+	size = (128, 128) if quick else (1024, 1024)
+	handler = depth_confusion.tiles.TileHandler()
+	handler.add_tile_type('grass-tile', GrassTile)
+	world = depth_confusion.tiles.TiledWorld(image_handler, handler, size)
+	world.fill_from_array(np.ones((size[Y], size[X]), dtype = np.uint8), ['void', 'grass-tile'])
+	viewport = depth_confusion.viewport.Viewport(pygame.display.get_surface())
+	viewport.attach_to_world(world)
+	viewport.center_on((size[X] / 2, size[Y] / 2))
+	
+	def scroll(argument):
+		viewport.pan_view((5, 3))
+		viewport.on_render()
+	
+	results['tiles_scroll/{0}x{1}'.format(*size)] = measure(scroll, repeat = 5, number = 20)
+
+
+def bench_world_io(results, image_handler, quick):
+	size = (64, 64, 16) if quick else (512, 512, 32)
+	world = flat_world(size, image_handler)
+	filepath = os.path.join(tempfile.mkdtemp(), 'world.dcw')
+	try:
+		name = '{0}x{1}x{2}'.format(*size)
+		results['save_world/' + name] = measure(lambda a: depth_confusion.world_io.save_world(world, filepath), repeat = 3)
+		results['load_world/' + name] = measure(lambda a: depth_confusion.world_io.close_world(
+			depth_confusion.world_io.load_world(filepath, image_handler, voxel_handler())))
+	
+	finally:
+		shutil.rmtree(os.path.dirname(filepath))
+
+
+BENCHMARKS = [bench_load_image_pack, bench_generate_flat, bench_render, bench_picking, bench_edit, bench_viewports, bench_pipeline, bench_update, bench_prerender, bench_tiles, bench_world_io]
+
+
+def run(quick = False, only = None):
+	pygame.init()
+	pygame.display.set_mode((800, 600))
+	
+	#the images are decoded as the benchmarks first use them
+	image_handler = depth_confusion.resource_loader.load_image_pack(IMAGE_PACK, lazy = True)
+	
+	results = {}
+	for benchmark in BENCHMARKS:
+		if not only or any(name in benchmark.__name__ for name in only):
+			benchmark(results, image_handler, quick)
+	
+	pygame.quit()
+	return {'meta': {'python': platform.python_version(),
+	                 'pygame': pygame.version.ver,
+	                 'numpy': np.__version__,
+	                 'machine': platform.machine(),
+	                 'time': time.strftime('%Y-%m-%dT%H:%M:%S')},
+	        'results': results}
+
+
+def compare(results, baseline, tolerance):
+	"""
+	Compares the minimum timings with a baseline, returns a list of
+	(name, baseline, current, ratio) for everything that got slower than the tolerance.
+	"""
+	regressions = []
+	for name in sorted(results['results']):
+		if name not in baseline['results']:
+			continue
+		
+		current = results['results'][name]['min']
+		old = baseline['results'][name]['min']
+		ratio = current / old if old else 1.0
+		sys.stderr.write('{0:50} {1:10.6f} {2:10.6f} {3:7.2f}x\n'.format(name, old, current, ratio))
+		if ratio > 1 + tolerance:
+			regressions.append((name, old, current, ratio))
+	
+	return regressions
+
+
+def main(argv):
+	parser = argparse.ArgumentParser(description = 'Benchmarks the hot paths of DepthConfusion.')
+	parser.add_argument('-o', '--output', help = 'write the results to this json file')
+	parser.add_argument('-b', '--baseline', help = 'compare the results with this json file')
+	parser.add_argument('-t', '--tolerance', type = float, default = 0.25,
+	                    help = 'how much slower than the baseline still passes (default 0.25)')
+	parser.add_argument('-q', '--quick', action = 'store_true', help = 'only run the small sizes')
+	parser.add_argument('-k', '--only', action = 'append', help = 'only run benchmarks with this in their name')
+	args = parser.parse_args(argv)
+	
+	results = run(args.quick, args.only)
+	
+	print(json.dumps(results, indent = 2, sort_keys = True))
+	if args.output:
+		with open(args.output, 'w') as f_object:
+			json.dump(results, f_object, indent = 2, sort_keys = True)
+	
+	if args.baseline:
+		with open(args.baseline) as f_object:
+			regressions = compare(results, json.load(f_object), args.tolerance)
+		
+		for (name, old, current, ratio) in regressions:
+			sys.stderr.write('REGRESSION {0}: {1:.6f}s -> {2:.6f}s ({3:.2f}x)\n'.format(name, old, current, ratio))
+		
+		return 1 if regressions else 0
+	
+	return 0
+
+
+if __name__ == '__main__':
+	sys.exit(main(sys.argv[1:]))
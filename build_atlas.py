@@ -0,0 +1,40 @@
+#!/usr/bin/env python2.7
+"""
+Builds the atlas cache of an image pack ahead of time, so the first start of
+the game does not have to. load_image_pack(filepath, atlas = True) uses it.
+
+python build_atlas.py example_image_pack/pack.json
+"""
+import os
+os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+
+import sys
+import argparse
+
+import pygame
+
+import depth_confusion
+
+
+
+def main(argv):
+	parser = argparse.ArgumentParser(description = 'Packs the images of an image pack into atlas pages.')
+	parser.add_argument('pack', nargs = '+', help = 'the pack.json of the image pack')
+	parser.add_argument('-s', '--max-size', type = int, default = 2048,
+	                    help = 'the largest width and height of an atlas page (default 2048)')
+	args = parser.parse_args(argv)
+	
+	pygame.init()
+	for filepath in args.pack:
+		image_handler = depth_confusion.resource_loader.load_image_pack(filepath, lazy = True)
+		image_handler.save_atlas(filepath, args.max_size)
+		
+		(table_path, page_path) = depth_confusion.resource_loader.atlas_paths(filepath)
+		print('packed {0} images of {1} into {2}'.format(len(image_handler.get_image_ids()), filepath, table_path))
+	
+	pygame.quit()
+	return 0
+
+
+if __name__ == '__main__':
+	sys.exit(main(sys.argv[1:]))
@@ -2,5 +2,10 @@ import voxels
 import viewport
 import resource_loader
 import world_generator
+import profiling
+import world_io
+import prerender
+import tiles
+import pipeline
 from common_util import *
-__all__ = ["resource_loader", "voxels", "world_generator", "viewport"]
\ No newline at end of file
+__all__ = ["resource_loader", "voxels", "world_generator", "viewport", "profiling", "world_io", "prerender", "tiles", "pipeline"]
\ No newline at end of file
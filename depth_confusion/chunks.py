@@ -0,0 +1,316 @@
+"""
+Splits a voxel world into fixed size chunks. Every chunk is rendered once onto
+a surface of its own and only gets rendered again when something in it changes,
+so rendering a world that does not change is just a few chunk blits.
+Author: Huba Nagy
+"""
+import math
+import pygame
+from collections import OrderedDict
+from common_util import *
+from profiling import PROFILER
+
+
+
+class ChunkTarget(object):
+	"""
+	Looks enough like a Viewport for the voxels to render themselves onto
+	the surface of a chunk instead of the scene of a viewport.
+	"""
+	def __init__(self, surface, placement, scale):
+		self.scene = surface
+		self.scene_placement = placement
+		self.scene_scale = scale
+	
+	
+	def get_global_rect(self):
+		(w, h) = self.scene.get_size()
+		return pygame.Rect((-self.scene_placement[X], -self.scene_placement[Y]),
+		                   (int(math.ceil(w / float(self.scene_scale))), int(math.ceil(h / float(self.scene_scale)))))
+	
+	
+	def global_to_scene(self, global_coordinates):
+		#rounded down even left of and above the surface, so what is drawn across
+		#the edges of neighbouring surfaces lines up
+		return (int(math.floor((self.scene_placement[X] + global_coordinates[X]) * self.scene_scale)),
+		        int(math.floor((self.scene_placement[Y] + global_coordinates[Y]) * self.scene_scale)))
+	
+	
+
+
+
+class SurfaceCache(object):
+	"""
+	Holds on to rendered surfaces by key, each with the version of what it shows.
+	The least recently used surfaces are dropped above capacity.
+	"""
+	def __init__(self, capacity):
+		self.capacity = capacity
+		self._surfaces = OrderedDict()
+	
+	
+	def _kept_surface(self, key, version = None):
+		"""
+		Returns the kept surface of a key and marks it as the most recently used,
+		raises KeyError if there is none or it is of another version.
+		"""
+		(surface_version, surface) = self._surfaces.pop(key)
+		if surface_version != version:
+			raise KeyError(key)
+		
+		self._surfaces[key] = (version, surface)
+		return surface
+	
+	
+	def _keep_surface(self, key, surface, version = None):
+		self._surfaces.pop(key, None)
+		if len(self._surfaces) >= self.capacity:
+			self._surfaces.popitem(last = False)
+		
+		self._surfaces[key] = (version, surface)
+	
+	
+	def invalidate_all(self):
+		self._surfaces.clear()
+	
+	
+
+
+
+class ChunkGrid(SurfaceCache):
+	"""
+	Keeps track of which chunks of a world have changed and holds on to the
+	rendered surfaces of the chunks. Chunks are indexed with (cx, cy, cz) chunk
+	coordinates and the least recently used surfaces are dropped above capacity.
+	"""
+	def __init__(self, world, chunk_dimensions = (8, 8, 4), capacity = 256):
+		SurfaceCache.__init__(self, capacity)
+		self._world = world
+		self.chunk_dimensions = chunk_dimensions
+		self._grid_dimensions = tuple((world.get_dimension(i) + chunk_dimensions[i] - 1) / chunk_dimensions[i]
+		                              for i in (WIDTH, HEIGHT, DEPTH))
+		
+		#every change to a chunk bumps its version, surfaces of older versions are stale
+		self._versions = {}
+		self._rects = {}
+		
+		self.renders = 0
+	
+	
+	def get_dimension(self, dimension):
+		return self._grid_dimensions[dimension]
+	
+	
+	def chunk_of(self, coordinate):
+		"""
+		Returns the coordinate of the chunk the given map coordinate is in.
+		"""
+		return (coordinate[X] / self.chunk_dimensions[X],
+		        coordinate[Y] / self.chunk_dimensions[Y],
+		        coordinate[Z] / self.chunk_dimensions[Z])
+	
+	
+	def chunk_box(self, chunk):
+		"""
+		Returns the lowest and the one past the highest map coordinate of a chunk.
+		"""
+		low = tuple(chunk[i] * self.chunk_dimensions[i] for i in (X, Y, Z))
+		high = tuple(min(low[i] + self.chunk_dimensions[i], self._world.get_dimension(i)) for i in (X, Y, Z))
+		return low, high
+	
+	
+	def chunk_rect(self, chunk):
+		"""
+		Returns the rect in global coordinates that all the voxels of the chunk fit into.
+		"""
+		try:
+			return self._rects[chunk]
+		
+		except KeyError:
+			(low, high) = self.chunk_box(chunk)
+			self._rects[chunk] = self._world.box_rect(low, (high[X] - 1, high[Y] - 1, high[Z] - 1))
+			return self._rects[chunk]
+	
+	
+	def chunks_showing(self, coordinate):
+		"""
+		Returns the chunks whose surfaces show the voxel of a map coordinate, its
+		own and the ones it is on the rim of (see _render_chunk).
+		"""
+		return set(self.chunk_of((coordinate[X] + dx, coordinate[Y] + dy, coordinate[Z]))
+		           for dx, dy in ((0, 0), (1, 0), (0, 1)))
+	
+	
+	def invalidate(self, coordinate):
+		"""
+		Marks the chunks that show the given map coordinate as changed.
+		"""
+		for chunk in self.chunks_showing(coordinate):
+			self._versions[chunk] = self._versions.get(chunk, 0) + 1
+	
+	
+	def invalidate_box(self, low, high):
+		"""
+		Marks all the chunks that show the voxels between two map coordinates (both
+		inclusive) as changed, the box is clipped to the world.
+		"""
+		low = [max(low[i], 0) for i in (X, Y, Z)]
+		#the chunks after the box have it on their rim
+		high = [min(high[i] + (i != Z), self._world.get_dimension(i) - 1) for i in (X, Y, Z)]
+		if low[X] > high[X] or low[Y] > high[Y] or low[Z] > high[Z]:
+			return
+		
+		(cx0, cy0, cz0) = self.chunk_of(low)
+		(cx1, cy1, cz1) = self.chunk_of(high)
+		for cz in xrange(cz0, cz1 + 1):
+			for cy in xrange(cy0, cy1 + 1):
+				for cx in xrange(cx0, cx1 + 1):
+					self._versions[(cx, cy, cz)] = self._versions.get((cx, cy, cz), 0) + 1
+	
+	
+	def render_state(self, chunk):
+		"""
+		Returns the low and the one past the high coordinate of the box a chunk is
+		rendered from and the version a rendered surface of it has to have.
+		"""
+		(low, high) = self.chunk_box(chunk)
+		
+		#the layer cut off and the top layer outlines change the look of a chunk too
+		top = min(self._world.get_visible_top(), high[Z] - 1)
+		active_layer = self._world._active_layer if low[Z] <= self._world._active_layer < high[Z] else None
+		return low, (high[X], high[Y], top + 1), (self._versions.get(chunk, 0), top, active_layer)
+	
+	
+	def get_surface(self, chunk, scale):
+		"""
+		Returns the rendered surface of a chunk at the given scale, rendering it if
+		it has changed since it was last rendered. None if the chunk is empty.
+		"""
+		(low, high, version) = self.render_state(chunk)
+		
+		try:
+			return self._kept_surface((chunk, scale), version)
+		
+		except KeyError:
+			surface = self._render_chunk(chunk, low, high, scale)
+			self._keep_surface((chunk, scale), surface, version)
+			return surface
+	
+	
+	def put_surface(self, chunk, scale, version, surface):
+		"""
+		Keeps a surface of a chunk that was rendered somewhere else, version is
+		the one render_state gave before it was rendered.
+		"""
+		self._keep_surface((chunk, scale), surface, version)
+	
+	
+	def all_chunks(self):
+		"""
+		Yields the coordinates of every chunk up to the visible top in the order
+		they have to be rendered in.
+		"""
+		top = self._world.get_visible_top()
+		for cz in xrange(min(top / self.chunk_dimensions[Z] + 1, self._grid_dimensions[Z])):
+			for cy in xrange(self._grid_dimensions[Y]):
+				for cx in xrange(self._grid_dimensions[X]):
+					yield (cx, cy, cz)
+	
+	
+	def _render_chunk(self, chunk, low, high, scale):
+		self.renders += 1
+		if not self._world.has_voxels_in_box(low, high):
+			return None
+		
+		with PROFILER.phase('chunk_render'):
+			rect = self.chunk_rect(chunk)
+			size = (int(rect.w * scale) + 1, int(rect.h * scale) + 1)
+			surface = pygame.Surface(size, flags = pygame.SRCALPHA)
+			self._world.render_box(ChunkTarget(surface, (-rect.x, -rect.y), scale), low, high)
+			
+			#a voxel of the rim, the row and column right behind the chunk in the chunks
+			#blitted before it, is drawn over the voxel of the chunk in front of it a layer
+			#below it (no others for voxels at least half as deep as they are high). The
+			#chunk is drawn again with its rim layer by layer and cut to its own voxels.
+			if self._rim_overlaps(low, high):
+				whole = pygame.Surface(size, flags = pygame.SRCALPHA)
+				self._world.render_box(ChunkTarget(whole, (-rect.x, -rect.y), scale),
+				                       (max(low[X] - 1, 0), max(low[Y] - 1, 0), low[Z]), high)
+				surface.fill((255, 255, 255, 0), special_flags = pygame.BLEND_RGBA_MAX)
+				whole.blit(surface, (0, 0), special_flags = pygame.BLEND_RGBA_MIN)
+				surface = whole
+		
+		if PROFILER.enabled:
+			PROFILER.count('chunks_rendered')
+			PROFILER.count('surfaces_allocated')
+		
+		return surface
+	
+	
+	def _rim_overlaps(self, low, high):
+		"""
+		Whether a voxel on the rim of a chunk box is drawn over a voxel of the box
+		right in front of it and a layer below it.
+		"""
+		if high[Z] - low[Z] < 2 or (low[X] == 0 and low[Y] == 0):
+			return False
+		
+		edge = (max(low[X] - 1, 0), max(low[Y] - 1, 0), low[Z])
+		drawn = self._world.drawn_in_box(edge, high)
+		(ox, oy) = (low[X] - edge[X], low[Y] - edge[Y])
+		return bool((ox and (drawn[1:, oy:, 0] & drawn[:-1, oy:, 1]).any()) or
+		            (oy and (drawn[1:, 0, ox:] & drawn[:-1, 1, ox:]).any()))
+	
+	
+	def visible_chunks(self, rect):
+		"""
+		Yields the coordinates of the chunks that intersect the given rect in
+		global coordinates, in the order they have to be rendered in.
+		"""
+		top = self._world.get_visible_top()
+		for cz in xrange(min(top / self.chunk_dimensions[Z] + 1, self._grid_dimensions[Z])):
+			low_z = cz * self.chunk_dimensions[Z]
+			box = self._world.screen_index.box_in_rect(rect, low_z, min(low_z + self.chunk_dimensions[Z] - 1, top))
+			if not box:
+				continue
+			
+			(low, high) = (self.chunk_of(box[0]), self.chunk_of(box[1]))
+			for cy in xrange(low[Y], high[Y] + 1):
+				for cx in xrange(low[X], high[X] + 1):
+					if self.chunk_rect((cx, cy, cz)).colliderect(rect):
+						yield (cx, cy, cz)
+	
+	
+	def scene_blits(self, viewport, rect = None):
+		"""
+		Returns the (surface, scene position) pairs of the chunks that are in the
+		view of the viewport back to front, rendering the ones that changed. If a
+		rect of global coordinates is given only the chunks in it are returned.
+		"""
+		view = viewport.get_global_rect()
+		if rect:
+			view = view.clip(rect)
+		
+		blits = []
+		for chunk in self.visible_chunks(view):
+			surface = self.get_surface(chunk, viewport.scene_scale)
+			if surface:
+				blits.append((surface, viewport.global_to_scene(self.chunk_rect(chunk).topleft)))
+		
+		return blits
+	
+	
+	def on_render(self, viewport, rect = None):
+		"""
+		Blits the chunks that are in the view onto the scene of the viewport back to front.
+		If a rect of global coordinates is given only the chunks in it are blitted.
+		"""
+		for surface, position in self.scene_blits(viewport, rect):
+			viewport.scene.blit(surface, position)
+			if PROFILER.enabled:
+				PROFILER.count('chunk_blits')
+				PROFILER.count('blits')
+	
+	
+
+
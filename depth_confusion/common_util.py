@@ -13,7 +13,7 @@ DEPTH = Z = 2
 #Colors for mapping coordinates
 TEST_RED = pygame.Color(255, 0, 0, 255)#-16776961
 TEST_GREEN = pygame.Color(0, 255, 0, 255)#-16711936
-TEST_YELLOW = pygame.Color(255, 0, 255, 255)#-16711681
+TEST_YELLOW = pygame.Color(255, 255, 0, 255)
 TEST_BLUE = pygame.Color(0, 0, 255, 255)#-65536
 
 #Visibility flags
@@ -36,6 +36,11 @@ UNPROJECT *= mp.matrix([[1, 0, 0],
                         [0, 2, 0],
                         [0, 0, 1]])
 
+#The same unprojection in plain floats for fast picking, there is no translation
+#in it so only the top left 2x2 part of it matters
+UNPROJECT_FLOAT = ((float(UNPROJECT[0, 0]), float(UNPROJECT[0, 1])),
+                   (float(UNPROJECT[1, 0]), float(UNPROJECT[1, 1])))
+
 
 class OutOfIt(Exception):
 	def __init__(self, msg, value):
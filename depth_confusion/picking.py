@@ -0,0 +1,79 @@
+"""
+Tells which grid element is under a point. The diamonds of a grid sit on a grid
+of rectangles as big as one diamond, every rectangle holds one whole diamond and
+a corner of four others. The colour coded mouse-help image of the image pack
+tells which one each pixel of a rectangle belongs to. It is decoded once into
+a table of -1/0/+1 corrections, so picking is some arithmetic and a table read.
+Based on: http://www.alcove-games.com/advanced-tutorials/isometric-tile-picking/
+Author: Huba Nagy
+"""
+import math
+import pygame
+import numpy as np
+from common_util import *
+
+#the colours of the corners of the mouse-help image and the corrections they stand for
+CORRECTIONS = ((TEST_RED, (0, -1)),
+               (TEST_GREEN, (-1, 0)),
+               (TEST_BLUE, (0, 1)),
+               (TEST_YELLOW, (1, 0)))
+
+
+
+class PickingTable(object):
+	"""
+	The map x and y corrections of every pixel of a rectangle, indexed [y, x].
+	Without a mouse-help image the table is made from the diamond that fills
+	the rectangle.
+	"""
+	def __init__(self, dimensions, image = None):
+		(w, h) = dimensions
+		self._dimensions = dimensions
+		self.dx = np.zeros((h, w), dtype = np.int8)
+		self.dy = np.zeros((h, w), dtype = np.int8)
+		
+		if image is None:
+			(py, px) = np.mgrid[0:h, 0:w] + 0.5
+			outside = np.abs(px - w / 2.0) / (w / 2.0) + np.abs(py - h / 2.0) / (h / 2.0) > 1
+			(left, top) = (px < w / 2.0, py < h / 2.0)
+			#in the order of CORRECTIONS
+			corners = (top & left, top & ~left, ~top & ~left, ~top & left)
+			masks = [(outside & corner, correction) for corner, (color, correction) in zip(corners, CORRECTIONS)]
+		
+		else:
+			if image.get_size() != (w, h):
+				image = pygame.transform.scale(image, (w, h))
+			
+			pixels = pygame.surfarray.array3d(image).transpose(1, 0, 2)
+			masks = [((pixels == (color.r, color.g, color.b)).all(axis = 2), correction)
+			         for color, correction in CORRECTIONS]
+		
+		for mask, (cx, cy) in masks:
+			self.dx[mask] = cx
+			self.dy[mask] = cy
+	
+	
+	def pick(self, px, py):
+		"""
+		Returns the (mx, my) of the diamond under a point. The rectangle of the
+		(0, 0) diamond has its top left corner at (0, 0), going right on the
+		screen is -x +y on the map and going down is +x +y.
+		"""
+		(w, h) = self._dimensions
+		(cx, ix) = divmod(int(math.floor(px)), w)
+		(cy, iy) = divmod(int(math.floor(py)), h)
+		return (cy - cx + int(self.dx[iy, ix]), cy + cx + int(self.dy[iy, ix]))
+	
+	
+	def pick_array(self, px, py):
+		"""
+		The same as pick for arrays of points, returns an array of mx and an array of my.
+		"""
+		(w, h) = self._dimensions
+		px = np.floor(px).astype(np.int64)
+		py = np.floor(py).astype(np.int64)
+		(cx, ix) = (px // w, px % w)
+		(cy, iy) = (py // h, py % h)
+		return cy - cx + self.dx[iy, ix], cy + cx + self.dy[iy, ix]
+	
+	
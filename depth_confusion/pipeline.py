@@ -0,0 +1,157 @@
+"""
+Renders the scene of a viewport on a thread of its own so a heavy frame does
+not hold up the main loop. The worker draws the next frame into a back buffer
+while the main thread handles events and presents the last finished frame.
+The worker only looks at the world while it holds the lock of the pipeline,
+just long enough to get the surfaces of the frame out of it, the blits are
+done without the lock and pygame lets go of the GIL while it blits. So the
+main loop has to hold the lock whenever it changes the world or the viewport:
+
+	pipeline = RenderPipeline(viewport)
+	while running:
+		with pipeline.lock:
+			handle_events()
+			world.on_update()
+		
+		pygame.display.update(pipeline.present())
+	
+	pipeline.stop()
+
+With profiling on, what the worker reports is added to the frames of the
+thread that enabled the PROFILER, see the profiling module.
+
+Author: Huba Nagy
+"""
+import sys
+import threading
+import Queue
+from common_util import *
+from viewport import Viewport
+
+
+
+class RenderPipeline(object):
+	"""
+	Double buffers the scene of a viewport. The viewport itself is not rendered
+	any more, present blits the last finished buffer where it would be.
+	"""
+	def __init__(self, viewport):
+		self.viewport = viewport
+		#held by the worker while it takes a frame out of the world
+		self.lock = threading.RLock()
+		
+		#the buffers are viewports that are not attached to the world, each frame
+		#is drawn with the view the viewport had when the frame was asked for
+		self._buffers = [Viewport(viewport.screen, viewport.screen_placement, viewport.scene_rect.size, viewport.bg_color)
+		                 for i in (0, 1)]
+		self._front = None
+		self._pending = False
+		
+		self._requests = Queue.Queue()
+		self._finished = Queue.Queue()
+		self._thread = None
+		
+		self.frames = 0
+	
+	
+	def present(self, wait = False):
+		"""
+		Blits the last finished frame onto the screen and asks for the next one
+		if the worker is free. With wait it waits for the frame that is being
+		drawn first. Returns the list of screen rects that changed, ready to be
+		passed to pygame.display.update.
+		"""
+		self._collect(wait)
+		if not self._pending:
+			self._request()
+		
+		if self._front is None:
+			return []
+		
+		buffer = self._buffers[self._front]
+		self.viewport.screen.blit(buffer.scene, self.viewport.screen_placement)
+		return [buffer.scene_rect.move(self.viewport.screen_placement)]
+	
+	
+	def stop(self):
+		"""
+		Lets the worker finish its frame and ends its thread, the next present
+		starts it again.
+		"""
+		if self._thread:
+			self._requests.put(None)
+			self._thread.join()
+			self._thread = None
+			self._collect(False)
+	
+	
+	def _collect(self, wait):
+		#takes the frame the worker finished, if it has
+		if not self._pending:
+			return
+		
+		try:
+			(index, error) = self._finished.get(wait)
+		
+		except Queue.Empty:
+			return
+		
+		self._pending = False
+		if error:
+			raise error[0], error[1], error[2]
+		
+		self._front = index
+		self.frames += 1
+	
+	
+	def _request(self):
+		#the back buffer is the one that is not on the screen
+		index = 1 if self._front == 0 else 0
+		buffer = self._buffers[index]
+		buffer.scene_placement = self.viewport.scene_placement
+		buffer.scene_scale = self.viewport.scene_scale
+		buffer.bg_color = self.viewport.bg_color
+		
+		if not self._thread:
+			self._thread = threading.Thread(target = self._work)
+			self._thread.daemon = True
+			self._thread.start()
+		
+		self._pending = True
+		self._requests.put(index)
+	
+	
+	def _work(self):
+		while True:
+			index = self._requests.get()
+			if index is None:
+				return
+			
+			try:
+				self._render(self._buffers[index])
+				self._finished.put((index, None))
+			
+			except Exception:
+				self._finished.put((index, sys.exc_info()))
+	
+	
+	def _render(self, buffer):
+		world = self.viewport._world
+		buffer.scene.fill(buffer.bg_color)
+		if not world:
+			return
+		
+		with self.lock:
+			blits = world.scene_blits(buffer)
+			if blits is None:
+				#a world that draws more than the surfaces it keeps is drawn right here
+				world.on_render(buffer)
+				return
+		
+		for surface, position in blits:
+			buffer.scene.blit(surface, position)
+	
+	
+
+
+
@@ -0,0 +1,200 @@
+"""
+Pre-renders the chunks of a voxel world on a pool of processes, for building
+or saving big maps and for thumbnails of whole worlds. Every worker loads the
+image pack on its own, gets the type arrays of a chunk, draws its blocks the
+way Block.on_render does and sends back the raw pixels of the chunk surface.
+Chunks with anything but plain blocks in them are rendered in this process.
+Author: Huba Nagy
+"""
+import multiprocessing
+import pygame
+import numpy as np
+from common_util import *
+from voxel_storage import RENDERED, HIGHLIGHTED
+from resource_loader import ImageHandler, SpriteCache
+from chunks import ChunkTarget
+import visibility
+import voxels
+
+
+
+#the sprite cache and the palette tables of a worker process
+_worker = {}
+
+
+def _init_worker(root, paths, tables, culling):
+	image_handler = ImageHandler(root)
+	for image_id, image_path in paths.iteritems():
+		image_handler.add_image(image_path, image_id)
+	
+	_worker['sprite_cache'] = SpriteCache(image_handler)
+	_worker['tables'] = tables
+	_worker['culling'] = culling
+
+
+def _draw_job(surface, job, start):
+	"""
+	Draws the voxels of a job from the row and column start on (the chunk starts
+	at 2) onto a surface back to front, the row and column before start are only
+	looked at for the top layer outlines.
+	"""
+	(chunk, size, scale, origin, steps, top_layer, type_ids, flags, outlines) = job
+	(image_ids, image_sizes, is_block, is_opaque) = _worker['tables']
+	sprite_cache = _worker['sprite_cache']
+	
+	rendered = (flags & RENDERED).astype(bool)
+	box = (slice(None), slice(start, None), slice(start, None))
+	drawn = (type_ids[box] != 0) & rendered[box]
+	occluders = drawn & is_opaque[type_ids[box]] if _worker['culling'] else np.zeros(drawn.shape, dtype = bool)
+	(oz, oy, ox) = visibility.unoccluded(drawn, occluders, np.zeros(drawn.shape, dtype = bool))
+	
+	((sx, sy), (dx_x, dx_y), (dy_x, dy_y), (dz_x, dz_y)) = (origin, steps[X], steps[Y], steps[Z])
+	for z, y, x in zip(oz, oy + start, ox + start):
+		type_id = type_ids[z, y, x]
+		outline = outlines[z, y, x]
+		if z == top_layer:
+			if not outline & 1 and not rendered[z, y - 1, x]:
+				outline |= 1
+			
+			if not outline & 2 and not rendered[z, y, x - 1]:
+				outline |= 2
+		
+		sprite = sprite_cache.get_sprite(image_ids[type_id], int(outline), bool(flags[z, y, x] & HIGHLIGHTED),
+		                                 image_sizes[type_id], scale)
+		surface.blit(sprite, (int((sx + (x - 2) * dx_x + (y - 2) * dy_x + z * dz_x) * scale),
+		                      int((sy + (x - 2) * dx_y + (y - 2) * dy_y + z * dz_y) * scale)))
+
+
+def _render_job(job):
+	"""
+	Renders a chunk from its type, flag and outline arrays, which have two extra
+	rows of the voxels behind and to the right of it, one for its rim and one
+	for the top layer outlines. Returns the chunk and the RGBA pixels of its surface.
+	"""
+	(chunk, size, scale, origin, steps, top_layer, type_ids, flags, outlines) = job
+	surface = pygame.Surface(size, flags = pygame.SRCALPHA)
+	_draw_job(surface, job, 2)
+	
+	#drawn again with the rim and cut to the voxels of the chunk like ChunkGrid._render_chunk does
+	drawn = (type_ids != 0) & (flags & RENDERED).astype(bool)
+	if (drawn[1:, 2:, 1] & drawn[:-1, 2:, 2]).any() or (drawn[1:, 1, 2:] & drawn[:-1, 2, 2:]).any():
+		whole = pygame.Surface(size, flags = pygame.SRCALPHA)
+		_draw_job(whole, job, 1)
+		surface.fill((255, 255, 255, 0), special_flags = pygame.BLEND_RGBA_MAX)
+		whole.blit(surface, (0, 0), special_flags = pygame.BLEND_RGBA_MIN)
+		surface = whole
+	
+	return chunk, pygame.image.tostring(surface, 'RGBA')
+
+
+def _palette_tables(world):
+	"""
+	Returns the image id, the image size and whether it is a block that a
+	worker can draw and whether it is opaque for every palette id of the world.
+	"""
+	image_ids = []
+	image_sizes = []
+	is_block = []
+	is_opaque = []
+	for element_id in world._grid.get_palette():
+		element_class = world.element_class_handler.get_element_class(element_id)
+		voxel = world.element_class_handler.construct_element(element_id)
+		image_ids.append(voxel._voxel_id)
+		image_sizes.append(voxel._image_size)
+		
+		#a subclass that renders itself in some other way has to be rendered here
+		plain = issubclass(element_class, voxels.Block) and element_class.on_render.__func__ is voxels.Block.on_render.__func__
+		is_block.append(plain)
+		is_opaque.append(plain and element_class.opaque)
+	
+	return image_ids, image_sizes, np.array(is_block, dtype = bool), np.array(is_opaque, dtype = bool)
+
+
+def prerender_chunks(world, scale = 1, chunks = None, workers = None):
+	"""
+	Renders the given chunks (all of them by default) of a world at a scale on
+	workers processes (as many as there are cores by default) and keeps them in
+	the chunk cache of the world like rendering them would. Returns a dict of
+	the surfaces of the chunks that are not empty.
+	"""
+	grid = world._chunks
+	chunks = list(grid.all_chunks() if chunks is None else chunks)
+	workers = workers or multiprocessing.cpu_count()
+	tables = _palette_tables(world)
+	is_block = tables[2]
+	
+	#how far the sprite of a voxel moves on the screen along every axis
+	origin = world.map_to_global(0, 0, 0)
+	steps = [tuple(np.subtract(world.map_to_global(*step), origin)) for step in ((1, 0, 0), (0, 1, 0), (0, 0, 1))]
+	
+	#the voxels that are kept as objects might not draw like their type
+	storage = world._grid
+	kept = set()
+	for index in storage._elements:
+		kept.update(grid.chunks_showing(world._index_to_coordinate(index)))
+	
+	surfaces = {}
+	jobs = []
+	versions = {}
+	for chunk in chunks:
+		(low, high, version) = grid.render_state(chunk)
+		if low[Z] >= high[Z]:
+			continue
+		
+		outer = (low[X] - 2, low[Y] - 2, low[Z])
+		type_ids = storage.read_box('type_ids', outer, high)
+		if workers < 2 or chunk in kept or not is_block[type_ids[:, 1:, 1:]][type_ids[:, 1:, 1:] != 0].all():
+			surface = grid.get_surface(chunk, scale)
+			if surface:
+				surfaces[chunk] = surface
+			
+			continue
+		
+		if not type_ids[:, 2:, 2:].any():
+			grid.put_surface(chunk, scale, version, None)
+			continue
+		
+		rect = grid.chunk_rect(chunk)
+		size = (int(rect.w * scale) + 1, int(rect.h * scale) + 1)
+		start = world.map_to_global(*low)
+		jobs.append((chunk, size, scale, (start[X] - rect.x, start[Y] - rect.y), steps,
+		             world._active_layer - low[Z], type_ids,
+		             storage.read_box('flags', outer, high), storage.read_box('outlines', outer, high)))
+		versions[chunk] = (version, size)
+	
+	if jobs:
+		pool = multiprocessing.Pool(workers, _init_worker,
+		                            (world.resource_handler._root, world.resource_handler._paths, tables,
+		                             world.occlusion_culling))
+		try:
+			for chunk, pixels in pool.imap_unordered(_render_job, jobs):
+				(version, size) = versions[chunk]
+				surface = pygame.image.fromstring(pixels, size, 'RGBA')
+				grid.put_surface(chunk, scale, version, surface)
+				surfaces[chunk] = surface
+		
+		finally:
+			pool.close()
+			pool.join()
+	
+	return surfaces
+
+
+def render_thumbnail(world, scale = 0.25, workers = None):
+	"""
+	Renders the whole world up to the visible top onto one surface at the given
+	scale, the chunks are pre-rendered on worker processes.
+	"""
+	(w, h, d) = (world.get_dimension(WIDTH), world.get_dimension(HEIGHT), world.get_dimension(DEPTH))
+	rect = world.box_rect((0, 0, 0), (w - 1, h - 1, d - 1))
+	target = ChunkTarget(pygame.Surface((int(rect.w * scale) + 1, int(rect.h * scale) + 1), flags = pygame.SRCALPHA),
+	                     (-rect.x, -rect.y), scale)
+	
+	surfaces = prerender_chunks(world, scale, workers = workers)
+	for chunk in world._chunks.all_chunks():
+		if chunk in surfaces:
+			(gx, gy) = world._chunks.chunk_rect(chunk).topleft
+			target.scene.blit(surfaces[chunk], (int((gx + target.scene_placement[X]) * scale),
+			                                    int((gy + target.scene_placement[Y]) * scale)))
+	
+	return target.scene
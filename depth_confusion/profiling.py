@@ -0,0 +1,230 @@
+"""
+Opt-in per frame instrumentation. The engine reports how long the phases of a
+frame take and counts the work it does (voxels visited and drawn, blits,
+surfaces allocated, scalings, cache hits) to the PROFILER of this module.
+Nothing is recorded until it is enabled, and the hot paths only check the
+enabled flag before reporting so it costs next to nothing when it is off.
+
+	from depth_confusion.profiling import PROFILER
+	PROFILER.enable()
+	...
+	PROFILER.begin_frame()
+	viewport.on_render()
+	PROFILER.end_frame()
+	PROFILER.draw_overlay(screen)
+
+The profiler belongs to the thread that enables it, only that one may begin
+and end frames. What other threads (like the worker of a RenderPipeline)
+report is held aside and added to the frame the owner ends next.
+
+Author: Huba Nagy
+"""
+import json
+import time
+import threading
+from collections import deque
+import pygame
+
+
+
+class _Phase(object):
+	"""
+	Times a with block and adds the time to a phase of the current frame.
+	"""
+	def __init__(self, profiler, name):
+		self._profiler = profiler
+		self._name = name
+		self._start = 0
+	
+	
+	def __enter__(self):
+		self._start = time.time()
+		return self
+	
+	
+	def __exit__(self, exc_type, exc_value, traceback):
+		self._profiler.add_time(self._name, time.time() - self._start)
+		return False
+	
+	
+
+
+
+class _NoPhase(object):
+	"""
+	What phase() returns when the profiler is disabled, does nothing at all.
+	"""
+	def __enter__(self):
+		return self
+	
+	
+	def __exit__(self, exc_type, exc_value, traceback):
+		return False
+	
+	
+
+
+
+class FrameProfiler(object):
+	"""
+	Collects the phase timings (in seconds) and the counters of every frame and
+	keeps the last history frames for rolling statistics.
+	"""
+	def __init__(self, history = 120):
+		self.enabled = False
+		self._no_phase = _NoPhase()
+		self._history = deque(maxlen = history)
+		self._frame = None
+		self._font = None
+		
+		#what the threads other than the owner reported since the last end_frame
+		self._owner = None
+		self._lock = threading.Lock()
+		self._others = {'phases': {}, 'counters': {}}
+	
+	
+	def enable(self):
+		self._owner = threading.current_thread()
+		self.enabled = True
+	
+	
+	def disable(self):
+		self.enabled = False
+		self._frame = None
+	
+	
+	def begin_frame(self):
+		if self.enabled:
+			self._frame = {'start': time.time(), 'phases': {}, 'counters': {}}
+	
+	
+	def end_frame(self):
+		"""
+		Closes the current frame and puts it into the history.
+		"""
+		if self.enabled and self._frame:
+			self._frame['phases']['frame'] = time.time() - self._frame.pop('start')
+			with self._lock:
+				for group, values in self._others.iteritems():
+					for name, value in values.iteritems():
+						self._frame[group][name] = self._frame[group].get(name, 0) + value
+					
+					values.clear()
+			
+			self._history.append(self._frame)
+			self._frame = None
+	
+	
+	def _current_frame(self):
+		#things reported outside of begin_frame and end_frame start a frame on their own
+		if self._frame is None:
+			self.begin_frame()
+		
+		return self._frame
+	
+	
+	def phase(self, name):
+		"""
+		Returns a context manager that adds the time spent in it to the named phase.
+		"""
+		if self.enabled:
+			return _Phase(self, name)
+		
+		return self._no_phase
+	
+	
+	def _report(self, group, name, amount):
+		if threading.current_thread() is not self._owner:
+			with self._lock:
+				values = self._others[group]
+				values[name] = values.get(name, 0) + amount
+		
+		else:
+			values = self._current_frame()[group]
+			values[name] = values.get(name, 0) + amount
+	
+	
+	def add_time(self, name, seconds):
+		if self.enabled:
+			self._report('phases', name, seconds)
+	
+	
+	def count(self, name, amount = 1):
+		if self.enabled:
+			self._report('counters', name, amount)
+	
+	
+	def get_frames(self):
+		return list(self._history)
+	
+	
+	def stats(self):
+		"""
+		Returns the rolling statistics of every phase and counter over the frames
+		in the history: {name: {'last', 'mean', 'min', 'max'}}.
+		"""
+		names = set()
+		for frame in self._history:
+			for group in ('phases', 'counters'):
+				names.update(frame[group])
+		
+		stats = {}
+		for name in names:
+			#a frame that did not report something did none of it
+			samples = [frame['phases'].get(name, frame['counters'].get(name, 0)) for frame in self._history]
+			stats[name] = {'last': samples[-1],
+			               'mean': float(sum(samples)) / len(samples),
+			               'min': min(samples),
+			               'max': max(samples)}
+		
+		return stats
+	
+	
+	def export(self, filepath):
+		"""
+		Writes the frames in the history and their statistics to a json file.
+		"""
+		with open(filepath, 'w') as f_object:
+			json.dump({'frames': self.get_frames(), 'stats': self.stats()}, f_object, indent = 1, sort_keys = True)
+	
+	
+	def reset(self):
+		self._history.clear()
+		self._frame = None
+		with self._lock:
+			for values in self._others.itervalues():
+				values.clear()
+	
+	
+	def draw_overlay(self, surface, position = (4, 4), color = (255, 255, 0)):
+		"""
+		Draws the mean of every phase (in milliseconds) and counter onto the surface.
+		"""
+		if not self.enabled:
+			return
+		
+		if not self._font:
+			if not pygame.font.get_init():
+				pygame.font.init()
+			
+			self._font = pygame.font.Font(None, 18)
+		
+		stats = self.stats()
+		(x, y) = position
+		for name in sorted(stats):
+			mean = stats[name]['mean']
+			if any(name in frame['phases'] for frame in self._history):
+				text = '{0}: {1:.2f} ms'.format(name, mean * 1000)
+			
+			else:
+				text = '{0}: {1:.1f}'.format(name, mean)
+			
+			label = self._font.render(text, True, color)
+			surface.blit(label, (x, y))
+			y += label.get_height()
+	
+	
+
+
+#the profiler the engine reports to
+PROFILER = FrameProfiler()
@@ -0,0 +1,179 @@
+"""
+Shares what a world looks like between all the viewports attached to it. The
+world is cut into big square regions of global coordinates, each is composed
+from the chunks once per scale and background colour, after that any viewport
+that shows it just blits the region. The world reports every change as damage
+and the regions it touches are composed again the next time they are shown.
+Author: Huba Nagy
+"""
+import math
+import weakref
+import pygame
+from collections import OrderedDict
+from common_util import *
+from profiling import PROFILER
+from chunks import ChunkTarget
+
+
+
+class RegionCache(object):
+	"""
+	Keeps the composed regions of a world indexed by (rx, ry, scale, bg_color),
+	the least recently used ones are dropped above capacity pixels, and the ones
+	of a scale and colour that no viewport shows any more right away. render is called
+	with a ChunkTarget and a rect of global coordinates to draw that part of
+	the world onto it.
+	"""
+	def __init__(self, world, render, region_size = 512, capacity = 16 * 1024 * 1024):
+		self._world = world
+		self._render = render
+		#a power of two so the regions start on whole pixels at the zoom levels
+		self.region_size = region_size
+		self.capacity = capacity
+		
+		self._regions = OrderedDict()
+		self._pixels = 0
+		self._damage = world.track_damage()
+		
+		#viewport: the (scale, bg_color) it was last shown at
+		self._views = weakref.WeakKeyDictionary()
+		
+		self.renders = 0
+	
+	
+	def close(self):
+		"""
+		Stops following the changes of the world and lets go of the regions.
+		"""
+		self._world.untrack_damage(self._damage)
+		self.clear()
+	
+	
+	def clear(self):
+		self._regions.clear()
+		self._pixels = 0
+	
+	
+	def pixel_count(self):
+		return self._pixels
+	
+	
+	def _drop(self, key):
+		(w, h) = self._regions.pop(key).get_size()
+		self._pixels -= w * h
+	
+	
+	def region_rect(self, region):
+		"""
+		Returns the rect of a region in global coordinates.
+		"""
+		return pygame.Rect(region[X] * self.region_size, region[Y] * self.region_size, self.region_size, self.region_size)
+	
+	
+	def _drop_damaged(self):
+		if not self._damage:
+			return
+		
+		if self._damage[0] is None:
+			self.clear()
+		
+		else:
+			for key in self._regions.keys():
+				if self.region_rect(key).collidelist(self._damage) != -1:
+					self._drop(key)
+		
+		del self._damage[:]
+	
+	
+	def get_region(self, region, scale, bg_color):
+		"""
+		Returns the surface of a region at the given scale on the given background
+		colour, composing it if it is not kept or something in it has changed.
+		"""
+		self._drop_damaged()
+		
+		key = (region[X], region[Y], scale, tuple(bg_color))
+		try:
+			surface = self._regions.pop(key)
+		
+		except KeyError:
+			surface = self._compose(region, scale, bg_color)
+			(w, h) = surface.get_size()
+			self._pixels += w * h
+			while self._regions and self._pixels > self.capacity:
+				self._drop(next(iter(self._regions)))
+		
+		self._regions[key] = surface
+		return surface
+	
+	
+	def _show(self, viewport):
+		#the regions of a look that the viewport was the last one to show are not needed any more
+		view = (viewport.scene_scale, tuple(viewport.bg_color))
+		old_view = self._views.get(viewport)
+		self._views[viewport] = view
+		if old_view is None or old_view == view or old_view in self._views.values():
+			return
+		
+		for key in self._regions.keys():
+			if key[2:] == old_view:
+				self._drop(key)
+	
+	
+	def _compose(self, region, scale, bg_color):
+		self.renders += 1
+		with PROFILER.phase('region_render'):
+			rect = self.region_rect(region)
+			#one pixel more than the region so neighbours overlap at any scale
+			size = int(rect.w * scale) + 1
+			surface = pygame.Surface((size, size))
+			surface.fill(bg_color)
+			self._render(ChunkTarget(surface, (-rect.x, -rect.y), scale), rect)
+		
+		if PROFILER.enabled:
+			PROFILER.count('regions_rendered')
+		
+		return surface
+	
+	
+	def scene_blits(self, viewport, rect = None):
+		"""
+		Returns the (surface, scene position) pairs of the regions that are in the
+		view of the viewport, composing the ones that changed. If a rect of global
+		coordinates is given only the regions in it are returned.
+		"""
+		self._show(viewport)
+		view = viewport.get_global_rect()
+		if rect:
+			view = view.clip(rect)
+		
+		if not view.w or not view.h:
+			return []
+		
+		size = self.region_size
+		(scale, placement) = (viewport.scene_scale, viewport.scene_placement)
+		blits = []
+		for ry in xrange(view.top // size, (view.bottom - 1) // size + 1):
+			for rx in xrange(view.left // size, (view.right - 1) // size + 1):
+				#rounded down like the chunks in the regions are so there are no seams
+				blits.append((self.get_region((rx, ry), scale, viewport.bg_color),
+				              (int(math.floor((placement[X] + rx * size) * scale)),
+				               int(math.floor((placement[Y] + ry * size) * scale)))))
+		
+		return blits
+	
+	
+	def on_render(self, viewport, rect = None):
+		"""
+		Blits the regions that are in the view onto the scene of the viewport. If a
+		rect of global coordinates is given only the regions in it are blitted.
+		"""
+		for surface, position in self.scene_blits(viewport, rect):
+			viewport.scene.blit(surface, position)
+			if PROFILER.enabled:
+				PROFILER.count('region_blits')
+				PROFILER.count('blits')
+	
+	
+
+
@@ -2,30 +2,349 @@
 A utility module for managing sprites and other resources
 Author: Huba Nagy
 """
+import os
 import pygame
 import json
+from functools import partial
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
+from profiling import PROFILER
 
 
 
 class ImageHandler:
+	"""
+	Keeps the images of an image pack by id. Images can be loaded right away
+	with load_image or just added with add_image, then they are decoded the
+	first time get_image asks for them or in the background by prefetch.
+	"""
 	def __init__(self, root):
 		self._images = {}
+		self._paths = {}
 		self._root = root
+		self._prefetching = None
 	
 	def load_image(self, image_path, image_id):
 		print('loaded image: {0} as {1}.'.format(image_path, image_id))
+		self._paths[image_id] = image_path
 		self._images[image_id] = pygame.image.load(self._root + '/' + image_path)
 	
 	
+	def add_image(self, image_path, image_id):
+		"""
+		Adds an image without decoding it yet.
+		"""
+		self._paths[image_id] = image_path
+	
+	
+	def _decode(self, image_id):
+		image = pygame.image.load(self._root + '/' + self._paths[image_id])
+		#the main thread and the prefetch might both get to it, the first one is kept
+		return self._images.setdefault(image_id, image)
+	
+	
 	def get_image(self, image_id):
 		try:
 			return self._images[image_id]
+		
+		except KeyError:
+			if image_id in self._paths:
+				return self._decode(image_id)
+			
+			return None
+	
+	
+	def prefetch(self, workers = 4):
+		"""
+		Decodes the images that are not loaded yet on a pool of background
+		threads, get_image can be used in the meantime.
+		"""
+		pending = [image_id for image_id in self._paths if image_id not in self._images]
+		if not pending:
+			return
+		
+		pool = ThreadPool(workers)
+		self._prefetching = pool.map_async(self._decode, pending)
+		pool.close()
+	
+	
+	def wait(self):
+		"""
+		Blocks until the background prefetch is done.
+		"""
+		if self._prefetching:
+			self._prefetching.wait()
+			self._prefetching = None
 	
 	
+	def loaded_count(self):
+		return len(self._images)
+	
+	
+	def get_image_ids(self):
+		return sorted(self._paths)
+	
+	
+	def _source_stamps(self):
+		#what the atlas cache is checked against, the modification time of every image
+		return dict((image_id, os.path.getmtime(self._root + '/' + image_path))
+		            for image_id, image_path in self._paths.iteritems())
+	
+	
+	def save_atlas(self, pack_filepath, max_size = 2048):
+		"""
+		Packs all the images into atlas pages and saves them as a cache next to
+		the pack file, see atlas_paths.
+		"""
+		(pages, rects) = build_atlas(self, max_size)
+		(table_path, page_path) = atlas_paths(pack_filepath)
+		for i, page in enumerate(pages):
+			pygame.image.save(page, page_path.format(i))
+		
+		with open(table_path, 'w') as f_object:
+			json.dump({'pages': len(pages), 'rects': rects, 'sources': self._source_stamps()},
+			          f_object, indent = 1, sort_keys = True)
+	
+	
+	def load_atlas(self, pack_filepath):
+		"""
+		Replaces the images with subsurfaces of the cached atlas pages of the pack.
+		Returns False without changing anything if the cache is missing or older
+		than any of the images.
+		"""
+		(table_path, page_path) = atlas_paths(pack_filepath)
+		try:
+			with open(table_path) as f_object:
+				table = json.load(f_object)
+			
+			if table['sources'] != self._source_stamps():
+				return False
+			
+			pages = [pygame.image.load(page_path.format(i)) for i in xrange(table['pages'])]
+		
+		except (IOError, OSError, ValueError, KeyError, pygame.error):
+			return False
+		
+		for image_id, (page, x, y, w, h) in table['rects'].iteritems():
+			self._images[str(image_id)] = pages[page].subsurface((x, y, w, h))
+		
+		return True
+	
+	
+
+
+
+class SpritePyramid:
+	"""
+	Keeps the images of an image handler scaled to the zoom levels they are
+	used at, every image is only scaled the first time it is asked for at a
+	level. The least recently used levels are dropped above max_levels.
+	"""
+	def __init__(self, image_handler, max_levels = 4):
+		self._image_handler = image_handler
+		self._levels = OrderedDict()
+		self.max_levels = max_levels
+		self.scalings = 0
+	
+	
+	def get_image(self, image_id, scale):
+		if scale == 1:
+			return self._image_handler.get_image(image_id)
+		
+		try:
+			level = self._levels.pop(scale)
+		
 		except KeyError:
-			return None
+			level = {}
+			if len(self._levels) >= self.max_levels:
+				self._levels.popitem(last = False)
+		
+		self._levels[scale] = level
+		try:
+			return level[image_id]
+		
+		except KeyError:
+			image = self._image_handler.get_image(image_id)
+			level[image_id] = pygame.transform.scale(image, (int(image.get_width() * scale), int(image.get_height() * scale)))
+			self.scalings += 1
+			if PROFILER.enabled:
+				PROFILER.count('scale_operations')
+				PROFILER.count('surfaces_allocated')
+			
+			return level[image_id]
+	
+	
+	def build_level(self, scale, image_ids = None):
+		"""
+		Scales all the images (or the given ones) to a level ahead of time.
+		"""
+		for image_id in image_ids or self._image_handler.get_image_ids():
+			self.get_image(image_id, scale)
+	
+	
+	def levels(self):
+		return list(self._levels)
+	
 	
+	def clear(self):
+		self._levels.clear()
 	
+	
+
+
+
+class SpriteCache:
+	"""
+	Keeps the finished, composited and scaled sprites of voxels so they don't
+	have to be put together from the base image and the overlays every frame.
+	The least recently used sprites are thrown away once the cache is full.
+	"""
+	def __init__(self, image_handler, capacity = 512):
+		self._image_handler = image_handler
+		self.pyramid = SpritePyramid(image_handler)
+		self._sprites = OrderedDict()
+		self.capacity = capacity
+		
+		self.hits = 0
+		self.misses = 0
+		self.evictions = 0
+	
+	
+	def get_sprite(self, image_id, outline, highlighted, size, scale):
+		"""
+		Returns the sprite of the image with the dark outlines in the 6 bit outline
+		mask and the highlight drawn over it, scaled by scale.
+		"""
+		key = (image_id, outline, highlighted, size, scale)
+		try:
+			sprite = self._sprites.pop(key)
+			self.hits += 1
+			if PROFILER.enabled:
+				PROFILER.count('sprite_cache_hits')
+		
+		except KeyError:
+			with PROFILER.phase('sprite_compose'):
+				sprite = self._compose(image_id, outline, highlighted, size, scale)
+			
+			self.misses += 1
+			if PROFILER.enabled:
+				PROFILER.count('sprite_cache_misses')
+			
+			if len(self._sprites) >= self.capacity:
+				self._sprites.popitem(last = False)
+				self.evictions += 1
+		
+		#(re)inserting puts the sprite at the most recently used end
+		self._sprites[key] = sprite
+		return sprite
+	
+	
+	def _compose(self, image_id, outline, highlighted, size, scale):
+		#the layers come already scaled from the pyramid, scaling with nearest
+		#neighbour and then blending gives the same pixels the other way around
+		sprite = pygame.Surface((int(size[0] * scale), int(size[1] * scale)), flags = pygame.SRCALPHA)
+		
+		#blit the base image
+		sprite.blit(self.pyramid.get_image(image_id, scale), (0, 0))
+		
+		#blit the dark outlines
+		for i in xrange(6):
+			if outline & (1 << i):
+				sprite.blit(self.pyramid.get_image('overlay-dark-outline-{0}'.format(i), scale), (0, 0))
+		
+		#blit the highlight
+		if highlighted:
+			sprite.blit(self.pyramid.get_image('overlay-yellow-highlight', scale), (0, 0))
+		
+		if PROFILER.enabled:
+			PROFILER.count('surfaces_allocated')
+			PROFILER.count('blits', 1 + bin(outline).count('1') + (1 if highlighted else 0))
+		
+		return sprite
+	
+	
+	def clear(self):
+		self._sprites.clear()
+		self.pyramid.clear()
+	
+	
+	def stats(self):
+		"""
+		Returns the counters of the cache, useful for sizing it.
+		"""
+		lookups = self.hits + self.misses
+		return {'hits': self.hits,
+		        'misses': self.misses,
+		        'evictions': self.evictions,
+		        'size': len(self._sprites),
+		        'capacity': self.capacity,
+		        'hit_rate': float(self.hits) / lookups if lookups else 0.0}
+	
+	
+	def reset_stats(self):
+		self.hits = self.misses = self.evictions = 0
+	
+	
+
+
+
+def pack_rects(sizes, max_size = 2048):
+	"""
+	Places rects of the given (width, height) sizes onto as few pages of at most
+	max_size by max_size pixels as it can, shelf by shelf from the tallest down.
+	Returns the (page, x, y) of every rect and the (width, height) of every page.
+	"""
+	places = [None] * len(sizes)
+	pages = [(0, 0)]
+	(x, y, shelf_height) = (0, 0, 0)
+	for i in sorted(xrange(len(sizes)), key = lambda i: (-sizes[i][1], -sizes[i][0])):
+		(w, h) = sizes[i]
+		if w > max_size or h > max_size:
+			raise ValueError('A {0}x{1} image does not fit on a {2}x{2} atlas page'.format(w, h, max_size))
+		
+		#start a new shelf, or a new page if there is no room for one
+		if x + w > max_size:
+			(x, y, shelf_height) = (0, y + shelf_height, 0)
+		
+		if y + h > max_size:
+			pages.append((0, 0))
+			(x, y, shelf_height) = (0, 0, 0)
+		
+		places[i] = (len(pages) - 1, x, y)
+		pages[-1] = (max(pages[-1][0], x + w), max(pages[-1][1], y + h))
+		x += w
+		shelf_height = max(shelf_height, h)
+	
+	return places, pages
+
+
+def build_atlas(image_handler, max_size = 2048):
+	"""
+	Copies every image of the image handler onto atlas pages. Returns the pages
+	and a dict of {image_id: (page, x, y, width, height)}.
+	"""
+	image_ids = image_handler.get_image_ids()
+	images = [image_handler.get_image(image_id) for image_id in image_ids]
+	(places, page_sizes) = pack_rects([image.get_size() for image in images], max_size)
+	
+	pages = [pygame.Surface(size, flags = pygame.SRCALPHA, depth = 32) for size in page_sizes]
+	rects = {}
+	for image_id, image, (page, x, y) in zip(image_ids, images, places):
+		#the pages start out all zero so this copies the pixels and the alpha exactly
+		pages[page].blit(image, (x, y), special_flags = pygame.BLEND_RGBA_MAX)
+		rects[image_id] = (page, x, y, image.get_width(), image.get_height())
+	
+	return pages, rects
+
+
+def atlas_paths(pack_filepath):
+	"""
+	Returns the path of the rect table of the atlas cache of a pack and the path
+	of its pages with a {0} for the page number, pack.json gets pack.atlas.json
+	and pack.atlas-0.png, pack.atlas-1.png...
+	"""
+	base = os.path.splitext(pack_filepath)[0] + '.atlas'
+	return base + '.json', base + '-{0}.png'
 
 
 
@@ -40,11 +359,18 @@ class EntityHandler:
 
 
 
-def as_image_pack(dct):
+def as_image_pack(dct, lazy = False, prefetch_workers = 0):
 	if '__image_paths__' in dct:
 		image_handler = ImageHandler(dct['__root__'])
 		for image_id in dct['__image_paths__']:
-			image_handler.load_image(dct['__image_paths__'][str(image_id)], str(image_id))
+			if lazy:
+				image_handler.add_image(dct['__image_paths__'][str(image_id)], str(image_id))
+			
+			else:
+				image_handler.load_image(dct['__image_paths__'][str(image_id)], str(image_id))
+		
+		if lazy and prefetch_workers:
+			image_handler.prefetch(prefetch_workers)
 		
 		return image_handler
 	
@@ -52,7 +378,27 @@ def as_image_pack(dct):
 		return dct
 
 
-def load_image_pack(filepath):
+def load_image_pack(filepath, lazy = False, prefetch_workers = 0, atlas = False):
+	"""
+	Loads the image pack described by a json file. With lazy the images are only
+	decoded when they are first used so it takes the same time whatever the size
+	of the pack is, prefetch_workers threads decode them in the background.
+	With atlas the images come from the atlas cache next to the pack, which is
+	built first if it is missing or out of date.
+	"""
 	f_object = open(filepath)
-	return json.load(f_object, object_hook = as_image_pack)
+	if not atlas:
+		return json.load(f_object, object_hook = partial(as_image_pack, lazy = lazy, prefetch_workers = prefetch_workers))
+	
+	image_handler = json.load(f_object, object_hook = partial(as_image_pack, lazy = True))
+	if not image_handler.load_atlas(filepath):
+		try:
+			image_handler.save_atlas(filepath)
+			image_handler.load_atlas(filepath)
+		
+		#without a cache the separate images are used, they are decoded by now anyway
+		except (IOError, OSError, pygame.error) as error:
+			print('could not save the atlas of {0}: {1}'.format(filepath, error))
+	
+	return image_handler
 
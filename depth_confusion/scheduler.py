@@ -0,0 +1,104 @@
+"""
+Decides which voxels get their on_update called on an update of the world.
+Instead of sweeping the whole world every update only the voxels that asked
+for it are updated, every tick has a bucket of the voxels that are due in it
+so an update only costs as much as the number of voxels it actually updates.
+Author: Huba Nagy
+"""
+
+
+
+class UpdateScheduler(object):
+	"""
+	Keeps keys (the indexes of voxels) in buckets by the tick they are due in.
+	A key is in the scheduler at most once, scheduling it again replaces the
+	old schedule, the old entry is left in its bucket and skipped when it is due.
+	With places (a CellBuckets of the spatial_index module) the keys are kept
+	in it too, so keys_in_box can find the ones in a part of the world.
+	"""
+	def __init__(self, places = None):
+		self.tick_count = 0
+		
+		#tick: [(key, generation)]
+		self._buckets = {}
+		#key: (interval, generation) of the schedule that is in effect
+		self._entries = {}
+		self._generation = 0
+		self._places = places
+	
+	
+	def __len__(self):
+		return len(self._entries)
+	
+	
+	def __contains__(self, key):
+		return key in self._entries
+	
+	
+	def keys(self):
+		return self._entries.keys()
+	
+	
+	def keys_in_box(self, low, high):
+		"""
+		Returns the keys whose cell is between the low and high coordinates (both
+		inclusive), only for a scheduler with places.
+		"""
+		return self._places.in_box(low, high)
+	
+	
+	def schedule(self, key, interval = 1, delay = 0):
+		"""
+		Schedules the key to be due every interval ticks, or just once if interval
+		is None, starting delay ticks after the next one.
+		"""
+		self._generation += 1
+		if self._places is not None and key not in self._entries:
+			self._places.add(key)
+		
+		self._entries[key] = (interval, self._generation)
+		self._buckets.setdefault(self.tick_count + 1 + max(delay, 0), []).append((key, self._generation))
+	
+	
+	def unschedule(self, key):
+		if self._entries.pop(key, None) and self._places is not None:
+			self._places.discard(key)
+	
+	
+	def tick(self, callback):
+		"""
+		Moves on to the next tick and calls the callback with every key that is
+		due in it. Returns the number of keys that were due.
+		"""
+		self.tick_count += 1
+		due = 0
+		for key, generation in self._buckets.pop(self.tick_count, ()):
+			entry = self._entries.get(key)
+			if not entry or entry[1] != generation:
+				continue
+			
+			#put it back first so the callback can unschedule or reschedule it
+			(interval, generation) = entry
+			if interval:
+				self._buckets.setdefault(self.tick_count + interval, []).append((key, generation))
+			
+			else:
+				del self._entries[key]
+				if self._places is not None:
+					self._places.discard(key)
+			
+			callback(key)
+			due += 1
+		
+		return due
+	
+	
+	def clear(self):
+		self._buckets.clear()
+		self._entries.clear()
+		if self._places is not None:
+			self._places.clear()
+	
+	
+
+
@@ -0,0 +1,150 @@
+"""
+Maps rects in global pixel coordinates back to ranges of map coordinates, so
+that only the part of the world that is actually in a rect has to be looked at.
+CellBuckets does the same for a few cells spread out over the world.
+Author: Huba Nagy
+"""
+import math
+import itertools
+from common_util import *
+
+
+
+class ScreenIndex(object):
+	"""
+	The sprite of the voxel at (mx, my, mz) has its top left corner at
+	((my - mx - 1) * w / 2, (mx + my) * h / 2 - mz * d) as map_to_global puts it.
+	So a column of the sprites only depends on u = my - mx and a row only
+	depends on v = mx + my and mz, this is used to invert the mapping for rects.
+	"""
+	def __init__(self, world_dimensions, voxel_dimensions = (72, 36, 36)):
+		self._world_dimensions = world_dimensions
+		self._voxel_dimensions = voxel_dimensions
+		self._half_width = voxel_dimensions[WIDTH] / 2
+		self._half_height = voxel_dimensions[HEIGHT] / 2
+		self._image_height = voxel_dimensions[HEIGHT] + voxel_dimensions[DEPTH]
+	
+	
+	def uv_ranges(self, rect, low_z, high_z):
+		"""
+		Returns the inclusive (u_min, u_max), (v_min, v_max) ranges of the voxels
+		in the layers low_z to high_z (inclusive) whose sprite might intersect the
+		rect. The ranges are never too small but can be one too big on each end.
+		"""
+		u_min = int(math.floor(float(rect.left - self._voxel_dimensions[WIDTH]) / self._half_width)) + 1
+		u_max = int(math.ceil(float(rect.right) / self._half_width)) + 1
+		v_min = int(math.floor(float(rect.top + low_z * self._voxel_dimensions[DEPTH] - self._image_height) / self._half_height))
+		v_max = int(math.ceil(float(rect.bottom + high_z * self._voxel_dimensions[DEPTH]) / self._half_height))
+		return (u_min, u_max), (v_min, v_max)
+	
+	
+	def box_in_rect(self, rect, low_z, high_z):
+		"""
+		Returns the low and high (both inclusive) map coordinates of the smallest
+		box in the world that has all the voxels of the layers low_z to high_z
+		whose sprite intersects the rect. Returns None if there are none.
+		"""
+		((u_min, u_max), (v_min, v_max)) = self.uv_ranges(rect, low_z, high_z)
+		low = (max((v_min - u_max) / 2, 0), max((u_min + v_min) / 2, 0), max(low_z, 0))
+		high = (min((v_max - u_min + 1) / 2, self._world_dimensions[WIDTH] - 1),
+		        min((u_max + v_max + 1) / 2, self._world_dimensions[HEIGHT] - 1),
+		        min(high_z, self._world_dimensions[DEPTH] - 1))
+		
+		if low[X] > high[X] or low[Y] > high[Y] or low[Z] > high[Z]:
+			return None
+		
+		return low, high
+	
+	
+	def voxels_in_rect(self, rect, low_z = 0, high_z = None):
+		"""
+		Yields the map coordinates of the voxels whose sprite might intersect the
+		rect in the order they should be rendered, layer by layer back to front.
+		"""
+		if high_z is None:
+			high_z = self._world_dimensions[DEPTH] - 1
+		
+		(width, height, depth) = self._world_dimensions
+		for mz in xrange(max(low_z, 0), min(high_z, depth - 1) + 1):
+			((u_min, u_max), (v_min, v_max)) = self.uv_ranges(rect, mz, mz)
+			for v in xrange(max(v_min, 0), min(v_max, width + height - 2) + 1):
+				#only every second u is on the grid and mx, my have to be in the world
+				u_low = max(u_min, v - 2 * (width - 1), -v)
+				u_high = min(u_max, 2 * (height - 1) - v, v)
+				if (u_low + v) % 2:
+					u_low += 1
+				
+				for u in xrange(u_low, u_high + 1, 2):
+					yield ((v - u) / 2, (v + u) / 2, mz)
+	
+	
+
+
+
+class CellBuckets(object):
+	"""
+	Keeps a set of cell indexes grouped by the block of size cells a side the
+	cells are in, so the ones in a box are found without looking at the rest.
+	index_to_coordinate maps an index to the map coordinate of its cell.
+	"""
+	def __init__(self, index_to_coordinate, size = 8):
+		self._index_to_coordinate = index_to_coordinate
+		self.size = size
+		
+		#block coordinate: set of the indexes in it
+		self._buckets = {}
+	
+	
+	def _bucket_of(self, index):
+		return tuple(c / self.size for c in self._index_to_coordinate(index))
+	
+	
+	def add(self, index):
+		self._buckets.setdefault(self._bucket_of(index), set()).add(index)
+	
+	
+	def discard(self, index):
+		bucket = self._bucket_of(index)
+		indexes = self._buckets.get(bucket)
+		if indexes is not None:
+			indexes.discard(index)
+			if not indexes:
+				del self._buckets[bucket]
+	
+	
+	def clear(self):
+		self._buckets.clear()
+	
+	
+	def in_box(self, low, high):
+		"""
+		Returns the list of the indexes whose cell is between the low and high
+		coordinates (both inclusive).
+		"""
+		size = self.size
+		ranges = [xrange(low[i] // size, high[i] // size + 1) for i in xrange(len(low))]
+		if reduce(lambda count, blocks: count * len(blocks), ranges, 1) <= len(self._buckets):
+			buckets = [bucket for bucket in itertools.product(*ranges) if bucket in self._buckets]
+		
+		else:
+			buckets = [bucket for bucket in self._buckets
+			           if all(ranges[i][0] <= bucket[i] <= ranges[i][-1] for i in xrange(len(low)))]
+		
+		found = []
+		for bucket in buckets:
+			#a block that is all inside the box does not have to be looked into
+			if all(low[i] <= bucket[i] * size and (bucket[i] + 1) * size - 1 <= high[i] for i in xrange(len(low))):
+				found.extend(self._buckets[bucket])
+				continue
+			
+			for index in self._buckets[bucket]:
+				coordinate = self._index_to_coordinate(index)
+				if all(low[i] <= coordinate[i] <= high[i] for i in xrange(len(low))):
+					found.append(index)
+		
+		return found
+	
+	
+
+
+
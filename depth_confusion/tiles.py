@@ -1,34 +1,84 @@
 """
-Module with a class to represent a flat isometric tile grid
+Module with a class to represent a flat isometric tile grid. The tiles are kept
+as type ids in a compact array and the ground is rendered once onto the cached
+surfaces of blocks of tiles, a tile that changes is only drawn again where it is.
 Author: Huba Nagy
 """
 import pygame
+import numpy as np
 from common_util import *
+from world_base import *
+from resource_loader import SpritePyramid
+from picking import PickingTable
+from chunks import SurfaceCache
+from voxel_storage import PaletteStorage
+from profiling import PROFILER
 
 
 
-class TiledWorld:
+class TiledWorld(WorldBase):
 	def __init__(self, image_handler, tile_handler,
 	             world_dimensions = (64, 64),
-	             tile_dimensions = (72, 36)):
+	             tile_dimensions = (72, 36),
+	             block_dimensions = (8, 8)):
 		self.image_handler = image_handler
 		self.tile_handler = tile_handler
 		
 		self._world_dimensions = world_dimensions
 		self._tile_dimensions = tile_dimensions
-		self._grid = [None] * world_dimensions[WIDTH] * world_dimensions[HEIGHT]
+		
+		WorldBase.__init__(self, image_handler, tile_handler,
+		                   world_dimensions[WIDTH] * world_dimensions[HEIGHT], (0, 0))
+		
+		self.sprites = SpritePyramid(image_handler)
+		self._ground = GroundCache(self, block_dimensions)
+		self._picking_table = None
 	
 	
 	def on_update(self):
-		for tile in self._grid:
-			if tile:
-				tile.on_update()
+		"""
+		Calls on_update of the tiles whose class overrides it, in index order.
+		"""
+		storage = self._grid
+		updates = lambda tile_class: tile_class.on_update.__func__ is not ElementaryTile.on_update.__func__
+		is_updated = self._palette_mask(updates)
+		indexes = list(is_updated[storage.type_ids].nonzero()[0])
+		
+		#the tiles of classes the handler does not know are not of the class of their type id
+		(w, h) = self._world_dimensions
+		for index, tile in storage.unregistered_in_box((0, 0), (w - 1, h - 1)):
+			if not is_updated[storage.type_ids[index]] and updates(type(tile)):
+				indexes.append(index)
+		
+		for index in sorted(indexes):
+			storage[int(index)].on_update()
 	
 	
-	def on_render(self, target_surface):
-		for mx in xrange(self._world_dimensions[WIDTH]):
-			for my in xrange(self.world_dimensions[HEIGHT]):
-				
+	def on_render(self, viewport, rect = None):
+		"""
+		Renders the world onto a given viewport, the ground comes from the cached
+		surfaces and the tiles that are not ground tiles are rendered over it.
+		If a rect of global coordinates is given only that part is rendered.
+		"""
+		with PROFILER.phase('world_render'):
+			view = viewport.get_global_rect()
+			if rect:
+				view = view.clip(rect)
+			
+			self._ground.on_render(viewport, view)
+			
+			#everything else renders itself every frame
+			is_drawn = self._palette_mask(lambda tile_class: not issubclass(tile_class, GroundTile) and
+			                              tile_class.on_render.__func__ is not ElementaryTile.on_render.__func__)
+			if not is_drawn.any():
+				return
+			
+			box = self.tiles_in_rect(view)
+			if box:
+				(low, high) = box
+				type_ids = self._grid.read_box(low, (high[X] + 1, high[Y] + 1))
+				for oy, ox in zip(*is_drawn[type_ids].nonzero()):
+					self._grid[self._coordinate_to_index((low[X] + ox, low[Y] + oy))].on_render(viewport)
 	
 	
 	def on_event(self, event):
@@ -40,26 +90,71 @@ class TiledWorld:
 	
 	
 	def get_tile(self, mx, my):
+		return self[(mx, my)]
+	
+	
+	def set_tile(self, mx, my, tile):
+		self[(mx, my)] = tile
+	
+	
+	def fill_from_array(self, type_array, palette, low = (0, 0)):
+		"""
+		Fills a box of the world in one go. type_array is a (height, width) array
+		of indexes into palette, which is a list of tile ids of the tile handler,
+		the box starts at the low coordinate. The on_create and on_destroy hooks
+		are not called.
+		"""
+		type_array = np.asarray(type_array)
+		(h, w) = type_array.shape
+		high = (low[X] + w - 1, low[Y] + h - 1)
 		try:
-			self._validate_coordinates(mx, my)
-			return self._grid[self._get_index(mx, my)]
+			self._validate_coordinate(low)
+			self._validate_coordinate(high)
 		
 		except OutOfIt as out_of_this_world:
-			print out_of_this_world
+			print(out_of_this_world)
+			return
+		
+		storage = self._grid
+		palette_ids = np.array([storage.palette_id(tile_id) for tile_id in palette], dtype = storage.type_ids.dtype)
+		storage.write_box(low, palette_ids[type_array])
+		
+		storage.forget_box(low, high)
+		
+		self._ground.invalidate_box(low, high)
+		self._damage(self.box_rect(low, high))
+	
+	
+	def _palette_mask(self, predicate):
+		#a bool array of the palette ids whose tile class the predicate is True for
+		return np.array([predicate(self.tile_handler.get_element_class(tile_id))
+		                 for tile_id in self._grid.get_palette()], dtype = bool)
+	
+	
+	def _element_changed(self, coordinate):
+		self._ground.redraw_tile(coordinate)
+		self._damage(self.box_rect(coordinate, coordinate))
 	
-	def set_tile(self, mx, my, tile):
-		pass
 	
+	def _create_grid(self, grid_length):
+		return TileStorage(self, self.element_class_handler, self._world_dimensions)
 	
-	def _get_index(self, x, y, z):
-		return self._world_dimensions[WIDTH] * y x
 	
+	def _coordinate_to_index(self, coordinate):
+		return self._world_dimensions[WIDTH] * coordinate[Y] + coordinate[X]
 	
-	def _validate_coordinates(self, x, y, z):
+	
+	def _index_to_coordinate(self, index):
+		(y, x) = divmod(index, self._world_dimensions[WIDTH])
+		return (x, y)
+	
+	
+	def _validate_coordinate(self, coordinate):
 		"""
 		Validates that the world coordinoates are actually within the world
 		Make sure you handle the exceptions when you use this!!!
 		"""
+		(x, y) = coordinate
 		if x < 0:
 			raise OutOfIt('X coordinate is less than 0...' , x)
 		
@@ -73,61 +168,288 @@ class TiledWorld:
 			raise OutOfIt('Y coordinate is more than the height of the world...' , y)
 	
 	
+	def box_rect(self, low, high):
+		"""
+		Returns the rect in global coordinates that the images of all the tiles
+		between the low and high coordinates (both inclusive) fit into.
+		"""
+		(w, h) = self._tile_dimensions
+		left = self.map_to_global(high[X], low[Y])[X]
+		right = self.map_to_global(low[X], high[Y])[X] + w
+		top = self.map_to_global(low[X], low[Y])[Y]
+		bottom = self.map_to_global(high[X], high[Y])[Y] + h
+		return pygame.Rect(left, top, right - left, bottom - top)
+	
+	
+	def tiles_in_rect(self, rect):
+		"""
+		Returns the lowest and the highest coordinate (both inclusive) of the box
+		of tiles that covers the given rect of global coordinates, clipped to the
+		world. None if it is outside of the world.
+		"""
+		corners = [self.global_to_map(corner) for corner in (rect.topleft, rect.topright, rect.bottomleft, rect.bottomright)]
+		
+		#the mouse-help image might be a pixel or two off of the diamonds
+		low = [max(min(corner[i] for corner in corners) - 1, 0) for i in (X, Y)]
+		high = [min(max(corner[i] for corner in corners) + 1, self._world_dimensions[i] - 1) for i in (X, Y)]
+		if low[X] > high[X] or low[Y] > high[Y]:
+			return None
+		
+		return tuple(low), tuple(high)
+	
+	
 	def global_to_map(self, global_coordinates):
 		"""
-		Maps screen coordinates to world coordinates
+		Maps global coordinates to the map coordinates of the tile under them,
+		the coordinates can be outside of the world. See the picking module.
 		"""
-		(gx, gy) = global_coordinates
+		return self.get_picking_table().pick(*global_coordinates)
+	
+	
+	def global_to_map_array(self, global_points):
+		"""
+		The same as global_to_map for a whole (n, 2) array of global coordinates
+		at once, returns an (n, 2) array of map coordinates.
+		"""
+		global_points = np.asarray(global_points).reshape((-1, 2))
+		return np.column_stack(self.get_picking_table().pick_array(global_points[:, X], global_points[:, Y]))
+	
+	
+	def get_picking_table(self):
+		if self._picking_table is None:
+			self._picking_table = PickingTable(self._tile_dimensions, self.image_handler.get_image('mouse-help'))
 		
-		#Calculate rough x, y, z coordinate in the map
-		mx = ((gy + self._active_layer * self._voxel_dimensions[DEPTH]) / (self._voxel_dimensions[HEIGHT] / 2) - gx / (self._voxel_dimensions[WIDTH] / 2)) / 2
-		my = (gx / (self._voxel_dimensions[WIDTH] / 2) + (gy) / (self._voxel_dimensions[HEIGHT] / 2)) / 2
+		return self._picking_table
+	
+	
+	def map_to_global(self, mx, my):
+		"""
+		Maps world coordinates the coordinates of the top left corner of the image on the world surface.
+		No translation is applied yet.
+		"""
+		gx = - mx * (self._tile_dimensions[WIDTH] / 2) + my * (self._tile_dimensions[WIDTH] / 2)
+		gy = my * (self._tile_dimensions[HEIGHT] / 2)  + mx * (self._tile_dimensions[HEIGHT] / 2)
 		
-		#Calculate where the corner of the image is
-		cx, cy = self.map_to_global(mx, my)
-		#calculate where the screen cordinate is relative to the corner of the image
-		ix, iy = gx - cx, gy - cy
+		return (gx, gy)
+	
+	
+
+
+
+class TileStorage(PaletteStorage):
+	"""
+	Keeps the palette ids of the tiles of a TiledWorld in a compact array indexed
+	like TiledWorld._coordinate_to_index.
+	"""
+	def __init__(self, world, tile_handler, world_dimensions):
+		PaletteStorage.__init__(self, world, tile_handler)
+		self._shape = (world_dimensions[HEIGHT], world_dimensions[WIDTH])
+		self.type_ids = np.zeros(self._shape[0] * self._shape[1], dtype = np.uint16)
+	
+	
+	def __len__(self):
+		return len(self.type_ids)
+	
+	
+	def get_type_id(self, index):
+		return int(self.type_ids[index])
+	
+	
+	def _store_element(self, index, tile, tile_id):
+		self.type_ids[index] = self.palette_id(tile_id if tile_id else tile._tile_id)
+	
+	
+	def read_box(self, low, high):
+		"""
+		Returns the palette ids between the low and the one past the high
+		coordinates indexed [y, x], the box has to be inside the world.
+		Do not write into the result, it is a view of the storage.
+		"""
+		return self.type_ids.reshape(self._shape)[low[Y]:high[Y], low[X]:high[X]]
+	
+	
+	def write_box(self, low, values):
+		(h, w) = values.shape
+		self.type_ids.reshape(self._shape)[low[Y]:low[Y] + h, low[X]:low[X] + w] = values
+	
+	
+
+
+
+class GroundCache(SurfaceCache):
+	"""
+	Keeps the ground tiles of a world rendered onto the surfaces of blocks of
+	tiles, by block and scale. Blocks are indexed with (bx, by) coordinates and
+	the least recently used surfaces are dropped above capacity. When a tile
+	changes only it and the tiles overlapping it are drawn again onto the
+	surfaces of its block that are kept.
+	"""
+	def __init__(self, world, block_dimensions = (8, 8), capacity = 96):
+		SurfaceCache.__init__(self, capacity)
+		self._world = world
+		self.block_dimensions = block_dimensions
+		self._grid_dimensions = tuple((world.get_dimension(i) + block_dimensions[i] - 1) / block_dimensions[i]
+		                              for i in (X, Y))
+		
+		self._rects = {}
+		
+		self.renders = 0
+		self.redraws = 0
+	
+	
+	def block_of(self, coordinate):
+		return (coordinate[X] / self.block_dimensions[X], coordinate[Y] / self.block_dimensions[Y])
+	
+	
+	def block_box(self, block):
+		"""
+		Returns the lowest and the one past the highest map coordinate of a block.
+		"""
+		low = tuple(block[i] * self.block_dimensions[i] for i in (X, Y))
+		high = tuple(min(low[i] + self.block_dimensions[i], self._world.get_dimension(i)) for i in (X, Y))
+		return low, high
+	
+	
+	def block_rect(self, block):
+		try:
+			return self._rects[block]
+		
+		except KeyError:
+			(low, high) = self.block_box(block)
+			self._rects[block] = self._world.box_rect(low, (high[X] - 1, high[Y] - 1))
+			return self._rects[block]
+	
+	
+	def get_surface(self, block, scale):
+		"""
+		Returns the surface of a block at the given scale, rendering it if it is
+		not kept. None if there is no ground in the block.
+		"""
+		try:
+			surface = self._kept_surface((block, scale))
+			if PROFILER.enabled:
+				PROFILER.count('ground_cache_hits')
 		
-		#print 'corner: {0}, {1}'.format(cx, cy)
-		#print 'image: {0}, {1}'.format(ix, iy)
+		except KeyError:
+			surface = self._render_block(block, scale)
+			self._keep_surface((block, scale), surface)
 		
-		#Check the image coordinate accuired above against the mouse helper image
-		#and make corrections to the map coordinates if necessary
-		pixel_array = pygame.PixelArray(self.image_handler.get_image('mouse-help'))
-		pixel_color = pygame.Color(pixel_array[ix][iy])
-		#print pixel_color
-		if pixel_color == TEST_RED:
-			#print 'got red'
-			my -= 1
+		return surface
+	
+	
+	def _render_block(self, block, scale):
+		self.renders += 1
+		(low, high) = self.block_box(block)
+		if not self._ground_mask()[self._world._grid.read_box(low, high)].any():
+			return None
 		
-		elif pixel_color == TEST_GREEN:
-			#print 'got green'
-			mx -= 1
+		with PROFILER.phase('ground_render'):
+			rect = self.block_rect(block)
+			surface = pygame.Surface((int(rect.w * scale) + 1, int(rect.h * scale) + 1), flags = pygame.SRCALPHA)
+			self._draw_tiles(surface, rect, scale, low, high)
 		
-		elif pixel_color == TEST_BLUE:
-			#print 'got blue'
-			my += 1
+		if PROFILER.enabled:
+			PROFILER.count('ground_blocks_rendered')
+			PROFILER.count('surfaces_allocated')
+		
+		return surface
+	
+	
+	def _ground_mask(self):
+		return self._world._palette_mask(lambda tile_class: issubclass(tile_class, GroundTile))
+	
+	
+	def _draw_tiles(self, surface, rect, scale, low, high):
+		#draws the ground tiles between the low and the one past the high coordinates
+		#onto the surface of the block with the given rect, row by row
+		world = self._world
+		palette = world._grid.get_palette()
+		is_ground = self._ground_mask()
+		images = [world.sprites.get_image(world.tile_handler.construct_element(tile_id)._tile_id, scale)
+		          if is_ground[palette_id] else None for palette_id, tile_id in enumerate(palette)]
 		
-		elif pixel_color == TEST_YELLOW:
-			#print 'got yellow'
-			mx += 1
+		type_ids = world._grid.read_box(low, high)
+		for oy, ox in zip(*is_ground[type_ids].nonzero()):
+			(gx, gy) = world.map_to_global(low[X] + ox, low[Y] + oy)
+			surface.blit(images[type_ids[oy, ox]], (int((gx - rect.x) * scale), int((gy - rect.y) * scale)))
 		
-		return (mx, my)
+		if PROFILER.enabled:
+			PROFILER.count('blits', int(is_ground[type_ids].sum()))
 	
 	
-	def map_to_global(self, mx, my):
+	def redraw_tile(self, coordinate):
 		"""
-		Maps world coordinates the coordinates of the top left corner of the image on the world surface.
-		No translation is applied yet.
+		Draws the tile at the given coordinate again onto the kept surfaces of its
+		block, clearing its place and drawing it and its neighbours clipped to it.
 		"""
-		gx = - mx * (self._voxel_dimensions[WIDTH] / 2) + my * (self._voxel_dimensions[WIDTH] / 2)
-		gy = my * (self._voxel_dimensions[HEIGHT] / 2)  + mx * (self._voxel_dimensions[HEIGHT] / 2)
+		block = self.block_of(coordinate)
+		(low, high) = self.block_box(block)
+		rect = self.block_rect(block)
+		(gx, gy) = self._world.map_to_global(*coordinate)
+		(w, h) = self._world._tile_dimensions
 		
-		return (gx, gy)
+		for key in [key for key in self._surfaces if key[0] == block]:
+			(version, surface) = self._surfaces[key]
+			scale = key[1]
+			
+			#a block without ground has no surface to draw onto
+			if surface is None:
+				del self._surfaces[key]
+				continue
+			
+			surface.set_clip(pygame.Rect(int((gx - rect.x) * scale), int((gy - rect.y) * scale), int(w * scale), int(h * scale)))
+			surface.fill((0, 0, 0, 0))
+			self._draw_tiles(surface, rect, scale,
+			                 (max(coordinate[X] - 1, low[X]), max(coordinate[Y] - 1, low[Y])),
+			                 (min(coordinate[X] + 2, high[X]), min(coordinate[Y] + 2, high[Y])))
+			surface.set_clip(None)
+			self.redraws += 1
+	
+	
+	def invalidate_box(self, low, high):
+		"""
+		Drops the surfaces of the blocks between two map coordinates (both inclusive).
+		"""
+		(bx0, by0) = self.block_of(low)
+		(bx1, by1) = self.block_of(high)
+		for key in self._surfaces.keys():
+			if bx0 <= key[0][X] <= bx1 and by0 <= key[0][Y] <= by1:
+				del self._surfaces[key]
+	
+	
+	def visible_blocks(self, rect):
+		"""
+		Yields the coordinates of the blocks that intersect the given rect in
+		global coordinates, row by row.
+		"""
+		box = self._world.tiles_in_rect(rect)
+		if not box:
+			return
+		
+		(low, high) = (self.block_of(box[0]), self.block_of(box[1]))
+		for by in xrange(low[Y], high[Y] + 1):
+			for bx in xrange(low[X], high[X] + 1):
+				if self.block_rect((bx, by)).colliderect(rect):
+					yield (bx, by)
+	
+	
+	def on_render(self, viewport, rect):
+		"""
+		Blits the blocks in the given rect of global coordinates onto the scene of the viewport.
+		"""
+		for block in self.visible_blocks(rect):
+			surface = self.get_surface(block, viewport.scene_scale)
+			if surface:
+				viewport.scene.blit(surface, viewport.global_to_scene(self.block_rect(block).topleft))
+				if PROFILER.enabled:
+					PROFILER.count('ground_blits')
+					PROFILER.count('blits')
+	
+	
 
 
 
-class ElementaryTile:
+class ElementaryTile(GridElement):
 	def __init__(self, tile_id, dimensions = (72, 36)):
 		self._dimensions = dimensions
 		self._image_size = dimensions
@@ -138,7 +460,7 @@ class ElementaryTile:
 		self._tile_id = tile_id
 	
 	
-	def put_into_world(self, world, x, y, ):
+	def put_into_world(self, world, x, y):
 		self._coordinates = (x, y)
 		self._world = world
 		self._screen_coordinates = self._world.map_to_global(*self._coordinates)
@@ -151,7 +473,7 @@ class ElementaryTile:
 		pass
 	
 	
-	def on_render(self, target_surface, translation):
+	def on_render(self, viewport):
 		"""
 		How the tile gets rendered
 		"""
@@ -175,19 +497,29 @@ class ElementaryTile:
 
 
 
+#the attributes every tile gets, anything more is state of its own
+ElementaryTile._base_attributes = frozenset(vars(ElementaryTile('void')))
+
+
+
 class GroundTile(ElementaryTile):
+	"""
+	A tile that just shows its image. The world renders these ahead of time
+	onto the ground surfaces instead of calling on_render every frame.
+	"""
 	def __init__(self, tile_id, dimensions = (72, 36)):
 		ElementaryTile.__init__(self, tile_id, dimensions)
 	
 	
-	def on_render(self, target_surface, translation):
-		coordinates = (self._screen_coordinates[0] + translation[0], self._screen_coordinates[1] + translation[1])
+	def on_render(self, viewport):
+		coordinates = viewport.global_to_scene(self._screen_coordinates)
 		#blit image
-		target_surface.blit(self._world.image_handler.get_image(self._voxel_id), coordinates)
+		viewport.scene.blit(self._world.sprites.get_image(self._tile_id, viewport.scene_scale), coordinates)
 	
 	
 
 
+
 class Void(ElementaryTile):
 	def __init__(self, dimensions = (72, 36)):
 		ElementaryTile.__init__(self, 'void', dimensions)
@@ -203,5 +535,3 @@ class TileHandler(ElementClassHandler):
 		self.construct_tile = self.construct_element
 	
 	
-
-
@@ -14,6 +14,10 @@ Author: Huba Nagy
 import pygame
 import mpmath as mp
 from common_util import *
+from profiling import PROFILER
+
+#the scene scales Viewport.zoom steps through
+ZOOM_LEVELS = (0.25, 0.5, 0.75, 1, 1.5, 2)
 
 class Viewport(object):
 	"""
@@ -22,7 +26,8 @@ class Viewport(object):
 	This will later be part of a possible gui api. One day...
 	#TODO: implement transformations using mpmath. ATM I'm just figuring out what should happen.
 	"""
-	def __init__(self, screen, placement = (0, 0), scene_dimensions = None, bg_color = (100, 100, 100)):
+	def __init__(self, screen, placement = (0, 0), scene_dimensions = None, bg_color = (100, 100, 100),
+	             dirty_rects = False):
 		self._world = None
 		#the target screen which the final image of the screen is blitted onto
 		self.screen = screen
@@ -46,37 +51,204 @@ class Viewport(object):
 		self.scene_scale = 1
 		
 		self.bg_color = bg_color
+		
+		#in dirty rect mode only the parts of the scene that changed are rendered again
+		self.dirty_rects = dirty_rects
+		self._damage = None
+		self._last_view = None
 	
 	
 	def on_render(self):
+		"""
+		Renders the world onto the scene and blits it onto the screen. Returns the
+		list of screen rects that changed, ready to be passed to pygame.display.update.
+		"""
+		if self.dirty_rects and self._world:
+			return self._render_dirty()
+		
 		self.scene.fill(self.bg_color)
 		if self._world:
 			self._world.on_render(self)
 			#self.blit_scene = pygame.transform.scale(self.scene, (int(self.scene_rect.w * self.scene_scale), int(self.scene_rect.h * self.scene_scale)))
-			self.screen.blit(self.scene, self.screen_placement)
+			with PROFILER.phase('scene_blit'):
+				self.screen.blit(self.scene, self.screen_placement)
+			
+			if PROFILER.enabled:
+				PROFILER.count('blits')
+			
+			return [self.scene_rect.move(self.screen_placement)]
+		
+		return []
+	
+	
+	def _render_dirty(self):
+		"""
+		Renders the parts of the scene that changed since the last frame. Panning
+		at a scale of 1 scrolls the scene and only renders the strips uncovered by it.
+		"""
+		view = (self.scene_placement, self.scene_scale)
+		damage = self._damage[:]
+		del self._damage[:]
+		
+		if self._last_view is None or self._last_view[1] != self.scene_scale or (damage and damage[0] is None):
+			redraw = [self.scene_rect]
+			changed = [self.scene_rect]
+		
+		else:
+			#a pixel more on every side for what the chunks round differently
+			redraw = [self.global_to_scene(rect).inflate(2, 2) for rect in damage]
+			changed = redraw
+			
+			(dx, dy) = (self.scene_placement[X] - self._last_view[0][X], self.scene_placement[Y] - self._last_view[0][Y])
+			if dx or dy:
+				if self.scene_scale == 1:
+					self.scene.scroll(int(dx), int(dy))
+					redraw += self._uncovered_strips(dx, dy)
+				
+				else:
+					redraw = [self.scene_rect]
+				
+				changed = [self.scene_rect]
+		
+		self._last_view = view
+		
+		redraw = self._merge_rects([rect.clip(self.scene_rect) for rect in redraw])
+		for rect in redraw:
+			self.scene.set_clip(rect)
+			self.scene.fill(self.bg_color, rect)
+			self._world.on_render(self, self.scene_to_global(rect).inflate(2, 2))
+		
+		self.scene.set_clip(None)
+		
+		changed = self._merge_rects([rect.clip(self.scene_rect) for rect in changed])
+		with PROFILER.phase('scene_blit'):
+			for rect in changed:
+				self.screen.blit(self.scene, rect.move(self.screen_placement), rect)
+		
+		if PROFILER.enabled:
+			PROFILER.count('blits', len(changed))
+			PROFILER.count('dirty_rects', len(redraw))
+		
+		return [rect.move(self.screen_placement) for rect in changed]
+	
+	
+	def _uncovered_strips(self, dx, dy):
+		(w, h) = self.scene_rect.size
+		strips = []
+		if dx > 0:
+			strips.append(pygame.Rect(0, 0, dx, h))
+		
+		elif dx < 0:
+			strips.append(pygame.Rect(w + dx, 0, -dx, h))
+		
+		if dy > 0:
+			strips.append(pygame.Rect(0, 0, w, dy))
+		
+		elif dy < 0:
+			strips.append(pygame.Rect(0, h + dy, w, -dy))
+		
+		return strips
+	
+	
+	def _merge_rects(self, rects):
+		"""
+		Merges the overlapping rects and drops the empty ones, if there are
+		still too many of them they are merged into one.
+		"""
+		merged = []
+		for rect in rects:
+			if not rect.w or not rect.h:
+				continue
+			
+			#keep growing the rect while it overlaps any of the merged ones
+			i = rect.collidelist(merged)
+			while i != -1:
+				rect = rect.union(merged.pop(i))
+				i = rect.collidelist(merged)
+			
+			merged.append(rect)
+		
+		if len(merged) > 32:
+			return [merged[0].unionall(merged[1:])]
+		
+		return merged
 	
 	
 	def attach_to_world(self, world):
 		if not self._world:
 			self._world = world
+			self._damage = world.track_damage()
+			self._last_view = None
+			world.prefetch(self.get_global_rect())
 	
 	
 	def deattach_from_world(self, world):
 		if self._world:
+			self._world.untrack_damage(self._damage)
 			self._world = None
+			self._damage = None
 	
 	
 	def pan_view(self, delta):
 		"""
-		Changes the xy coordinates of the scene by the xy coordinates of the delta
+		Moves the scene by a delta of screen pixels, like a mouse drag does.
 		"""
-		self.scene_placement = (self.scene_placement[X] + delta[X], self.scene_placement[Y] + delta[Y])
-        
-        
-        def center_on(self, coordinate):
-            """Centers view on given coordinate"""
-            #TODO: implement this, first need to sort out zooming though...
-            pass
+		#the placement is in global coordinates, a screen pixel is 1 / scale of those
+		self.scene_placement = (self.scene_placement[X] + delta[X] / float(self.scene_scale),
+		                        self.scene_placement[Y] + delta[Y] / float(self.scene_scale))
+		if self._world:
+			self._world.prefetch(self.get_global_rect())
+	
+	
+	def center_on(self, coordinate):
+		"""
+		Centers the view on the voxel at the given map coordinate.
+		"""
+		if self._world:
+			self._place(self._world.box_rect(coordinate, coordinate).center, self.scene_rect.center)
+	
+	
+	def set_scale(self, scale, focus = None):
+		"""
+		Changes the scene scale keeping the global point under the focus (scene
+		coordinates, the middle of the scene by default) where it is.
+		"""
+		if focus is None:
+			focus = self.scene_rect.center
+		
+		global_focus = (focus[X] / float(self.scene_scale) - self.scene_placement[X],
+		                focus[Y] / float(self.scene_scale) - self.scene_placement[Y])
+		self.scene_scale = scale
+		self._place(global_focus, focus)
+	
+	
+	def zoom(self, steps, focus = None):
+		"""
+		Zooms in (positive steps) or out (negative steps) through ZOOM_LEVELS,
+		keeping the global point under the focus where it is like set_scale.
+		"""
+		#a scale that is not one of the levels zooms to the closest level
+		level = min(xrange(len(ZOOM_LEVELS)), key = lambda i: abs(ZOOM_LEVELS[i] - self.scene_scale))
+		level = max(0, min(level + steps, len(ZOOM_LEVELS) - 1))
+		if ZOOM_LEVELS[level] != self.scene_scale:
+			self.set_scale(ZOOM_LEVELS[level], focus)
+	
+	
+	def _place(self, global_coordinates, scene_coordinates):
+		#moves the scene so that the global coordinates end up at the scene coordinates
+		self.scene_placement = (int(round(scene_coordinates[X] / float(self.scene_scale) - global_coordinates[X])),
+		                        int(round(scene_coordinates[Y] / float(self.scene_scale) - global_coordinates[Y])))
+		if self._world:
+			self._world.prefetch(self.get_global_rect())
+	
+	
+	def get_global_rect(self):
+		"""
+		Returns the part of the world that is visible in the scene in global coordinates.
+		"""
+		return pygame.Rect((-self.scene_placement[X], -self.scene_placement[Y]),
+		                   (int(mp.ceil(self.scene_rect.w / mp.mpf(self.scene_scale))),
+		                    int(mp.ceil(self.scene_rect.h / mp.mpf(self.scene_scale)))))
 	
 	
 	def global_to_scene(self, global_coordinates):
@@ -87,15 +259,19 @@ class Viewport(object):
 		else:
 			(gx, gy) = global_coordinates
 		
+		if isinstance(global_coordinates, pygame.Rect):
+			#rounded outwards so the rect covers every scene pixel the global one touches
+			left = int(mp.floor((self.scene_placement[X] + gx) * mp.mpf(self.scene_scale)))
+			top = int(mp.floor((self.scene_placement[Y] + gy) * mp.mpf(self.scene_scale)))
+			right = int(mp.ceil((self.scene_placement[X] + gx + w) * mp.mpf(self.scene_scale)))
+			bottom = int(mp.ceil((self.scene_placement[Y] + gy + h) * mp.mpf(self.scene_scale)))
+			return pygame.Rect(left, top, right - left, bottom - top)
+		
 		#Do the translation here
 		scn_x = int((self.scene_placement[X] + gx) * self.scene_scale)
 		scn_y = int((self.scene_placement[Y] + gy) * self.scene_scale)
 		
-		if isinstance(global_coordinates, pygame.Rect):
-			return pygame.Rect((scn_x, scn_y), (int(w * self.scene_scale), int(h * self.scene_scale)))
-		
-		else:
-			return (scn_x, scn_y)
+		return (scn_x, scn_y)
 	
 	
 	def scene_to_global(self, scene_coordinates):
@@ -111,7 +287,7 @@ class Viewport(object):
 		gy = int(scn_y / self.scene_scale) - self.scene_placement[Y]
 		
 		if isinstance(scene_coordinates, pygame.Rect):
-			return pygame.Rect((gx, gy), (int(w * self.scene_scale), int(h * self.scene_scale)))
+			return pygame.Rect((gx, gy), (int(w / self.scene_scale), int(h / self.scene_scale)))
 		
 		else:
 			return (gx, gy)
@@ -161,15 +337,16 @@ class Viewport(object):
 			(scr_x, scr_y) = screen_coordinates
 		
 		#Do the translation here
-		g_x = scr_x - self.screen_placement[X] - self.scene_placement[X]
-		g_y = scr_y - self.screen_placement[Y] - self.scene_placement[Y]
+		g_x = int((scr_x - self.screen_placement[X]) / float(self.scene_scale)) - self.scene_placement[X]
+		g_y = int((scr_y - self.screen_placement[Y]) / float(self.scene_scale)) - self.scene_placement[Y]
                 
                 #print "clicked on {}".format((g_x, g_y))
                 
 		if isinstance(screen_coordinates, pygame.Rect):
-			return pygame.Rect((g_x, g_y), screen_coordinates.size)
+			return pygame.Rect((g_x, g_y), (int(screen_coordinates.w / float(self.scene_scale)),
+			                                int(screen_coordinates.h / float(self.scene_scale))))
 		
 		else:
 			return (g_x, g_y)
-
-
+	
+	
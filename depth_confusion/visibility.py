@@ -0,0 +1,94 @@
+"""
+Computes the visibility of blocks for whole boxes of the world at once with
+numpy, the same rules as Block.update_visibility just without visiting the
+voxels one by one. All arrays are indexed [z, y, x] like the voxel storage,
+DenseVoxelStorage.read_box gives the padded boxes these work on.
+Author: Huba Nagy
+"""
+import numpy as np
+from common_util import *
+
+
+
+def neighbour(padded, dx, dy, dz):
+	"""
+	Returns the view of an array padded by one on every side that holds the
+	neighbours at the given offset of the cells in the middle of it.
+	"""
+	(d, h, w) = padded.shape
+	return padded[1 + dz:d - 1 + dz, 1 + dy:h - 1 + dy, 1 + dx:w - 1 + dx]
+
+
+def exposed_blocks(is_block, is_void):
+	"""
+	Takes two bool arrays padded by one on every side, the padding of both should
+	be False like it is for coordinates outside of the world. Returns where blocks
+	would be rendered with ONLY_SHOW_EXPOSED: wherever there isn't a block over
+	them or there is void on any of their four sides.
+	"""
+	hidden = neighbour(is_block, 0, 0, 1).copy()
+	for (dx, dy) in ((1, 0), (0, 1), (-1, 0), (0, -1)):
+		hidden &= ~neighbour(is_void, dx, dy, 0)
+	
+	return ~hidden
+
+
+def dark_outlines(rendered):
+	"""
+	Takes a bool array of the rendered voxels padded by one on every side with
+	False and returns the 6 bit dark outline masks of the cells in the middle.
+	"""
+	hidden = lambda dx, dy, dz: ~neighbour(rendered, dx, dy, dz)
+	outlines = np.zeros(neighbour(rendered, 0, 0, 0).shape, dtype = np.uint8)
+	
+	nothing_behind = hidden(0, -1, 0)
+	outlines |= (nothing_behind & hidden(1, -1, 0)).astype(np.uint8) << 5
+	outlines |= (nothing_behind & hidden(0, -1, 1)).astype(np.uint8) << 0
+	
+	nothing_right = hidden(-1, 0, 0)
+	outlines |= (nothing_right & hidden(-1, 1, 0)).astype(np.uint8) << 2
+	outlines |= (nothing_right & hidden(-1, 0, 1)).astype(np.uint8) << 1
+	
+	nothing_under = hidden(0, 0, -1)
+	outlines |= (nothing_under & hidden(0, 1, 0) & hidden(0, 1, -1)).astype(np.uint8) << 3
+	outlines |= (nothing_under & hidden(1, 0, 0) & hidden(1, 0, -1)).astype(np.uint8) << 4
+	
+	return outlines
+
+
+def unoccluded(drawn, occluders, always_drawn):
+	"""
+	Takes bool arrays of the voxels of a box that draw anything, the ones that
+	hide what is behind them and the ones that can not be hidden. Returns the
+	(oz, oy, ox) offsets of the drawn voxels that are not completely covered by
+	occluders drawn after them, in the order they are drawn.
+	
+	The sprite of a block is a hexagon made of six triangles of a triangle
+	lattice, two columns (u = my - mx) wide and three rows (v = mx + my - 2 * mz)
+	high. Going through the voxels front to back, a voxel is covered if every
+	one of its triangles has already been covered by an occluder.
+	"""
+	(oz, oy, ox) = drawn.nonzero()
+	if not len(oz):
+		return oz, oy, ox
+	
+	order = np.arange(len(oz))
+	column = oy - ox
+	column -= column.min()
+	row = ox + oy - 2 * oz
+	row -= row.min()
+	
+	#the draw order of the last occluder over every triangle
+	covered_by = np.empty((column.max() + 2, row.max() + 3), dtype = np.int64)
+	covered_by.fill(-1)
+	covering = occluders[oz, oy, ox]
+	for dc in (0, 1):
+		for dr in (0, 1, 2):
+			np.maximum.at(covered_by, (column[covering] + dc, row[covering] + dr), order[covering])
+	
+	visible = always_drawn[oz, oy, ox].copy()
+	for dc in (0, 1):
+		for dr in (0, 1, 2):
+			visible |= covered_by[column + dc, row + dr] <= order
+	
+	return oz[visible], oy[visible], ox[visible]
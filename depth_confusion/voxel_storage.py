@@ -0,0 +1,672 @@
+"""
+The storage engine behind the voxel world. Instead of one python object per
+cell the type of every voxel is kept as a small integer in numpy arrays, and
+the little bit of state the built in voxels have (outlines, visibility,
+highlight) sits in arrays right next to it. DenseVoxelStorage holds the whole
+world in memory, PagedVoxelStorage only the chunks that are in use.
+Python objects are only kept around for voxels that really carry state of their
+own, everything else is rebuilt from its type id when it is asked for.
+Author: Huba Nagy
+"""
+import numpy as np
+from collections import OrderedDict
+from common_util import *
+from spatial_index import CellBuckets
+
+#bits of the per voxel flags array
+RENDERED = 1
+HIGHLIGHTED = 2
+
+#the types of the per voxel arrays
+DTYPES = {'type_ids': np.uint16, 'flags': np.uint8, 'outlines': np.uint8}
+
+
+def pack_cells(type_ids, flags, outlines):
+	"""
+	Packs the three arrays of some cells into one uint32 array, the type id in
+	the low 16 bits then the flags and the outline mask in a byte each.
+	"""
+	return (type_ids.astype(np.uint32) | (flags.astype(np.uint32) << 16) | (outlines.astype(np.uint32) << 24))
+
+
+def unpack_cells(cells):
+	"""
+	The inverse of pack_cells, returns the type ids, the flags and the outlines.
+	"""
+	return ((cells & 0xffff).astype(np.uint16), ((cells >> 16) & 0xff).astype(np.uint8), (cells >> 24).astype(np.uint8))
+
+
+
+class PaletteStorage(object):
+	"""
+	Behaves like the list WorldBase keeps its grid in. Element ids are stored
+	through a palette, palette id 0 is always 'void'. Elements are constructed
+	from their type when they are needed, only the stateful ones and the ones of
+	types the handler does not know are kept as objects. Subclasses keep the
+	palette ids, get_type_id reads one and _store_element writes one.
+	"""
+	def __init__(self, world, element_class_handler):
+		self._world = world
+		self._element_class_handler = element_class_handler
+		
+		self._palette = ['void']
+		self._palette_ids = {'void': 0}
+		
+		#the elements that have to be kept as objects, by index, then their indexes
+		#and the ones of the elements of classes the handler does not know by where they are
+		self._elements = {}
+		self._kept = CellBuckets(world._index_to_coordinate)
+		self._unregistered = CellBuckets(world._index_to_coordinate)
+	
+	
+	def __getitem__(self, index):
+		"""
+		Returns the element at the given index, elements that are not kept as
+		objects are constructed from their type id and put into the world on the fly.
+		"""
+		try:
+			return self._elements[index]
+		
+		except KeyError:
+			element = self._element_class_handler.construct_element(self._palette[self.get_type_id(index)])
+			element.put_into_world(self._world, *self._world._index_to_coordinate(index))
+			
+			#stateful elements are kept from the first time they are needed
+			if element.is_stateful():
+				self._keep(index, element)
+			
+			return element
+	
+	
+	def __setitem__(self, index, element):
+		"""
+		Stores the type of the element at the given index. The object itself is
+		only kept if it is stateful or of an unregistered type.
+		"""
+		element_id = self._element_class_handler.get_element_id(element)
+		self._store_element(index, element, element_id)
+		
+		if element_id is None:
+			self._keep(index, element)
+			self._unregistered.add(index)
+		
+		elif element.is_stateful():
+			self._keep(index, element)
+		
+		else:
+			self._forget(index)
+	
+	
+	def __iter__(self):
+		for index in xrange(len(self)):
+			yield self[index]
+	
+	
+	def _keep(self, index, element):
+		if index in self._elements:
+			self._unregistered.discard(index)
+		
+		else:
+			self._kept.add(index)
+		
+		self._elements[index] = element
+	
+	
+	def _forget(self, index):
+		if self._elements.pop(index, None) is not None:
+			self._kept.discard(index)
+			self._unregistered.discard(index)
+	
+	
+	def forget_box(self, low, high):
+		"""
+		Lets go of the elements that are kept as objects between the low and high
+		coordinates (both inclusive), they are built from their type again.
+		"""
+		for index in self._kept.in_box(low, high):
+			self._forget(index)
+	
+	
+	def unregistered_in_box(self, low, high):
+		"""
+		Returns the (index, element) pairs of the kept elements of classes the
+		handler does not know between the low and high coordinates (both
+		inclusive), the only ones that are not of the class of their type id.
+		"""
+		return [(index, self._elements[index]) for index in self._unregistered.in_box(low, high)]
+	
+	
+	def palette_id(self, element_id):
+		"""
+		Returns the palette id of an element id, adds it to the palette if it is new.
+		"""
+		try:
+			return self._palette_ids[element_id]
+		
+		except KeyError:
+			self._palette.append(element_id)
+			self._palette_ids[element_id] = len(self._palette) - 1
+			return self._palette_ids[element_id]
+	
+	
+	def element_id(self, palette_id):
+		return self._palette[palette_id]
+	
+	
+	def get_palette(self):
+		return list(self._palette)
+	
+	
+	def kept_element_count(self):
+		"""
+		The number of elements that are held as python objects.
+		"""
+		return len(self._elements)
+	
+	
+
+
+
+class VoxelStorage(PaletteStorage):
+	"""
+	Indexed with the same z major y secondary x minor indexes as
+	_coordinate_to_index gives. Subclasses decide where the type ids, the flags
+	and the outlines live.
+	"""
+	#True for storages that load the world piece by piece, see prefetch
+	paged = False
+	
+	def __init__(self, world, element_class_handler, world_dimensions):
+		PaletteStorage.__init__(self, world, element_class_handler)
+		self._world_dimensions = world_dimensions
+		self._shape = (world_dimensions[DEPTH], world_dimensions[HEIGHT], world_dimensions[WIDTH])
+	
+	
+	def __len__(self):
+		return self._shape[0] * self._shape[1] * self._shape[2]
+	
+	
+	def _store_element(self, index, element, element_id):
+		#the state of the built in voxels goes next to the type
+		(flags, outline) = element._get_state()
+		self._set_cell(index, self.palette_id(element_id if element_id else element._voxel_id), flags, outline)
+	
+	
+	def prefetch(self, low, high):
+		"""
+		A hint that the cells between the low and the one past the high
+		coordinates are about to be needed.
+		"""
+		pass
+	
+	
+
+
+
+class DenseVoxelStorage(VoxelStorage):
+	"""
+	Keeps the whole world in memory in dense numpy arrays.
+	"""
+	def __init__(self, world, element_class_handler, world_dimensions):
+		VoxelStorage.__init__(self, world, element_class_handler, world_dimensions)
+		grid_length = len(self)
+		
+		#the dense arrays, 4 bytes per cell all together
+		self.type_ids = np.zeros(grid_length, dtype = np.uint16)
+		self.outlines = np.zeros(grid_length, dtype = np.uint8)
+		self.flags = np.zeros(grid_length, dtype = np.uint8)
+	
+	
+	def _set_cell(self, index, type_id, flags, outline):
+		self.type_ids[index] = type_id
+		self.flags[index] = flags
+		self.outlines[index] = outline
+	
+	
+	def get_type_id(self, index):
+		return int(self.type_ids[index])
+	
+	
+	def get_flags(self, index):
+		return int(self.flags[index])
+	
+	
+	def set_flags(self, index, flags):
+		self.flags[index] = flags
+	
+	
+	def get_outline(self, index):
+		return int(self.outlines[index])
+	
+	
+	def set_outline(self, index, outline):
+		self.outlines[index] = outline
+	
+	
+	def _box_arrays(self, name, low, high):
+		#the part of the box inside the world and where it starts in the box
+		(d, h, w) = self._shape
+		inner_low = (max(low[X], 0), max(low[Y], 0), max(low[Z], 0))
+		inner_high = (min(high[X], w), min(high[Y], h), min(high[Z], d))
+		array = getattr(self, name).reshape(self._shape)
+		return array, inner_low, inner_high
+	
+	
+	def read_box(self, name, low, high, fill = 0):
+		"""
+		Returns the cells of one of the arrays ('type_ids', 'flags' or 'outlines')
+		between the low and the one past the high coordinates, indexed [z, y, x].
+		The box can reach out of the world, the cells out there are set to fill.
+		Do not write into the result, it might be a view of the storage.
+		"""
+		(array, inner_low, inner_high) = self._box_arrays(name, low, high)
+		if inner_low == tuple(low) and inner_high == tuple(high):
+			return array[low[Z]:high[Z], low[Y]:high[Y], low[X]:high[X]]
+		
+		result = np.empty((high[Z] - low[Z], high[Y] - low[Y], high[X] - low[X]), dtype = array.dtype)
+		result.fill(fill)
+		if all(inner_low[i] < inner_high[i] for i in (X, Y, Z)):
+			result[inner_low[Z] - low[Z]:inner_high[Z] - low[Z],
+			       inner_low[Y] - low[Y]:inner_high[Y] - low[Y],
+			       inner_low[X] - low[X]:inner_high[X] - low[X]] = array[inner_low[Z]:inner_high[Z],
+			                                                             inner_low[Y]:inner_high[Y],
+			                                                             inner_low[X]:inner_high[X]]
+		
+		return result
+	
+	
+	def write_box(self, name, low, values, mask = None):
+		"""
+		Writes a [z, y, x] array of values into one of the arrays starting at the
+		low coordinate, only where mask is True if there is a mask. The box has
+		to be inside the world.
+		"""
+		(d, h, w) = values.shape
+		box = getattr(self, name).reshape(self._shape)[low[Z]:low[Z] + d, low[Y]:low[Y] + h, low[X]:low[X] + w]
+		if mask is None:
+			box[...] = values
+		
+		else:
+			box[mask] = values[mask]
+	
+	
+	def nbytes(self):
+		"""
+		The memory used by the dense arrays in bytes.
+		"""
+		return self.type_ids.nbytes + self.outlines.nbytes + self.flags.nbytes
+	
+	
+
+
+
+class LazyVoxelStorage(DenseVoxelStorage):
+	"""
+	A DenseVoxelStorage that starts out empty and fills itself from a source one
+	chunk at a time, the first time anything in the chunk is touched. The source
+	needs a chunk_dimensions attribute and a read_chunk(chunk) method that returns
+	the packed cells of a chunk (see pack_cells) indexed [z, y, x], WorldFile of
+	the world_io module is one. The palette has to be the one the cells use.
+	"""
+	paged = True
+	
+	def __init__(self, world, element_class_handler, world_dimensions, source, palette):
+		DenseVoxelStorage.__init__(self, world, element_class_handler, world_dimensions)
+		self._source = source
+		self._chunk_dimensions = source.chunk_dimensions
+		
+		#palette id 0 is void in the source as well so the rest keep their ids
+		for element_id in palette[1:]:
+			self.palette_id(element_id)
+		
+		self._loaded = np.zeros(tuple((world_dimensions[i] + self._chunk_dimensions[i] - 1) / self._chunk_dimensions[i]
+		                              for i in (Z, Y, X)), dtype = bool)
+	
+	
+	def _load_chunk(self, chunk):
+		(type_ids, flags, outlines) = unpack_cells(self._source.read_chunk(chunk))
+		low = tuple(chunk[i] * self._chunk_dimensions[i] for i in (X, Y, Z))
+		DenseVoxelStorage.write_box(self, 'type_ids', low, type_ids)
+		DenseVoxelStorage.write_box(self, 'flags', low, flags)
+		DenseVoxelStorage.write_box(self, 'outlines', low, outlines)
+		self._loaded[chunk[Z], chunk[Y], chunk[X]] = True
+		self._world._chunk_loaded(low, type_ids)
+	
+	
+	def _load_box(self, low, high):
+		"""
+		Loads the chunks between the low and the one past the high coordinates.
+		"""
+		(d, h, w) = self._loaded.shape
+		(x0, y0, z0) = tuple(max(low[i], 0) / self._chunk_dimensions[i] for i in (X, Y, Z))
+		(x1, y1, z1) = (min((high[X] - 1) / self._chunk_dimensions[X] + 1, w),
+		                min((high[Y] - 1) / self._chunk_dimensions[Y] + 1, h),
+		                min((high[Z] - 1) / self._chunk_dimensions[Z] + 1, d))
+		missing = ~self._loaded[z0:z1, y0:y1, x0:x1]
+		if missing.any():
+			for (oz, oy, ox) in zip(*missing.nonzero()):
+				self._load_chunk((x0 + ox, y0 + oy, z0 + oz))
+	
+	
+	def _load_index(self, index):
+		(x, y, z) = self._world._index_to_coordinate(index)
+		(cx, cy, cz) = (x / self._chunk_dimensions[X], y / self._chunk_dimensions[Y], z / self._chunk_dimensions[Z])
+		if not self._loaded[cz, cy, cx]:
+			self._load_chunk((cx, cy, cz))
+	
+	
+	def __getitem__(self, index):
+		if index not in self._elements:
+			self._load_index(index)
+		
+		return DenseVoxelStorage.__getitem__(self, index)
+	
+	
+	def __setitem__(self, index, element):
+		self._load_index(index)
+		DenseVoxelStorage.__setitem__(self, index, element)
+	
+	
+	def get_type_id(self, index):
+		self._load_index(index)
+		return DenseVoxelStorage.get_type_id(self, index)
+	
+	
+	def get_flags(self, index):
+		self._load_index(index)
+		return DenseVoxelStorage.get_flags(self, index)
+	
+	
+	def set_flags(self, index, flags):
+		self._load_index(index)
+		DenseVoxelStorage.set_flags(self, index, flags)
+	
+	
+	def get_outline(self, index):
+		self._load_index(index)
+		return DenseVoxelStorage.get_outline(self, index)
+	
+	
+	def set_outline(self, index, outline):
+		self._load_index(index)
+		DenseVoxelStorage.set_outline(self, index, outline)
+	
+	
+	def read_box(self, name, low, high, fill = 0):
+		self._load_box(low, high)
+		return DenseVoxelStorage.read_box(self, name, low, high, fill)
+	
+	
+	def write_box(self, name, low, values, mask = None):
+		(d, h, w) = values.shape
+		self._load_box(low, (low[X] + w, low[Y] + h, low[Z] + d))
+		DenseVoxelStorage.write_box(self, name, low, values, mask)
+	
+	
+	def prefetch(self, low, high):
+		self._load_box(low, high)
+	
+	
+	def loaded_chunk_count(self):
+		return int(self._loaded.sum())
+	
+	
+	def is_loaded(self):
+		"""
+		True once every chunk has been loaded and the source is not needed anymore.
+		"""
+		return bool(self._loaded.all())
+	
+	
+
+
+
+class _Page(object):
+	"""
+	The cells of one chunk of a PagedVoxelStorage, the arrays are flat in the
+	same z major order as the world just for the chunk only.
+	"""
+	def __init__(self, low, shape, cells):
+		self.low = low
+		self.shape = shape
+		(self.type_ids, self.flags, self.outlines) = unpack_cells(cells.ravel())
+		self.dirty = False
+	
+	
+	def nbytes(self):
+		return self.type_ids.nbytes + self.flags.nbytes + self.outlines.nbytes
+	
+	
+	def box(self, name, low, high):
+		"""
+		Returns the view of the part of one of the arrays between the low and
+		the one past the high coordinates, which have to be inside the page.
+		"""
+		array = getattr(self, name).reshape(self.shape)
+		return array[low[Z] - self.low[Z]:high[Z] - self.low[Z],
+		             low[Y] - self.low[Y]:high[Y] - self.low[Y],
+		             low[X] - self.low[X]:high[X] - self.low[X]]
+	
+	
+
+
+
+class PagedVoxelStorage(VoxelStorage):
+	"""
+	Keeps only some chunks (pages) of the world in memory, the rest of the world
+	stays in a backing store and the pages are loaded from it the first time they
+	are touched. Above memory_budget bytes the least recently used pages are
+	dropped, the ones that were changed are written back first. The voxels of a
+	dropped page that were kept as objects are let go of with it and built from
+	their type again once the page is loaded again, so only their type, flags
+	and outlines live on. The store needs a
+	chunk_dimensions attribute, read_chunk(chunk) and write_chunk(chunk, cells)
+	methods for the packed cells of a chunk (see pack_cells) and set_palette(palette),
+	WorldFile of the world_io module opened for writing is one.
+	"""
+	paged = True
+	
+	def __init__(self, world, element_class_handler, world_dimensions, store, palette,
+	             memory_budget = 64 * 1024 * 1024):
+		VoxelStorage.__init__(self, world, element_class_handler, world_dimensions)
+		self._store = store
+		self._chunk_dimensions = store.chunk_dimensions
+		self.memory_budget = memory_budget
+		
+		#palette id 0 is void in the store as well so the rest keep their ids
+		for element_id in palette[1:]:
+			self.palette_id(element_id)
+		
+		self._saved_palette_length = len(self._palette)
+		
+		#the pages in least recently used order
+		self._pages = OrderedDict()
+		self._nbytes = 0
+		self._last_page = None
+		
+		self.loads = 0
+		self.evictions = 0
+		self.write_backs = 0
+	
+	
+	def _page(self, chunk):
+		"""
+		Returns the page of a chunk, loads it if it is not in memory.
+		"""
+		if self._last_page and self._last_page[0] == chunk:
+			return self._last_page[1]
+		
+		try:
+			page = self._pages.pop(chunk)
+		
+		except KeyError:
+			low = tuple(chunk[i] * self._chunk_dimensions[i] for i in (X, Y, Z))
+			high = tuple(min(low[i] + self._chunk_dimensions[i], self._world_dimensions[i]) for i in (X, Y, Z))
+			page = _Page(low, (high[Z] - low[Z], high[Y] - low[Y], high[X] - low[X]), self._store.read_chunk(chunk))
+			self._nbytes += page.nbytes()
+			self.loads += 1
+			self._evict()
+			self._world._chunk_loaded(low, page.type_ids.reshape(page.shape))
+		
+		self._pages[chunk] = page
+		self._last_page = (chunk, page)
+		return page
+	
+	
+	def _evict(self):
+		#the page that is being loaded is not in the pages yet so it always stays
+		while self._pages and self._nbytes > self.memory_budget:
+			(chunk, page) = self._pages.popitem(last = False)
+			if page.dirty:
+				self._write_back(chunk, page)
+			
+			self._nbytes -= page.nbytes()
+			self.evictions += 1
+			(d, h, w) = page.shape
+			self._world._chunk_dropped(page.low, (page.low[X] + w, page.low[Y] + h, page.low[Z] + d))
+			self.forget_box(page.low, (page.low[X] + w - 1, page.low[Y] + h - 1, page.low[Z] + d - 1))
+		
+		self._last_page = None
+	
+	
+	def _write_back(self, chunk, page):
+		if len(self._palette) != self._saved_palette_length:
+			self._store.set_palette(self.get_palette())
+			self._saved_palette_length = len(self._palette)
+		
+		self._store.write_chunk(chunk, pack_cells(page.type_ids, page.flags, page.outlines).reshape(page.shape))
+		page.dirty = False
+		self.write_backs += 1
+	
+	
+	def _locate(self, index):
+		"""
+		Returns the page the index is in and the index inside of the page.
+		"""
+		(x, y, z) = self._world._index_to_coordinate(index)
+		page = self._page((x / self._chunk_dimensions[X], y / self._chunk_dimensions[Y], z / self._chunk_dimensions[Z]))
+		(d, h, w) = page.shape
+		return page, ((z - page.low[Z]) * h + y - page.low[Y]) * w + x - page.low[X]
+	
+	
+	def _set_cell(self, index, type_id, flags, outline):
+		(page, i) = self._locate(index)
+		page.type_ids[i] = type_id
+		page.flags[i] = flags
+		page.outlines[i] = outline
+		page.dirty = True
+	
+	
+	def get_type_id(self, index):
+		(page, i) = self._locate(index)
+		return int(page.type_ids[i])
+	
+	
+	def get_flags(self, index):
+		(page, i) = self._locate(index)
+		return int(page.flags[i])
+	
+	
+	def set_flags(self, index, flags):
+		(page, i) = self._locate(index)
+		page.flags[i] = flags
+		page.dirty = True
+	
+	
+	def get_outline(self, index):
+		(page, i) = self._locate(index)
+		return int(page.outlines[i])
+	
+	
+	def set_outline(self, index, outline):
+		(page, i) = self._locate(index)
+		page.outlines[i] = outline
+		page.dirty = True
+	
+	
+	def _chunks_in_box(self, low, high):
+		"""
+		Yields the chunks between the low and the one past the high coordinates
+		clipped to the world, with the low and high coordinates of the part of
+		the box in them.
+		"""
+		low = tuple(max(low[i], 0) for i in (X, Y, Z))
+		high = tuple(min(high[i], self._world_dimensions[i]) for i in (X, Y, Z))
+		if any(low[i] >= high[i] for i in (X, Y, Z)):
+			return
+		
+		(cw, ch, cd) = self._chunk_dimensions
+		for cz in xrange(low[Z] / cd, (high[Z] - 1) / cd + 1):
+			for cy in xrange(low[Y] / ch, (high[Y] - 1) / ch + 1):
+				for cx in xrange(low[X] / cw, (high[X] - 1) / cw + 1):
+					part_low = (max(low[X], cx * cw), max(low[Y], cy * ch), max(low[Z], cz * cd))
+					part_high = (min(high[X], (cx + 1) * cw), min(high[Y], (cy + 1) * ch), min(high[Z], (cz + 1) * cd))
+					yield (cx, cy, cz), part_low, part_high
+	
+	
+	def read_box(self, name, low, high, fill = 0):
+		"""
+		Returns a copy of the cells of one of the arrays ('type_ids', 'flags' or
+		'outlines') between the low and the one past the high coordinates, indexed
+		[z, y, x]. The box can reach out of the world, the cells out there are fill.
+		"""
+		result = np.empty((high[Z] - low[Z], high[Y] - low[Y], high[X] - low[X]), dtype = DTYPES[name])
+		result.fill(fill)
+		for chunk, part_low, part_high in self._chunks_in_box(low, high):
+			result[part_low[Z] - low[Z]:part_high[Z] - low[Z],
+			       part_low[Y] - low[Y]:part_high[Y] - low[Y],
+			       part_low[X] - low[X]:part_high[X] - low[X]] = self._page(chunk).box(name, part_low, part_high)
+		
+		return result
+	
+	
+	def write_box(self, name, low, values, mask = None):
+		"""
+		Writes a [z, y, x] array of values into one of the arrays starting at the
+		low coordinate, only where mask is True if there is a mask.
+		"""
+		(d, h, w) = values.shape
+		for chunk, part_low, part_high in self._chunks_in_box(low, (low[X] + w, low[Y] + h, low[Z] + d)):
+			part = (slice(part_low[Z] - low[Z], part_high[Z] - low[Z]),
+			        slice(part_low[Y] - low[Y], part_high[Y] - low[Y]),
+			        slice(part_low[X] - low[X], part_high[X] - low[X]))
+			page = self._page(chunk)
+			box = page.box(name, part_low, part_high)
+			if mask is None:
+				box[...] = values[part]
+			
+			else:
+				box[mask[part]] = values[part][mask[part]]
+			
+			page.dirty = True
+	
+	
+	def prefetch(self, low, high):
+		for chunk, part_low, part_high in self._chunks_in_box(low, high):
+			self._page(chunk)
+	
+	
+	def flush(self):
+		"""
+		Writes every changed page back to the store, they stay in memory.
+		"""
+		for chunk, page in self._pages.iteritems():
+			if page.dirty:
+				self._write_back(chunk, page)
+		
+		if len(self._palette) != self._saved_palette_length:
+			self._store.set_palette(self.get_palette())
+			self._saved_palette_length = len(self._palette)
+	
+	
+	def page_count(self):
+		return len(self._pages)
+	
+	
+	def nbytes(self):
+		"""
+		The memory used by the pages in memory in bytes.
+		"""
+		return self._nbytes
+	
+	
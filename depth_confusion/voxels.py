@@ -7,7 +7,22 @@ Author: Huba Nagy
 import pygame
 from common_util import *
 from world_base import *
-import mpmath as mp
+from voxel_storage import DenseVoxelStorage, DTYPES, RENDERED, HIGHLIGHTED
+from resource_loader import SpriteCache
+from chunks import ChunkGrid
+from regions import RegionCache
+from spatial_index import ScreenIndex, CellBuckets
+from profiling import PROFILER
+from scheduler import UpdateScheduler
+from picking import PickingTable
+import visibility
+import numpy as np
+
+
+#the column top of a column that has to be found again
+UNKNOWN_TOP = -2
+#the column tops are kept in pages of this many by this many columns
+COLUMN_PAGE = 64
 
 
 
@@ -16,7 +31,9 @@ class VoxelWorld(WorldBase):
 	             world_dimensions = (64, 64, 16),
 	             voxel_dimensions = (72, 36, 36),
 	             active_layer = 0,
-	             visibility_flag = ONLY_SHOW_EXPOSED):
+	             visibility_flag = ONLY_SHOW_EXPOSED,
+	             chunk_dimensions = (8, 8, 4),
+	             storage_factory = None):
 		
 		
 		self._world_dimensions = world_dimensions
@@ -24,49 +41,534 @@ class VoxelWorld(WorldBase):
 		grid_length = world_dimensions[WIDTH] * world_dimensions[HEIGHT] * world_dimensions[DEPTH]
 		
 		self._active_layer = active_layer
-		self.visibility_flag = visibility_flag
-                
-                #The unprojected length of the horizontal side of each voxel
-                self._side_length = mp.nint(self._voxel_dimensions[WIDTH] * mp.sin(mp.pi / 4))
+		self._visibility_flag = visibility_flag
+		
+		#skip drawing the blocks that are hidden behind opaque blocks in front of them
+		self._occlusion_culling = True
+		
+		#called with the world to create the storage instead of a DenseVoxelStorage
+		self._storage_factory = storage_factory
+		
+		#made from the mouse-help image the first time something is picked
+		self._picking_table = None
+		
+		#(px, py): the highest layer that is not void in every column [y, x] of a
+		#page of columns, -1 for empty columns and UNKNOWN_TOP for the ones that
+		#have to be looked at again, a page is made the first time it is needed
+		self._column_tops = {}
 		
 		WorldBase.__init__(self, resource_handler, voxel_handler,
 		                   grid_length, (0, 0))
+		
+		self._scheduler = UpdateScheduler(CellBuckets(self._index_to_coordinate))
+		self.sprite_cache = SpriteCache(resource_handler)
+		self.screen_index = ScreenIndex(world_dimensions, voxel_dimensions)
+		self._chunks = ChunkGrid(self, chunk_dimensions)
+		#composed regions shared by the viewports, see shared_regions
+		self._regions = None
+	
+	
+	@property
+	def shared_regions(self):
+		"""
+		With shared regions on the viewports blit big regions of the world that
+		are composed once for all of them instead of blitting every chunk, so
+		each viewport on the world only costs a few blits once they are composed.
+		"""
+		return self._regions is not None
+	
+	
+	@shared_regions.setter
+	def shared_regions(self, value):
+		if value and self._regions is None:
+			self._regions = RegionCache(self, self._chunks.on_render)
+		
+		elif not value and self._regions is not None:
+			self._regions.close()
+			self._regions = None
+		
+		self._damage(None)
+	
+	
+	@property
+	def occlusion_culling(self):
+		return self._occlusion_culling
+	
+	
+	@occlusion_culling.setter
+	def occlusion_culling(self, value):
+		self._occlusion_culling = value
+		self._chunks.invalidate_all()
+		self._damage(None)
+	
+	
+	@property
+	def visibility_flag(self):
+		return self._visibility_flag
+	
+	
+	@visibility_flag.setter
+	def visibility_flag(self, flag):
+		self._visibility_flag = flag
+		self._damage(None)
 	
 	
 	def scroll_layer(self, dl):
 		if self._world_dimensions[DEPTH] > (self._active_layer + dl) > -1:
 			self._active_layer += dl
+			self._damage(None)
 	
 	
 	def on_update(self):
-		for mx, my, mz, voxel in self:
-			if voxel:
-				voxel.on_update()
+		"""
+		Calls on_update of the voxels that are scheduled for this update, see
+		schedule_update and ElementaryVoxel.update_interval.
+		"""
+		with PROFILER.phase('world_update'):
+			updated = self._scheduler.tick(self._update_voxel)
+		
+		if PROFILER.enabled:
+			PROFILER.count('voxels_updated', updated)
+	
+	
+	def _update_voxel(self, index):
+		self._grid[index].on_update()
+	
+	
+	def schedule_update(self, coordinate, interval = 1, delay = 0):
+		"""
+		Makes the voxel at the given coordinate get updated every interval updates,
+		or just once if interval is None, starting delay updates after the next one.
+		The schedule ends when the voxel is replaced.
+		"""
+		self._scheduler.schedule(self._coordinate_to_index(coordinate), interval, delay)
+	
+	
+	def unschedule_update(self, coordinate):
+		self._scheduler.unschedule(self._coordinate_to_index(coordinate))
+	
+	
+	def active_voxel_count(self):
+		"""
+		The number of voxels that are scheduled to be updated.
+		"""
+		return len(self._scheduler)
+	
+	
+	def _update_interval(self, element_class):
+		if element_class.update_interval is not None:
+			return element_class.update_interval
+		
+		#classes that override on_update without saying how often still get every update
+		if element_class.on_update.__func__ is not ElementaryVoxel.on_update.__func__:
+			return 1
+		
+		return None
+	
+	
+	def schedule_box(self, low, high):
+		"""
+		Schedules the voxels between the low and high coordinates (both inclusive)
+		whose class has an update interval, the ones that are scheduled already
+		are left alone. fill_from_array and the storages that load the world
+		chunk by chunk do this on their own.
+		"""
+		if self._ticking_types() is not None:
+			self._schedule_types(low, self._grid.read_box('type_ids', low, (high[X] + 1, high[Y] + 1, high[Z] + 1)))
+	
+	
+	def _ticking_types(self):
+		"""
+		Returns the update interval of every palette id, None if no voxel type
+		of the palette updates on its own.
+		"""
+		intervals = [self._update_interval(self.element_class_handler.get_element_class(element_id))
+		             for element_id in self._grid.get_palette()]
+		return intervals if any(intervals) else None
+	
+	
+	def _schedule_types(self, low, type_ids):
+		#type_ids is the [z, y, x] array of the palette ids of the box starting at low
+		intervals = self._ticking_types()
+		if intervals is None:
+			return
+		
+		ticking = [i for i in xrange(len(intervals)) if intervals[i]]
+		for oz, oy, ox in zip(*np.in1d(type_ids, ticking).reshape(type_ids.shape).nonzero()):
+			index = self._coordinate_to_index((low[X] + ox, low[Y] + oy, low[Z] + oz))
+			if index not in self._scheduler:
+				self._scheduler.schedule(index, intervals[type_ids[oz, oy, ox]])
+	
+	
+	def _chunk_loaded(self, low, type_ids):
+		"""
+		Called by a storage that loads the world chunk by chunk with the low
+		coordinate and the palette ids of a chunk it has just loaded, the voxels
+		in it that update on their own start to.
+		"""
+		self._schedule_types(low, type_ids)
+	
+	
+	def _chunk_dropped(self, low, high):
+		"""
+		Called by a storage that let go of the chunk between the low and the one
+		past the high coordinates, its voxels stop updating until it is loaded again.
+		"""
+		for index in self._scheduler.keys_in_box(low, (high[X] - 1, high[Y] - 1, high[Z] - 1)):
+			self._scheduler.unschedule(index)
 	
 	
 	def __iter__(self):
-		for mz in xrange(self._world_dimensions[WIDTH]):
+		index = 0
+		for mz in xrange(self._world_dimensions[DEPTH]):
 			for my in xrange(self._world_dimensions[HEIGHT]):
-				for mx in xrange(self._world_dimensions[DEPTH]):
-					voxel = self[(mx, my, mz)]
-					yield mx, my, mz, voxel
+				for mx in xrange(self._world_dimensions[WIDTH]):
+					#the storage is in the same order so there is no need to validate anything
+					yield mx, my, mz, self._grid[index]
+					index += 1
 	
 	
-	def on_render(self, viewport):
+	def on_render(self, viewport, rect = None):
 		"""
-		This function calls the render function of all voxels onto a given viewport
+		Renders the world onto a given viewport, chunks that have not changed
+		since the last frame are not rendered again just blitted. If a rect of
+		global coordinates is given only that part of the world is rendered.
 		"""
-		for mx, my, mz, voxel in self:
-			if self.visibility_flag == ONLY_SHOW_EXPOSED and mz > self._active_layer:
-				return
+		with PROFILER.phase('world_render'):
+			if self._regions is not None:
+				self._regions.on_render(viewport, rect)
+			
+			else:
+				self._chunks.on_render(viewport, rect)
+	
+	
+	def scene_blits(self, viewport, rect = None):
+		with PROFILER.phase('world_render'):
+			if self._regions is not None:
+				return self._regions.scene_blits(viewport, rect)
+			
+			return self._chunks.scene_blits(viewport, rect)
+	
+	
+	def prefetch(self, rect):
+		"""
+		Lets the storage load the part of the world in and around a rect of global
+		coordinates ahead of rendering it, the viewports call this as they move.
+		Only does anything with a storage that loads the world piece by piece.
+		"""
+		if not self._grid.paged:
+			return
+		
+		#half a rect worth around it on every side
+		for chunk in self._chunks.visible_chunks(rect.inflate(rect.w, rect.h)):
+			(low, high) = self._chunks.chunk_box(chunk)
+			self._grid.prefetch(low, high)
+	
+	
+	def render_box(self, viewport, low, high):
+		"""
+		This function calls the render function of the voxels between the low
+		and the one past the high coordinates onto a given viewport, back to front.
+		"""
+		type_ids = self._grid.read_box('type_ids', low, high)
+		
+		#void never renders anything so it is skipped without looking at it
+		if self._occlusion_culling:
+			voxels = self._unoccluded(low, high, type_ids)
+		
+		else:
+			voxels = zip(*type_ids.nonzero())
+		
+		if PROFILER.enabled:
+			PROFILER.count('voxels_visited', len(voxels))
+		
+		for oz, oy, ox in voxels:
+			voxel = self._grid[self._coordinate_to_index((low[X] + ox, low[Y] + oy, low[Z] + oz))]
 			
 			#Make sure it does not render anything else
 			if isinstance(voxel, ElementaryVoxel):
-				#Also make sure that only voxels in the view are rendered
-				#if viewport.scene_to_global(viewport.scene.get_rect()).colliderect(viewport.global_to_scene(voxel.rect)):
 				voxel.on_render(viewport)
 	
 	
+	def drawn_in_box(self, low, high):
+		"""
+		Returns a [z, y, x] mask of the voxels between the low and the one past the
+		high coordinates that draw anything at all, occluded or not.
+		"""
+		return self._drawn_mask(low, high, self._grid.read_box('type_ids', low, high))[0]
+	
+	
+	def _drawn_mask(self, low, high, type_ids):
+		"""
+		Returns the drawn, the rendered and the block masks of a box for drawn_in_box and _unoccluded.
+		"""
+		is_block = self._type_mask(Block, low, (high[X] - 1, high[Y] - 1, high[Z] - 1), 0)
+		rendered = (self._grid.read_box('flags', low, high) & RENDERED).astype(bool)
+		return (type_ids != 0) & (rendered | ~is_block), rendered, is_block
+	
+	
+	def _unoccluded(self, low, high, type_ids):
+		"""
+		Returns the (oz, oy, ox) offsets of the voxels between the low and the one
+		past the high coordinates that draw anything at all in the order they are
+		drawn, see visibility.unoccluded.
+		"""
+		last = (high[X] - 1, high[Y] - 1, high[Z] - 1)
+		is_opaque = self._class_mask(lambda element_class: issubclass(element_class, Block) and element_class.opaque,
+		                             low, last, 0)
+		(drawn, rendered, is_block) = self._drawn_mask(low, high, type_ids)
+		(oz, oy, ox) = visibility.unoccluded(drawn, is_opaque & rendered, ~is_block)
+		if PROFILER.enabled:
+			PROFILER.count('voxels_culled', int(drawn.sum()) - len(oz))
+		
+		return zip(oz, oy, ox)
+	
+	
+	def voxels_in_rect(self, rect):
+		"""
+		Yields the coordinates and the voxels whose sprite is in the given rect
+		of global coordinates, back to front. Void is left out.
+		"""
+		storage = self._grid
+		for coordinate in self.screen_index.voxels_in_rect(rect, 0, self.get_visible_top()):
+			index = self._coordinate_to_index(coordinate)
+			if storage.get_type_id(index):
+				voxel = self._grid[index]
+				if voxel.rect.colliderect(rect):
+					yield coordinate, voxel
+	
+	
+	def has_voxels_in_box(self, low, high):
+		return self._grid.read_box('type_ids', low, high).any()
+	
+	
+	def fill_from_array(self, type_array, palette, low = (0, 0, 0)):
+		"""
+		Fills a box of the world in one go. type_array is a (depth, height, width)
+		array of indexes into palette, which is a list of voxel ids of the voxel
+		handler, the box starts at the low coordinate. The on_create and on_destroy
+		hooks are not called, the visibility is updated once at the end instead.
+		"""
+		type_array = np.asarray(type_array)
+		(d, h, w) = type_array.shape
+		high = (low[X] + w - 1, low[Y] + h - 1, low[Z] + d - 1)
+		try:
+			self._validate_coordinate(low)
+			self._validate_coordinate(high)
+		
+		except OutOfIt as out_of_this_world:
+			print(out_of_this_world)
+			return
+		
+		#the type ids and the state each voxel type starts out with
+		storage = self._grid
+		palette_ids = np.array([storage.palette_id(voxel_id) for voxel_id in palette], dtype = DTYPES['type_ids'])
+		states = [self.element_class_handler.construct_element(voxel_id)._get_state() for voxel_id in palette]
+		start_flags = np.array([flags for (flags, outline) in states], dtype = DTYPES['flags'])
+		start_outlines = np.array([outline for (flags, outline) in states], dtype = DTYPES['outlines'])
+		
+		storage.write_box('type_ids', low, palette_ids[type_array])
+		storage.write_box('flags', low, start_flags[type_array])
+		storage.write_box('outlines', low, start_outlines[type_array])
+		
+		#the voxels that were kept as objects in the box are gone and so are their schedules
+		storage.forget_box(low, high)
+		for index in self._scheduler.keys_in_box(low, high):
+			self._scheduler.unschedule(index)
+		
+		for py in xrange(low[Y] / COLUMN_PAGE, high[Y] / COLUMN_PAGE + 1):
+			for px in xrange(low[X] / COLUMN_PAGE, high[X] / COLUMN_PAGE + 1):
+				page = self._column_tops.get((px, py))
+				if page is not None:
+					page[max(low[Y] - py * COLUMN_PAGE, 0):high[Y] + 1 - py * COLUMN_PAGE,
+					     max(low[X] - px * COLUMN_PAGE, 0):high[X] + 1 - px * COLUMN_PAGE] = UNKNOWN_TOP
+		self.schedule_box(low, high)
+		
+		#the visibility of the voxels right around the box depends on it too
+		self.update_visibility((low[X] - 1, low[Y] - 1, low[Z] - 1), (high[X] + 1, high[Y] + 1, high[Z] + 1))
+	
+	
+	def fill_from_heightmap(self, heightmap, voxel_id):
+		"""
+		Fills the world from a (height, width) array of column heights, every column
+		is filled with voxel_id from the bottom up to its height and void above.
+		"""
+		heightmap = np.asarray(heightmap)
+		layers = np.arange(self._world_dimensions[DEPTH]).reshape((-1, 1, 1))
+		self.fill_from_array((layers < heightmap).astype(np.uint8), ['void', voxel_id])
+	
+	
+	def update_visibility(self, low = None, high = None):
+		"""
+		Updates the outlines and the visibility of all the blocks between the low
+		and high coordinates (both inclusive, defaults to the whole world) in one go.
+		Gives the same results as calling Block.update_visibility on every block
+		until nothing changes, the outlines of the blocks right around the box
+		are updated too since they depend on what is rendered in the box.
+		"""
+		(w, h, d) = self._world_dimensions
+		low = (0, 0, 0) if low is None else tuple(max(low[i], 0) for i in (X, Y, Z))
+		high = (w - 1, h - 1, d - 1) if high is None else tuple(min(high[i], self._world_dimensions[i] - 1) for i in (X, Y, Z))
+		if low[X] > high[X] or low[Y] > high[Y] or low[Z] > high[Z]:
+			return
+		
+		#first the rendered flags of the blocks in the box
+		is_block = self._type_mask(Block, low, high, 1)
+		if self.visibility_flag == ONLY_SHOW_EXPOSED:
+			rendered = visibility.exposed_blocks(is_block, self._type_mask(Void, low, high, 1))
+		
+		else:
+			rendered = np.ones(visibility.neighbour(is_block, 0, 0, 0).shape, dtype = bool)
+		
+		is_block = visibility.neighbour(is_block, 0, 0, 0)
+		box_flags = self._grid.read_box('flags', low, (high[X] + 1, high[Y] + 1, high[Z] + 1)).copy()
+		box_flags[rendered] |= RENDERED
+		box_flags[~rendered] &= ~RENDERED & 0xff
+		self._grid.write_box('flags', low, box_flags, is_block)
+		
+		#then the outlines of the blocks in the box and around it
+		low = tuple(max(low[i] - 1, 0) for i in (X, Y, Z))
+		high = tuple(min(high[i] + 1, self._world_dimensions[i] - 1) for i in (X, Y, Z))
+		is_rendered = (self._grid.read_box('flags', (low[X] - 1, low[Y] - 1, low[Z] - 1),
+		                                   (high[X] + 2, high[Y] + 2, high[Z] + 2)) & RENDERED).astype(bool)
+		is_block = visibility.neighbour(self._type_mask(Block, low, high, 1), 0, 0, 0)
+		self._grid.write_box('outlines', low, visibility.dark_outlines(is_rendered), is_block)
+		
+		self._chunks.invalidate_box(low, high)
+		self._damage(self.box_rect(low, high))
+	
+	
+	def _type_mask(self, voxel_class, low, high, margin):
+		"""
+		Returns a bool array of where the voxels between the low and high coordinates
+		(both inclusive) grown by margin are of the given class, indexed [z, y, x].
+		"""
+		return self._class_mask(lambda element_class: issubclass(element_class, voxel_class), low, high, margin)
+	
+	
+	def _class_mask(self, predicate, low, high, margin):
+		"""
+		The same as _type_mask for the voxels whose class the predicate is True for.
+		"""
+		storage = self._grid
+		palette = storage.get_palette()
+		
+		#outside of the world gets the id one past the palette which is not of any class
+		is_class = np.array([predicate(self.element_class_handler.get_element_class(element_id))
+		                     for element_id in palette] + [False], dtype = bool)
+		mask = is_class[storage.read_box('type_ids', tuple(low[i] - margin for i in (X, Y, Z)),
+		                                 tuple(high[i] + margin + 1 for i in (X, Y, Z)), len(palette))]
+		
+		#the voxels of classes the handler does not know are not of the class of their type id
+		for index, voxel in storage.unregistered_in_box(tuple(low[i] - margin for i in (X, Y, Z)),
+		                                                tuple(high[i] + margin for i in (X, Y, Z))):
+			(mx, my, mz) = self._index_to_coordinate(index)
+			mask[mz - low[Z] + margin, my - low[Y] + margin, mx - low[X] + margin] = predicate(type(voxel))
+		
+		return mask
+	
+	
+	def get_visible_top(self):
+		"""
+		Returns the highest layer that is rendered.
+		"""
+		if self.visibility_flag == ONLY_SHOW_EXPOSED:
+			return self._active_layer
+		
+		return self._world_dimensions[DEPTH] - 1
+	
+	
+	def invalidate(self, coordinate):
+		"""
+		Marks the voxel at the given coordinate as changed so it is rendered again.
+		"""
+		self._chunks.invalidate(coordinate)
+		self._damage(self.box_rect(coordinate, coordinate))
+	
+	
+	def _element_replaced(self, coordinate, voxel):
+		#the schedule of the old voxel ends, the new one can schedule itself in on_create
+		index = self._coordinate_to_index(coordinate)
+		self._scheduler.unschedule(index)
+		interval = self._update_interval(type(voxel))
+		if interval:
+			self._scheduler.schedule(index, interval)
+		
+		#a voxel above the top is the new top, taking away the top means looking again
+		(mx, my, mz) = coordinate
+		page = self._column_tops.get((mx / COLUMN_PAGE, my / COLUMN_PAGE))
+		if page is None:
+			return
+		
+		(cx, cy) = (mx % COLUMN_PAGE, my % COLUMN_PAGE)
+		top = page[cy, cx]
+		if top != UNKNOWN_TOP:
+			if self._grid.get_type_id(index) != 0:
+				page[cy, cx] = max(top, mz)
+			
+			elif mz == top:
+				page[cy, cx] = UNKNOWN_TOP
+	
+	
+	def column_top(self, mx, my):
+		"""
+		Returns the highest layer that is not void in the column at (mx, my), -1
+		if the whole column is void or outside of the world. Columns are looked
+		at the first time they are asked about and kept up to date on edits.
+		"""
+		if not (0 <= mx < self._world_dimensions[WIDTH] and 0 <= my < self._world_dimensions[HEIGHT]):
+			return -1
+		
+		key = (mx / COLUMN_PAGE, my / COLUMN_PAGE)
+		page = self._column_tops.get(key)
+		if page is None:
+			page = self._column_tops[key] = np.empty((COLUMN_PAGE, COLUMN_PAGE), dtype = np.int16)
+			page.fill(UNKNOWN_TOP)
+		
+		(cx, cy) = (mx % COLUMN_PAGE, my % COLUMN_PAGE)
+		top = page[cy, cx]
+		if top == UNKNOWN_TOP:
+			column = self._grid.read_box('type_ids', (mx, my, 0), (mx + 1, my + 1, self._world_dimensions[DEPTH]))
+			layers = column[:, 0, 0].nonzero()[0]
+			top = layers[-1] if len(layers) else -1
+			page[cy, cx] = top
+		
+		return top
+	
+	
+	def _element_changed(self, coordinate):
+		#the voxels around it might look different as well
+		(mx, my, mz) = coordinate
+		self._chunks.invalidate_box((mx - 1, my - 1, mz - 1), (mx + 1, my + 1, mz + 1))
+		self._damage(self.box_rect((mx - 1, my - 1, mz - 1), (mx + 1, my + 1, mz + 1)))
+	
+	
+	def _elements_changed(self, coordinates):
+		#the blocks left the visibility to this, one update per chunk around what changed in it
+		boxes = {}
+		for coordinate in coordinates:
+			chunk = self._chunks.chunk_of(coordinate)
+			(low, high) = boxes.get(chunk, (coordinate, coordinate))
+			boxes[chunk] = (tuple(min(low[i], coordinate[i]) for i in (X, Y, Z)),
+			                tuple(max(high[i], coordinate[i]) for i in (X, Y, Z)))
+		
+		for low, high in boxes.itervalues():
+			self.update_visibility((low[X] - 1, low[Y] - 1, low[Z] - 1), (high[X] + 1, high[Y] + 1, high[Z] + 1))
+	
+	
+	def box_rect(self, low, high):
+		"""
+		Returns the rect in global coordinates that the sprites of all the voxels
+		between the low and high coordinates (both inclusive) fit into.
+		"""
+		(w, h, d) = self._voxel_dimensions
+		left = self.map_to_global(high[X], low[Y], 0)[X]
+		right = self.map_to_global(low[X], high[Y], 0)[X] + w
+		top = self.map_to_global(low[X], low[Y], high[Z])[Y]
+		bottom = self.map_to_global(high[X], high[Y], low[Z])[Y] + h + d
+		return pygame.Rect(left, top, right - left, bottom - top)
+	
+	
 	def on_event(self, event):
 		pass
 	
@@ -76,24 +578,82 @@ class VoxelWorld(WorldBase):
 	
 	
 	def is_voxel_rendered(self, coordinate):
-		try:
-			return self[coordinate].is_rendered()
+		index = self._index_unchecked(coordinate)
+		return index is not None and bool(self._grid.get_flags(index) & RENDERED)
+	
+	
+	def get_unchecked(self, coordinate):
+		"""
+		Returns the voxel at the given coordinate like indexing the world does but
+		without validating the coordinate, None if it is outside of the world.
+		Never raises or prints anything so it is fine for probing around edges.
+		"""
+		index = self._index_unchecked(coordinate)
+		if index is None:
+			return None
 		
-		except AttributeError:
-			return False
+		return self._grid[index]
+	
+	
+	def neighbours(self, coordinate):
+		"""
+		Returns the 26 voxels around the given coordinate in a dict keyed by
+		their (dx, dy, dz) offset, the ones outside of the world are None.
+		"""
+		(mx, my, mz) = coordinate
+		return dict(((dx, dy, dz), self.get_unchecked((mx + dx, my + dy, mz + dz)))
+		            for dz in (-1, 0, 1) for dy in (-1, 0, 1) for dx in (-1, 0, 1) if dx or dy or dz)
+	
+	
+	def surroundings(self, coordinate):
+		"""
+		Returns bool arrays of where the voxels of the 3x3x3 box around the given
+		coordinate are rendered, blocks and void, indexed [z, y, x]. The box is
+		padded with cells that are none of these where it is outside of the world,
+		the way the visibility module expects it.
+		"""
+		(mx, my, mz) = coordinate
+		rendered = (self._grid.read_box('flags', (mx - 1, my - 1, mz - 1), (mx + 2, my + 2, mz + 2)) & RENDERED).astype(bool)
+		return rendered, self._type_mask(Block, coordinate, coordinate, 1), self._type_mask(Void, coordinate, coordinate, 1)
 	
 	
 	def is_top_layer(self, coordinate):
 		return coordinate[DEPTH] == self._active_layer
 	
 	
+	def _create_grid(self, grid_length):
+		if self._storage_factory:
+			return self._storage_factory(self)
+		
+		return DenseVoxelStorage(self, self.element_class_handler, self._world_dimensions)
+	
+	
 	def _coordinate_to_index(self, coordinate):
 		"""
 		Calculates the index in the list holding the _grid based on x, y and z 
 		coordinates. z major y secondary and x minor
 		"""
 		(x, y, z) = coordinate
-		return self._world_dimensions[WIDTH] * self._world_dimensions[HEIGHT] * z + self._world_dimensions[HEIGHT] * y + x
+		return self._world_dimensions[WIDTH] * self._world_dimensions[HEIGHT] * z + self._world_dimensions[WIDTH] * y + x
+	
+	
+	def _index_unchecked(self, coordinate):
+		#the same as _coordinate_to_index but None outside of the world
+		(x, y, z) = coordinate
+		(w, h, d) = self._world_dimensions
+		if 0 <= x < w and 0 <= y < h and 0 <= z < d:
+			return w * h * z + w * y + x
+		
+		return None
+	
+	
+	def _index_to_coordinate(self, index):
+		"""
+		The inverse of _coordinate_to_index.
+		"""
+		(z, rest) = divmod(index, self._world_dimensions[WIDTH] * self._world_dimensions[HEIGHT])
+		(y, x) = divmod(rest, self._world_dimensions[WIDTH])
+		return (x, y, z)
 	
 	
 	def _validate_coordinate(self, coordinate):
@@ -124,29 +684,71 @@ class VoxelWorld(WorldBase):
 	def global_to_map(self, global_coordinates):
 		"""
 		Maps global coordinates to map coordinates. Mainly used to tell which 
-		voxel the mouse pointer is on. Implementation based on article:
-                http://www.alcove-games.com/advanced-tutorials/isometric-tile-picking/
+		voxel the mouse pointer is on, the one whose top is under the point on
+		the active layer, see the picking module.
 		"""
 		(gx, gy) = global_coordinates
 		
-                #depth info comes from the currently activated layer
-                mz = self._active_layer
-                
-                #turn the global coordinates into a homogenous vector
-                g_coord = mp.matrix([[gx], 
-                                     [gy + mz * self._voxel_dimensions[DEPTH]], 
-                                     [1]])
-                
-                #Apply the isometric unprojection matrix from common_util
-                g_coord = UNPROJECT * g_coord
-                
-                #divide and round the coordinates to get integer indexes.
-		mx = int(mp.nint(g_coord[X]) / self._side_length)
-                my = int(mp.nint(g_coord[Y]) / self._side_length)
-		
+		#depth info comes from the currently activated layer
+		mz = self._active_layer
+		(mx, my) = self.get_picking_table().pick(gx + self._voxel_dimensions[WIDTH] / 2,
+		                                         gy + mz * self._voxel_dimensions[DEPTH])
 		return (mx, my, mz)
 	
 	
+	def global_to_map_array(self, global_points):
+		"""
+		The same as global_to_map for a whole (n, 2) array of global coordinates
+		at once, returns an (n, 3) array of map coordinates.
+		"""
+		global_points = np.asarray(global_points).reshape((-1, 2))
+		map_points = np.empty((len(global_points), 3), dtype = np.int64)
+		(map_points[:, X], map_points[:, Y]) = self.get_picking_table().pick_array(
+			global_points[:, X] + self._voxel_dimensions[WIDTH] / 2,
+			global_points[:, Y] + self._active_layer * self._voxel_dimensions[DEPTH])
+		map_points[:, Z] = self._active_layer
+		return map_points
+	
+	
+	def pick(self, global_coordinates):
+		"""
+		Returns the map coordinates of the voxel that is drawn at the given global
+		coordinates, None if there is none. Unlike global_to_map this follows the
+		view ray down from the visible top through all the layers.
+		"""
+		(gx, gy) = global_coordinates
+		(w, h, d) = self._voxel_dimensions
+		mz = self.get_visible_top()
+		(mx, my) = self.get_picking_table().pick(gx + w / 2, gy + mz * d)
+		
+		#the sides of a voxel cover half of the top of the one in front of it on
+		#the same layer and the lower half of its sprite is where the top of the
+		#one behind it is, a layer down the ray moves back one on both x and y
+		#(this needs voxels as deep as their tops are high, like the default ones)
+		if gx < self.map_to_global(mx, my, mz)[X] + w / 2:
+			ray = ((0, 0), (0, -1), (-1, -1))
+		
+		else:
+			ray = ((0, 0), (-1, 0), (-1, -1))
+		
+		#front to back, the first voxel that is drawn is the one on top
+		while mz >= 0:
+			for dx, dy in ray:
+				if self.column_top(mx + dx, my + dy) >= mz and self.is_voxel_rendered((mx + dx, my + dy, mz)):
+					return (mx + dx, my + dy, mz)
+			
+			(mx, my, mz) = (mx - 1, my - 1, mz - 1)
+		
+		return None
+	
+	
+	def get_picking_table(self):
+		if self._picking_table is None:
+			self._picking_table = PickingTable(self._voxel_dimensions[:2], self.resource_handler.get_image('mouse-help'))
+		
+		return self._picking_table
+	
+	
 	def map_to_global(self, mx, my, mz):
 		"""
 		Maps world coordinates the coordinates of the top left corner of the image on the world surface.
@@ -162,17 +764,83 @@ class VoxelWorld(WorldBase):
 
 
 class ElementaryVoxel(GridElement):
+	#Voxels of a class with an update interval get their on_update called every
+	#update_interval world updates, the rest only when they schedule it with
+	#schedule_update. Classes that override on_update default to every update.
+	update_interval = None
+	
 	def __init__(self, voxel_id, dimensions = (72, 36, 36)):
 		self._dimensions = dimensions
 		self._image_size = (dimensions[WIDTH], dimensions[HEIGHT] + dimensions[DEPTH])
 		self._coordinates = (0, 0, 0)
 		self._screen_coordinates = (0, 0)
-		self.rect = pygame.Rect(self._screen_coordinates, self._image_size)
 		
 		self._world = None
+		self._index = None
 		self._voxel_id = voxel_id
-		self._highlighted = False
-		self._rendered = False
+		
+		#state used until the voxel is put into a world, after that it lives in the world's storage
+		self._local_flags = 0
+		self._local_outline = 0
+	
+	
+	@property
+	def rect(self):
+		return pygame.Rect(self._screen_coordinates, self._image_size)
+	
+	
+	@property
+	def _rendered(self):
+		return self._get_flag(RENDERED)
+	
+	
+	@_rendered.setter
+	def _rendered(self, value):
+		self._set_flag(RENDERED, value)
+	
+	
+	@property
+	def _highlighted(self):
+		return self._get_flag(HIGHLIGHTED)
+	
+	
+	@_highlighted.setter
+	def _highlighted(self, value):
+		self._set_flag(HIGHLIGHTED, value)
+	
+	
+	def _get_flag(self, flag):
+		if self._index is None:
+			return bool(self._local_flags & flag)
+		
+		return bool(self._world._grid.get_flags(self._index) & flag)
+	
+	
+	def _set_flag(self, flag, value):
+		if self._index is None:
+			flags = self._local_flags
+		
+		else:
+			flags = self._world._grid.get_flags(self._index)
+		
+		flags = flags | flag if value else flags & ~flag
+		
+		if self._index is None:
+			self._local_flags = flags
+		
+		else:
+			self._world._grid.set_flags(self._index, flags)
+	
+	
+	def _get_state(self):
+		"""
+		Returns the flags and the outline mask of the voxel wherever they are kept at the moment.
+		"""
+		if self._index is None:
+			return (self._local_flags, self._local_outline)
+		
+		storage = self._world._grid
+		return (storage.get_flags(self._index), storage.get_outline(self._index))
 	
 	
 	def is_rendered(self):
@@ -182,13 +850,29 @@ class ElementaryVoxel(GridElement):
 	def put_into_world(self, world, x, y, z):
 		self._coordinates = (x, y, z)
 		self._world = world
+		self._index = world._coordinate_to_index(self._coordinates)
 		self._screen_coordinates = self._world.map_to_global(*self._coordinates)
-		self.rect = pygame.Rect(self._screen_coordinates, self._image_size)
 	
 	
 	def highlight(self):
 		self._highlighted = not self._highlighted
 		#print 'highlighting {0}'.format(self)
+		if self._world:
+			self._world.invalidate(self._coordinates)
+	
+	
+	def schedule_update(self, interval = 1, delay = 0):
+		"""
+		Asks the world to call on_update every interval updates, or just once if
+		interval is None, starting delay updates after the next one.
+		"""
+		if self._world:
+			self._world.schedule_update(self._coordinates, interval, delay)
+	
+	
+	def unschedule_update(self):
+		if self._world:
+			self._world.unschedule_update(self._coordinates)
 	
 	
 	def on_update(self):
@@ -222,59 +906,55 @@ class ElementaryVoxel(GridElement):
 
 
 
+#the attributes every voxel gets, anything more is state of its own
+ElementaryVoxel._base_attributes = frozenset(vars(ElementaryVoxel('void')))
+
+
+
 class Block(ElementaryVoxel):
+	#Blocks hide what is behind them when they are drawn over it, set this to
+	#False in subclasses with images that are not opaque all over their hexagon.
+	opaque = True
+	
 	def __init__(self, voxel_id, dimensions = (72, 36, 36)):
 		ElementaryVoxel.__init__(self, voxel_id, dimensions)
-		self._dark_outline = [False] * 6
+		self._dark_outline = 0
 		self._rendered = True
 	
 	
+	@property
+	def _dark_outline(self):
+		"""
+		A 6 bit mask, bit i is set if the i-th dark outline is drawn.
+		"""
+		if self._index is None:
+			return self._local_outline
+		
+		return self._world._grid.get_outline(self._index)
+	
+	
+	@_dark_outline.setter
+	def _dark_outline(self, mask):
+		if self._index is None:
+			self._local_outline = mask
+		
+		else:
+			self._world._grid.set_outline(self._index, mask)
+	
+	
 	def update_visibility(self):
-		self._dark_outline = [False] * 6
-		(mx, my, mz) = self._coordinates
-		#print 'coordinates: {0}, {1}, {2}'.format(*self._coordinates)
-		if not self._world.is_voxel_rendered((mx, my - 1, mz)):
-			#print '\tNothing behind'
-			if not self._world.is_voxel_rendered((mx + 1, my - 1, mz)):
-				#print '\t\tNothing to the left'
-				self._dark_outline[5] = True
-			
-			if not self._world.is_voxel_rendered((mx, my - 1, mz + 1)):
-				#print '\t\tNothing over'
-				self._dark_outline[0] = True
-		
-		if not self._world.is_voxel_rendered((mx - 1, my, mz)):
-			#print '\tNothing to the right'
-			if not self._world.is_voxel_rendered((mx - 1, my + 1, mz)):
-				#print '\t\tNothing infront'
-				self._dark_outline[2] = True
-			
-			if not self._world.is_voxel_rendered((mx - 1, my, mz + 1)):
-				#print '\t\tNothing over'
-				self._dark_outline[1] = True
-		
-		if not self._world.is_voxel_rendered((mx, my, mz - 1)):
-			if not self._world.is_voxel_rendered((mx, my + 1, mz)):
-				if not self._world.is_voxel_rendered((mx, my + 1, mz -1)):
-					self._dark_outline[3] = True
-			
-			if not self._world.is_voxel_rendered((mx + 1, my, mz)):
-				if not self._world.is_voxel_rendered((mx + 1, my, mz -1)):
-					self._dark_outline[4] = True
+		old_state = self._get_state()
+		(rendered, is_block, is_void) = self._world.surroundings(self._coordinates)
+		self._dark_outline = int(visibility.dark_outlines(rendered)[0, 0, 0])
 		
 		if self._world.visibility_flag == ONLY_SHOW_EXPOSED:
-			if (isinstance(self._world[(mx, my, mz + 1)], Block) and
-			  not isinstance(self._world[(mx + 1, my, mz)], Void) and
-			  not isinstance(self._world[(mx, my + 1, mz)], Void) and
-			  not isinstance(self._world[(mx - 1, my, mz)], Void) and
-			  not isinstance(self._world[(mx, my - 1, mz)], Void)):
-				self._rendered = False
-			
-			else:
-				self._rendered = True
+			self._rendered = bool(visibility.exposed_blocks(is_block, is_void)[0, 0, 0])
 		
 		else:
 			self._rendered = True
+		
+		if self._get_state() != old_state:
+			self._world.invalidate(self._coordinates)
 	
 	
 	def on_render(self, viewport):
@@ -284,55 +964,44 @@ class Block(ElementaryVoxel):
 		
 		coordinates = (int((self._screen_coordinates[X] + viewport.scene_placement[X]) * viewport.scene_scale), int((self._screen_coordinates[Y] + viewport.scene_placement[Y]) * viewport.scene_scale))
 		
-		target_surface = pygame.Surface(self.rect.size, flags = pygame.SRCALPHA)
-		
-		#blit the base image
-		target_surface.blit(self._world.resource_handler.get_image(self._voxel_id), (0, 0))
-		
-		#blit the dark outlines
+		#the top layer also gets the back outlines where there is nothing behind it
 		(mx, my, mz) = self._coordinates
-		for i in xrange(len(self._dark_outline)):
-			if self._dark_outline[i]:
-				target_surface.blit(self._world.resource_handler.get_image('overlay-dark-outline-{0}'.format(i)), (0, 0))
+		outline = self._dark_outline
+		if self._world.is_top_layer((mx, my, mz)):
+			if not outline & 1 and not self._world.is_voxel_rendered((mx, my - 1, mz)):
+				outline |= 1
 			
-			elif (i == 0 or i == 1) and self._world.is_top_layer((mx, my, mz)):
-				if i == 0 and not self._world.is_voxel_rendered((mx, my - 1, mz)):
-					target_surface.blit(self._world.resource_handler.get_image('overlay-dark-outline-{0}'.format(i)), (0, 0))
-				
-				elif i == 1 and not self._world.is_voxel_rendered((mx - 1, my, mz)):
-					target_surface.blit(self._world.resource_handler.get_image('overlay-dark-outline-{0}'.format(i)), (0, 0))
+			if not outline & 2 and not self._world.is_voxel_rendered((mx - 1, my, mz)):
+				outline |= 2
 		
-		#blit the highlight
-		#NOTE: do not rely on this it will be removed
-		if self._highlighted:
-			target_surface.blit(self._world.resource_handler.get_image('overlay-yellow-highlight'), (0, 0))
+		#NOTE: do not rely on the highlight it will be removed
+		sprite = self._world.sprite_cache.get_sprite(self._voxel_id, outline, self._highlighted,
+		                                             self._image_size, viewport.scene_scale)
+		viewport.scene.blit(sprite, coordinates)
 		
-		target_surface = pygame.transform.scale(target_surface, (int(self.rect.w * viewport.scene_scale), int(self.rect.h * viewport.scene_scale)))
-		viewport.scene.blit(target_surface, coordinates)
+		if PROFILER.enabled:
+			PROFILER.count('voxels_drawn')
+			PROFILER.count('blits')
 	
 	
 	def on_create(self):
+		#in a transaction the world updates the visibility of everything at the end
+		if self._world._transaction_depth:
+			return
+		
+		#update own outlines and the visibility of all of the voxels around
 		(mx, my, mz) = self._coordinates
-		#update own outlines
-		self.update_visibility()
-		#Update the visibility on all of the voxels around
-		for ox in xrange(-1, 2):
-			for oy in xrange(-1, 2):
-				for oz in xrange(-1, 2):
-					voxel = self._world[(mx + ox, my + oy, mz + oz)]
-					if isinstance(voxel, Block):
-						voxel.update_visibility()
+		self._world.update_visibility((mx - 1, my - 1, mz - 1), (mx + 1, my + 1, mz + 1))
 	
 	
 	def on_destroy(self):
-		(mx, my, mz) = self._coordinates
+		#a block that replaced it updates the same box in its on_create
+		if self._world._transaction_depth or isinstance(self._world.get_unchecked(self._coordinates), Block):
+			return
+		
 		#Update the visibility on all of the voxels around
-		for ox in xrange(-1, 2):
-			for oy in xrange(-1, 2):
-				for oz in xrange(-1, 2):
-					voxel = self._world[(mx + ox, my + oy, mz + oz)]
-					if isinstance(voxel, Block):
-						voxel.update_visibility()
+		(mx, my, mz) = self._coordinates
+		self._world.update_visibility((mx - 1, my - 1, mz - 1), (mx + 1, my + 1, mz + 1))
 	
 	
 
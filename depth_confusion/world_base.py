@@ -2,6 +2,7 @@
 Author: Huba Nagy
 """
 import pygame
+from collections import OrderedDict
 from common_util import *
 
 
@@ -18,7 +19,21 @@ class WorldBase(object):
 		self.resource_handler = resource_handler
 		self.element_class_handler = element_class_handler
 		
-		self._grid = [None] * grid_length
+		#lists of the global rects that changed, one for everyone who keeps track
+		self._damage_lists = []
+		
+		#coordinate: (element before the transaction, element now) of the open transaction
+		self._transaction_depth = 0
+		self._pending = OrderedDict()
+		
+		self._grid = self._create_grid(grid_length)
+	
+	
+	def _create_grid(self, grid_length):
+		"""
+		Creates the container the grid elements are kept in, a plain list by default.
+		"""
+		return [None] * grid_length
 	
 	
 	def on_update(self):
@@ -29,6 +44,51 @@ class WorldBase(object):
 		pass
 	
 	
+	def prefetch(self, rect):
+		"""
+		A hint from the viewports that the part of the world in and around a rect
+		of global coordinates is about to be rendered.
+		"""
+		pass
+	
+	
+	def scene_blits(self, viewport, rect = None):
+		"""
+		Returns the (surface, scene position) pairs that on_render would blit onto
+		the scene of the viewport in order, or None for a world that draws more
+		than the surfaces it keeps and has to be rendered with on_render.
+		"""
+		return None
+	
+	
+	def track_damage(self):
+		"""
+		Returns a list that the global rects of everything that changes in the
+		world get added to from now on, None in it means that everything changed.
+		It is up to the caller to empty it once it has dealt with the changes.
+		"""
+		damage = []
+		self._damage_lists.append(damage)
+		return damage
+	
+	
+	def untrack_damage(self, damage):
+		self._damage_lists.remove(damage)
+	
+	
+	def _damage(self, rect):
+		for damage in self._damage_lists:
+			if damage and damage[0] is None:
+				continue
+			
+			#no point in keeping lots of small rects if everything changed anyway
+			if rect is None or len(damage) >= 256:
+				damage[:] = [None]
+			
+			else:
+				damage.append(rect)
+	
+	
 	def __iter__(self):
 		"""
 		Simply returns an iterator of the _grid, different types of worlds would need
@@ -50,11 +110,18 @@ class WorldBase(object):
 			#replace the given grid element
 			self._grid[index] = grid_element
 			grid_element.put_into_world(self, *coordinate)
+			self._element_replaced(coordinate, grid_element)
+			
+			if self._transaction_depth:
+				#the hooks run when the transaction ends, on the element that was there before it
+				self._pending[coordinate] = (self._pending.get(coordinate, (old_element, None))[0], grid_element)
+				return
 			
 			if old_element:
 				old_element.on_destroy()
 			
 			grid_element.on_create()
+			self._element_changed(coordinate)
 		
 		except OutOfIt as out_of_this_world:
 			print(out_of_this_world)
@@ -90,10 +157,68 @@ class WorldBase(object):
 		Replaces the element at the given grid coordinate with
 		the void type element of the element_class_handler...
 		"""
-                self[coordinate].on_destroy()
 		self[coordinate] = self.element_class_handler.construct_element('void')
 	
 	
+	def transaction(self):
+		"""
+		Returns a context manager that defers the on_destroy and on_create hooks
+		of the elements replaced in it until it ends, then runs them once for every
+		coordinate that changed. Transactions can be nested, the outermost one runs
+		the hooks.
+		
+			with world.transaction():
+				for coordinate in crater:
+					del world[coordinate]
+		"""
+		return _Transaction(self)
+	
+	
+	def _commit(self):
+		"""
+		Runs the hooks the transaction deferred, elements replaced by the hooks
+		are deferred again and get their hooks run right after.
+		"""
+		self._transaction_depth += 1
+		try:
+			while self._pending:
+				(pending, self._pending) = (self._pending, OrderedDict())
+				for old_element, grid_element in pending.itervalues():
+					if old_element:
+						old_element.on_destroy()
+				
+				for old_element, grid_element in pending.itervalues():
+					grid_element.on_create()
+				
+				self._elements_changed(pending.keys())
+		
+		finally:
+			self._transaction_depth -= 1
+	
+	
+	def _element_replaced(self, coordinate, grid_element):
+		"""
+		Called right after the element at the given coordinate has been replaced
+		with grid_element, before the on_destroy and on_create hooks run.
+		"""
+		pass
+	
+	
+	def _element_changed(self, coordinate):
+		"""
+		Called after the element at the given coordinate has been replaced.
+		"""
+		pass
+	
+	
+	def _elements_changed(self, coordinates):
+		"""
+		Called once a transaction has run the hooks of the replaced elements.
+		"""
+		for coordinate in coordinates:
+			self._element_changed(coordinate)
+	
+	
 	def _validate_coordinate(self, coordinate):
 		pass
 	
@@ -105,15 +230,60 @@ class WorldBase(object):
 
 
 
+class _Transaction(object):
+	"""
+	What WorldBase.transaction returns.
+	"""
+	def __init__(self, world):
+		self._world = world
+	
+	
+	def __enter__(self):
+		self._world._transaction_depth += 1
+		return self._world
+	
+	
+	def __exit__(self, exc_type, exc_value, traceback):
+		#the elements are already replaced so the hooks run even if something went wrong
+		self._world._transaction_depth -= 1
+		if not self._world._transaction_depth:
+			self._world._commit()
+		
+		return False
+	
+	
+
+
+
 class GridElement(object):
 	"""
 	Avoid using this class at all cost similarly to WorldBase.
 	If you use it and it blows up on you it's your fault. :) Thanks.
 	"""
+	#The worlds only keep the objects of stateful elements, the others are rebuilt
+	#from their type whenever they are needed. Leave it at None to let the world
+	#tell from the attributes of the object, see is_stateful.
+	stateful = None
+	
+	#the names of the attributes the classes of this package give their objects
+	_base_attributes = frozenset()
+	
 	def __init__(self):
 		pass
 	
 	
+	def is_stateful(self):
+		"""
+		Whether the world has to keep this object instead of building it again
+		from its type. If the class does not say it is when the object has any
+		attribute beyond the ones every element of its kind gets.
+		"""
+		if self.stateful is None:
+			return not self._base_attributes.issuperset(self.__dict__)
+		
+		return self.stateful
+	
+	
 	def put_into_world(self, world, coordinate):
 		pass
 	
@@ -156,11 +326,28 @@ class GridElement(object):
 class ElementClassHandler:
 	def __init__(self, void_type):
 		self._element_types = {}
+		self._element_ids = {}
 		self.add_element_type('void', void_type)
 	
 	
 	def add_element_type(self, element_id, base_class):
 		self._element_types[element_id] = base_class
+		self._element_ids[base_class] = element_id
+	
+	
+	def get_element_id(self, element):
+		"""
+		Returns the id the class of the given element was added under,
+		None if it was never added to this handler.
+		"""
+		return self._element_ids.get(type(element))
+	
+	
+	def get_element_class(self, element_id):
+		"""
+		Returns the class added under the given id, the void class if there is none.
+		"""
+		return self._element_types.get(element_id, self._element_types['void'])
 	
 	
 	def construct_element(self, element_id, *args):
@@ -2,18 +2,26 @@
 A utility module for generating maps
 Author: Huba Nagy
 """
+import numpy as np
 import voxels
 from common_util import *
 
 
 def generate_flat(dimensions, fill_height, voxel_handler, image_handler, fill_voxel_id):
+	heightmap = np.empty((dimensions[HEIGHT], dimensions[WIDTH]), dtype = np.int32)
+	heightmap.fill(fill_height)
+	return generate_from_heightmap(heightmap, dimensions[DEPTH], voxel_handler, image_handler, fill_voxel_id)
+
+
+def generate_from_heightmap(heightmap, depth, voxel_handler, image_handler, fill_voxel_id):
+	"""
+	Generates a world as wide and high as the (height, width) heightmap, with
+	every column filled with fill_voxel_id up to its height.
+	"""
+	heightmap = np.asarray(heightmap)
 	#Hint: IRON MAIDEN Song and a novel that takes place in a futuristic dystopia
-	brave_new_world = voxels.VoxelWorld(image_handler, voxel_handler, world_dimensions = dimensions)
-	
-	for z in xrange(dimensions[DEPTH]):
-		for y in xrange(dimensions[HEIGHT]):
-			for x in xrange(dimensions[WIDTH]):
-				new_voxel = voxel_handler.construct_voxel('grass-block') if z < fill_height else voxel_handler.construct_voxel('void')
-				brave_new_world[(x, y, z)] = new_voxel
+	brave_new_world = voxels.VoxelWorld(image_handler, voxel_handler,
+	                                    world_dimensions = (heightmap.shape[1], heightmap.shape[0], depth))
+	brave_new_world.fill_from_heightmap(heightmap, fill_voxel_id)
 	
 	return brave_new_world
\ No newline at end of file
@@ -0,0 +1,343 @@
+"""
+Saves voxel worlds into a compact binary file and loads them back. The file
+starts with a header (the dimensions of the world and of the voxels, the
+chunk size, the active layer and the visibility flag), then comes the palette
+of voxel ids, a table of where every chunk is and then the chunks themselves,
+each one run length encoded. A chunk that is nothing but void takes no space.
+
+Loading memory maps the file and only decodes a chunk once something in it is
+touched, so even huge maps open right away. Only the types and the state in
+the storage are saved, the objects of stateful voxels are not. The voxels that
+update on their own are scheduled as their chunks are decoded, in a paged world
+they stop updating while their chunk is out of memory.
+
+	depth_confusion.world_io.save_world(world, 'map.dcw')
+	world = depth_confusion.world_io.load_world('map.dcw', image_handler, voxel_handler)
+	...
+	depth_confusion.world_io.close_world(world)
+
+Worlds bigger than the memory can be opened paged, only the chunks in use are
+kept in memory and the changed ones are written back to the file. Changed
+chunks are appended to the end of the file, saving the world again compacts it.
+
+	depth_confusion.world_io.create_world_file('continent.dcw', (8192, 8192, 32))
+	world = depth_confusion.world_io.open_paged_world('continent.dcw', image_handler, voxel_handler)
+	...
+	depth_confusion.world_io.close_paged_world(world)
+
+Author: Huba Nagy
+"""
+import mmap
+import struct
+import numpy as np
+import voxels
+from common_util import *
+from voxel_storage import LazyVoxelStorage, PagedVoxelStorage, pack_cells
+
+MAGIC = 'DCVW'
+VERSION = 1
+
+#magic, version, world dimensions, voxel dimensions, chunk dimensions, active
+#layer, visibility flag, where the palette is and how many voxel ids are in it
+#and where the chunk table is
+HEADER = struct.Struct('<4sH3I3I3HIBQIQ')
+
+#where the run length encoded data of a chunk is in the file and how long it is
+CHUNK_ENTRY = np.dtype([('offset', '<u8'), ('length', '<u4')])
+
+
+
+def encode_runs(cells):
+	"""
+	Run length encodes a flat uint32 array: the number of runs, the value of
+	every run and then the length of every run.
+	"""
+	starts = np.flatnonzero(np.concatenate(([True], cells[1:] != cells[:-1])))
+	lengths = np.diff(np.append(starts, len(cells)))
+	return struct.pack('<I', len(starts)) + cells[starts].astype('<u4').tostring() + lengths.astype('<u4').tostring()
+
+
+def decode_runs(buffer, offset = 0):
+	"""
+	The inverse of encode_runs, the runs start at offset in the buffer.
+	"""
+	(count,) = struct.unpack_from('<I', buffer, offset)
+	values = np.frombuffer(buffer, dtype = '<u4', count = count, offset = offset + 4)
+	lengths = np.frombuffer(buffer, dtype = '<u4', count = count, offset = offset + 4 + 4 * count)
+	return np.repeat(values, lengths)
+
+
+def _chunk_grid(world_dimensions, chunk_dimensions):
+	return tuple((world_dimensions[i] + chunk_dimensions[i] - 1) / chunk_dimensions[i] for i in (X, Y, Z))
+
+
+def _chunk_box(chunk, world_dimensions, chunk_dimensions):
+	low = tuple(chunk[i] * chunk_dimensions[i] for i in (X, Y, Z))
+	high = tuple(min(low[i] + chunk_dimensions[i], world_dimensions[i]) for i in (X, Y, Z))
+	return low, high
+
+
+def _chunks(world_dimensions, chunk_dimensions):
+	#the order the chunks are in in the file
+	(w, h, d) = _chunk_grid(world_dimensions, chunk_dimensions)
+	for cz in xrange(d):
+		for cy in xrange(h):
+			for cx in xrange(w):
+				yield (cx, cy, cz)
+
+
+def _encode_palette(palette):
+	encoded = ''
+	for voxel_id in palette:
+		voxel_id = voxel_id.encode('utf-8') if isinstance(voxel_id, unicode) else voxel_id
+		encoded += struct.pack('<H', len(voxel_id)) + voxel_id
+	
+	return encoded
+
+
+def _write_world(filepath, world_dimensions, voxel_dimensions, chunk_dimensions, active_layer, visibility_flag,
+                 palette, read_box = None):
+	"""
+	Writes a world file, read_box(name, low, high) gives the cells of the world,
+	without it the world is all void.
+	"""
+	chunks = list(_chunks(world_dimensions, chunk_dimensions))
+	table = np.zeros(len(chunks), dtype = CHUNK_ENTRY)
+	encoded_palette = _encode_palette(palette)
+	palette_offset = HEADER.size
+	table_offset = palette_offset + len(encoded_palette)
+	
+	with open(filepath, 'wb') as f_object:
+		f_object.write(HEADER.pack(MAGIC, VERSION,
+		                           world_dimensions[X], world_dimensions[Y], world_dimensions[Z],
+		                           voxel_dimensions[X], voxel_dimensions[Y], voxel_dimensions[Z],
+		                           chunk_dimensions[X], chunk_dimensions[Y], chunk_dimensions[Z],
+		                           active_layer, visibility_flag, palette_offset, len(palette), table_offset))
+		f_object.write(encoded_palette)
+		
+		#the table is filled in once all the chunks are written
+		f_object.write(table.tostring())
+		if not read_box:
+			return
+		
+		for i, chunk in enumerate(chunks):
+			(low, high) = _chunk_box(chunk, world_dimensions, chunk_dimensions)
+			cells = pack_cells(read_box('type_ids', low, high),
+			                   read_box('flags', low, high),
+			                   read_box('outlines', low, high)).ravel()
+			if not cells.any():
+				continue
+			
+			runs = encode_runs(cells)
+			table[i] = (f_object.tell(), len(runs))
+			f_object.write(runs)
+		
+		f_object.seek(table_offset)
+		f_object.write(table.tostring())
+
+
+def save_world(world, filepath, chunk_dimensions = (32, 32, 8)):
+	"""
+	Writes the world into a file, chunk_dimensions is the size of the pieces
+	the file can be loaded in.
+	"""
+	_write_world(filepath, tuple(world.get_dimension(i) for i in (X, Y, Z)), world._voxel_dimensions,
+	             chunk_dimensions, world._active_layer, world.visibility_flag,
+	             world._grid.get_palette(), world._grid.read_box)
+
+
+def create_world_file(filepath, world_dimensions, voxel_dimensions = (72, 36, 36), chunk_dimensions = (32, 32, 8),
+                      active_layer = 0, visibility_flag = ONLY_SHOW_EXPOSED):
+	"""
+	Writes a world file of nothing but void, it is tiny whatever the size of the world is.
+	"""
+	_write_world(filepath, world_dimensions, voxel_dimensions, chunk_dimensions, active_layer, visibility_flag, ['void'])
+
+
+
+class WorldFile(object):
+	"""
+	An open world file, the header and the palette are read right away, the
+	chunks are decoded straight from the memory mapped file on demand. A file
+	opened writable can have its chunks and its palette replaced.
+	"""
+	def __init__(self, filepath, writable = False):
+		self._file = open(filepath, 'r+b' if writable else 'rb')
+		self._map = mmap.mmap(self._file.fileno(), 0, access = mmap.ACCESS_READ)
+		self.writable = writable
+		
+		header = HEADER.unpack_from(self._map, 0)
+		if header[0] != MAGIC:
+			raise IOError('{0} is not a world file'.format(filepath))
+		
+		if header[1] != VERSION:
+			raise IOError('{0} is of version {1}, only version {2} can be read'.format(filepath, header[1], VERSION))
+		
+		self.world_dimensions = header[2:5]
+		self.voxel_dimensions = header[5:8]
+		self.chunk_dimensions = header[8:11]
+		(self.active_layer, self.visibility_flag) = header[11:13]
+		(self._palette_offset, palette_length, self._table_offset) = header[13:16]
+		
+		offset = self._palette_offset
+		self.palette = []
+		for i in xrange(palette_length):
+			(length,) = struct.unpack_from('<H', self._map, offset)
+			self.palette.append(self._map[offset + 2:offset + 2 + length])
+			offset += 2 + length
+		
+		self._grid_dimensions = _chunk_grid(self.world_dimensions, self.chunk_dimensions)
+		self._table = np.frombuffer(self._map, dtype = CHUNK_ENTRY, count = (self._grid_dimensions[X] *
+		                                                                      self._grid_dimensions[Y] *
+		                                                                      self._grid_dimensions[Z]),
+		                            offset = self._table_offset)
+		
+		#the file changes under a writable table so it needs a copy of its own
+		if writable:
+			self._table = self._table.copy()
+	
+	
+	def _chunk_index(self, chunk):
+		return (chunk[Z] * self._grid_dimensions[Y] + chunk[Y]) * self._grid_dimensions[X] + chunk[X]
+	
+	
+	def read_chunk(self, chunk):
+		"""
+		Returns the packed cells of a chunk indexed [z, y, x].
+		"""
+		(low, high) = _chunk_box(chunk, self.world_dimensions, self.chunk_dimensions)
+		shape = (high[Z] - low[Z], high[Y] - low[Y], high[X] - low[X])
+		(offset, length) = self._table[self._chunk_index(chunk)]
+		if not length:
+			return np.zeros(shape, dtype = np.uint32)
+		
+		#chunks written since the file was mapped are past the end of the map
+		if offset + length > len(self._map):
+			self._map.close()
+			self._map = mmap.mmap(self._file.fileno(), 0, access = mmap.ACCESS_READ)
+		
+		return decode_runs(self._map, int(offset)).reshape(shape)
+	
+	
+	def _append(self, data):
+		self._file.seek(0, 2)
+		offset = self._file.tell()
+		self._file.write(data)
+		return offset
+	
+	
+	def write_chunk(self, chunk, cells):
+		"""
+		Replaces the packed cells of a chunk, the new data goes to the end of the
+		file and the old data is left where it was.
+		"""
+		i = self._chunk_index(chunk)
+		cells = cells.ravel()
+		if cells.any():
+			runs = encode_runs(cells)
+			self._table[i] = (self._append(runs), len(runs))
+		
+		else:
+			self._table[i] = (0, 0)
+		
+		self._file.seek(self._table_offset + i * CHUNK_ENTRY.itemsize)
+		self._file.write(self._table[i:i + 1].tostring())
+	
+	
+	def set_palette(self, palette):
+		"""
+		Replaces the palette, the new one goes to the end of the file.
+		"""
+		self.palette = list(palette)
+		self._palette_offset = self._append(_encode_palette(palette))
+		self.write_header()
+	
+	
+	def write_header(self, active_layer = None, visibility_flag = None):
+		if active_layer is not None:
+			self.active_layer = active_layer
+		
+		if visibility_flag is not None:
+			self.visibility_flag = visibility_flag
+		
+		self._file.seek(0)
+		self._file.write(HEADER.pack(MAGIC, VERSION,
+		                             self.world_dimensions[X], self.world_dimensions[Y], self.world_dimensions[Z],
+		                             self.voxel_dimensions[X], self.voxel_dimensions[Y], self.voxel_dimensions[Z],
+		                             self.chunk_dimensions[X], self.chunk_dimensions[Y], self.chunk_dimensions[Z],
+		                             self.active_layer, self.visibility_flag, self._palette_offset, len(self.palette),
+		                             self._table_offset))
+	
+	
+	def flush(self):
+		self._file.flush()
+	
+	
+	def close(self):
+		self._map.close()
+		self._file.close()
+	
+	
+
+
+
+def load_world(filepath, resource_handler, voxel_handler, chunk_dimensions = (8, 8, 4)):
+	"""
+	Opens a world file, the chunks of it are decoded the first time they are
+	needed. chunk_dimensions is the size of the rendered chunks of the world.
+	"""
+	world_file = WorldFile(filepath)
+	storage_factory = lambda world: LazyVoxelStorage(world, voxel_handler, world_file.world_dimensions,
+	                                                 world_file, world_file.palette)
+	
+	world = voxels.VoxelWorld(resource_handler, voxel_handler,
+	                          world_dimensions = world_file.world_dimensions,
+	                          voxel_dimensions = world_file.voxel_dimensions,
+	                          active_layer = world_file.active_layer,
+	                          visibility_flag = world_file.visibility_flag,
+	                          chunk_dimensions = chunk_dimensions,
+	                          storage_factory = storage_factory)
+	
+	#the voxels that update on their own are scheduled as the storage loads their chunks
+	return world
+
+
+def close_world(world):
+	"""
+	Closes the file of a world opened with load_world. Only the chunks that were
+	decoded can be used after that, prefetch the whole world first to keep it.
+	"""
+	world._grid._source.close()
+
+
+def open_paged_world(filepath, resource_handler, voxel_handler, memory_budget = 64 * 1024 * 1024,
+                     chunk_dimensions = (8, 8, 4)):
+	"""
+	Opens a world file for reading and writing, only the chunks of it that are
+	in use are kept in memory, about memory_budget bytes of them.
+	chunk_dimensions is the size of the rendered chunks of the world.
+	"""
+	world_file = WorldFile(filepath, writable = True)
+	storage_factory = lambda world: PagedVoxelStorage(world, voxel_handler, world_file.world_dimensions,
+	                                                  world_file, world_file.palette, memory_budget)
+	
+	world = voxels.VoxelWorld(resource_handler, voxel_handler,
+	                          world_dimensions = world_file.world_dimensions,
+	                          voxel_dimensions = world_file.voxel_dimensions,
+	                          active_layer = world_file.active_layer,
+	                          visibility_flag = world_file.visibility_flag,
+	                          chunk_dimensions = chunk_dimensions,
+	                          storage_factory = storage_factory)
+	
+	#the voxels that update on their own are scheduled as the storage loads their chunks
+	return world
+
+
+def close_paged_world(world):
+	"""
+	Writes everything that changed in a paged world back to its file and closes it.
+	"""
+	storage = world._grid
+	storage.flush()
+	storage._store.write_header(world._active_layer, world.visibility_flag)
+	storage._store.close()
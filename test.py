@@ -48,17 +48,20 @@ class Game:
 		#load resources
 		voxel_handler = depth_confusion.voxels.VoxelHandler()
 		voxel_handler.add_voxel_type('grass-block', GrassBlock)
-		image_handler = depth_confusion.resource_loader.load_image_pack('example_image_pack/pack.json')
+		image_handler = depth_confusion.resource_loader.load_image_pack('example_image_pack/pack.json', lazy = True, prefetch_workers = 4)
 		
 		#generate the world
 		self.world = depth_confusion.world_generator.generate_flat((8, 8, 8), 3, voxel_handler, image_handler, 'grass-block')
 		self.world.visibility_flag = depth_confusion.voxels.ONLY_SHOW_EXPOSED
 		
-		#set up and attach the viewports
-		self.viewport1 = depth_confusion.viewport.Viewport(self._screen)
-		#self.viewport2 = depth_confusion.viewport.Viewport(self._screen, placement = (400, 0), scene_dimensions = (200, 100))
+		#set up and attach the viewports, they share the rendered regions of the world
+		self.world.shared_regions = True
+		self.viewport1 = depth_confusion.viewport.Viewport(self._screen, dirty_rects = True)
+		self.viewport2 = depth_confusion.viewport.Viewport(self._screen, placement = (400, 0), scene_dimensions = (200, 100))
 		self.viewport1.attach_to_world(self.world)
-		#self.viewport2.attach_to_world(self.world)
+		self.viewport2.attach_to_world(self.world)
+		self.viewport2.set_scale(0.25)
+		self.viewport2.center_on((4, 4, 0))
 		
 		return True
 	
@@ -72,6 +75,23 @@ class Game:
 		if event.type == pygame.QUIT:
 			self._running = False
 		
+		elif event.type == pygame.KEYDOWN and event.key == pygame.K_F3:
+			#toggle the profiler overlay
+			if depth_confusion.profiling.PROFILER.enabled:
+				depth_confusion.profiling.PROFILER.disable()
+				self.viewport1.dirty_rects = True
+			
+			else:
+				depth_confusion.profiling.PROFILER.enable()
+				self.viewport1.dirty_rects = False
+		
+		elif event.type == pygame.KEYDOWN and event.key in (pygame.K_EQUALS, pygame.K_MINUS):
+			#zoom in and out around the mouse pointer
+			self.viewport1.zoom(1 if event.key == pygame.K_EQUALS else -1, pygame.mouse.get_pos())
+		
+		elif event.type == pygame.KEYDOWN and event.key == pygame.K_c:
+			self.viewport1.center_on((4, 4, self.world._active_layer))
+		
 		elif event.type == pygame.MOUSEMOTION:
 			#print 'pos: {0}, rel: {1}, buttons:{2}'.format(event.pos, event.rel, event.buttons)
 			if event.buttons[2] == 1:
@@ -81,10 +101,9 @@ class Game:
 		elif event.type == pygame.MOUSEBUTTONDOWN:
 			#print event.button
 			if event.button == 1:
-				coordinate = self.world.global_to_map(self.viewport1.screen_to_global(event.pos))
-				voxel = self.world[coordinate]
-				if voxel:
-					voxel.highlight()
+				coordinate = self.world.pick(self.viewport1.screen_to_global(event.pos))
+				if coordinate:
+					self.world[coordinate].highlight()
 			
 			elif event.button == 4:
 				self.world.scroll_layer(1)
@@ -93,8 +112,8 @@ class Game:
 				self.world.scroll_layer(-1)
 			
 			elif event.button == 3:
-				coordinate = self.world.global_to_map(self.viewport1.screen_to_global(event.pos))
-				if self.world.is_voxel_rendered(coordinate):
+				coordinate = self.world.pick(self.viewport1.screen_to_global(event.pos))
+				if coordinate:
 					del self.world[coordinate]
 				
 	
@@ -102,9 +121,10 @@ class Game:
 	def on_render(self):
 		#self._screen.blit(self._background, (0, 0))
 		#self.world.on_render(self._screen)
-		self.viewport1.on_render()
-		#self.viewport2.on_render()
-		pygame.display.flip()
+		changed = self.viewport1.on_render()
+		changed += self.viewport2.on_render()
+		depth_confusion.profiling.PROFILER.draw_overlay(self._screen)
+		pygame.display.update(changed)
 	
 	
 	def execute(self):
@@ -112,11 +132,13 @@ class Game:
 		
 		while self._running:
 			self._clock.tick(60)
+			depth_confusion.profiling.PROFILER.begin_frame()
 			for event in pygame.event.get():
 				self.on_event(event)
 			
 			self.on_update()
 			self.on_render()
+			depth_confusion.profiling.PROFILER.end_frame()
 			
 		
 		pygame.quit()